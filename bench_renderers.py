@@ -0,0 +1,80 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Compares how long each available renderer (see roboviva/renderers.py) takes
+to render the same routes.
+
+Routes are synthetic, with a fixed mix of turns, notes, climbs and colored
+rows, so runs are comparable across machines and renderers.
+
+Example:
+  python bench_renderers.py --cues 30 300 --repeat 5
+'''
+
+import argparse
+import random
+import sys
+import time
+
+from roboviva import cue
+from roboviva import renderers
+
+def syntheticRoute(n_cues, seed = 0):
+  '''Makes a cue.Route with 'n_cues' entries.'''
+  rng = random.Random(seed)
+  instructions = [cue.Instruction.LEFT, cue.Instruction.RIGHT, cue.Instruction.STRAIGHT,
+                  cue.Instruction.PIT, cue.Instruction.CAT_3, cue.Instruction.DANGER]
+  entries = []
+  distance = 0.0
+  for i in xrange(n_cues):
+    step = rng.uniform(0.1, 5.0)
+    note = "*Careful*: **gravel** for a bit" if rng.random() < 0.2 else ""
+    color = rng.choice([cue.Color.NONE] * 8 + [cue.Color.GRAY, cue.Color.YELLOW])
+    entries.append(cue.Entry(rng.choice(instructions), "Street number %d" % i,
+                             distance, note = note, for_distance = step, color = color))
+    distance += step
+  return cue.Route(entries, distance, 1000 + n_cues, "Benchmark %d" % n_cues, n_cues * 50)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description = "Benchmark PDF renderers.")
+  parser.add_argument("--cues", type = int, nargs = "+", default = [30, 100, 300],
+                      help = "Route sizes to render")
+  parser.add_argument("--repeat", type = int, default = 3,
+                      help = "Renders per renderer and route size")
+  args = parser.parse_args(argv[1:])
+
+  print "%-10s %6s %10s %10s %10s" % ("renderer", "cues", "min (s)", "mean (s)", "size (kB)")
+  for name in renderers.names():
+    renderer = renderers.get(name)
+    if not renderer.available():
+      print "%-10s (not available here)" % name
+      continue
+    for n_cues in args.cues:
+      route = syntheticRoute(n_cues)
+      timings = []
+      for _ in xrange(args.repeat):
+        start = time.time()
+        pdf = renderer.render(route)
+        timings.append(time.time() - start)
+      print "%-10s %6d %10.3f %10.3f %10.1f" % (name, n_cues, min(timings),
+                                                sum(timings) / len(timings),
+                                                len(pdf) / 1024.0)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,53 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Builds roboviva/static into ASSET_DIR (see config.py): every asset under a
+content-hashed name, the HTML pages rewritten to refer to those names, and the
+text files precompressed (gzip, plus brotli if the brotli module is
+installed). Once built, the site serves those instead, with hashed assets
+cached forever, so repeat page loads don't fetch any of them again.
+
+Usage: build_assets.py [--src DIR] [--out DIR]
+
+Re-run it after changing anything in roboviva/static (update_version.sh does,
+after stamping the new version into index.html).
+'''
+
+import argparse
+import os
+import sys
+
+import roboviva
+from roboviva import assets
+
+def main(argv):
+  parser = argparse.ArgumentParser(description = "Build the static assets.")
+  parser.add_argument("--src", default = os.path.join(roboviva.app.root_path, "static"),
+                      help = "Directory of assets to build (default: roboviva/static)")
+  parser.add_argument("--out", default = roboviva.app.config['ASSET_DIR'],
+                      help = "Directory to build them into (default: ASSET_DIR)")
+  args = parser.parse_args(argv[1:])
+
+  manifest = assets.buildAssets(args.src, args.out)
+  for filename in sorted(manifest):
+    print "%24s -> %s" % (filename, manifest[filename])
+  print "Built %d assets into %s." % (len(manifest), args.out)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
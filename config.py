@@ -19,4 +19,86 @@ import os
 _cwd = os.path.dirname(os.path.abspath(__file__))
 
 PDF_CACHE_DIR = os.path.join(_cwd, 'pdf_cache')
+# Parsed routes, kept so PDFs can be re-rendered without asking RideWithGPS:
+ROUTE_CACHE_DIR = os.path.join(_cwd, 'route_cache')
 SHELVE_FILENAME = '/tmp/roboviva.db'
+# An index of the cache db, for the admin pages; see roboviva/cache_index.py.
+# None keeps it next to the db, in SHELVE_FILENAME + '.index'.
+CACHE_INDEX_FILE = None
+
+# How long a request for a route may take, all told, in seconds. Fetching
+# from RideWithGPS and running pdflatex share this budget: retries that
+# wouldn't finish in time aren't tried, pdflatex is stopped when it runs out,
+# and a stale PDF is served instead if there is one. None disables this.
+REQUEST_DEADLINE_SECS = 30
+
+# Where to fetch routes from. Point this at a local stand-in server (see
+# roboviva/standin.py) to test without hitting the real RideWithGPS.
+RWGPS_BASE_URL = 'http://ridewithgps.com'
+
+# Be gentle with RideWithGPS: at most RWGPS_RATE_LIMIT requests per second
+# (with bursts of up to RWGPS_RATE_BURST), each attempt timing out after
+# RWGPS_TIMEOUT_SECS. After RWGPS_BREAKER_THRESHOLD failed fetches in a row,
+# stop asking for RWGPS_BREAKER_RESET_SECS, and serve cached PDFs instead.
+RWGPS_MAX_ATTEMPTS = 3
+RWGPS_TIMEOUT_SECS = 5
+RWGPS_RATE_LIMIT = 10
+RWGPS_RATE_BURST = 20
+RWGPS_BREAKER_THRESHOLD = 5
+RWGPS_BREAKER_RESET_SECS = 30
+
+# Hedged requests: if a request to RideWithGPS is slower than the recent
+# RWGPS_HEDGE_PERCENTILE latency, send an identical one alongside it and use
+# whichever answers first. At most RWGPS_HEDGE_MAX_RATE of requests are hedged.
+RWGPS_HEDGE = False
+RWGPS_HEDGE_PERCENTILE = 0.95
+RWGPS_HEDGE_MAX_RATE = 0.05
+
+# How PDFs are rendered: 'latex' (needs pdflatex) or 'reportlab' (needs
+# ReportLab). See roboviva/renderers.py. Individual requests can ask for
+# another one with '?renderer=<name>'.
+RENDERER = 'latex'
+
+# Routes with more than LONG_ROUTE_ENTRIES cues are rendered in pieces of
+# LONG_ROUTE_CHUNK_ENTRIES cues (about a page each), on up to
+# LONG_ROUTE_WORKERS cores at once (None: all of them). See roboviva/chunked.py.
+LONG_ROUTE_ENTRIES = 240
+LONG_ROUTE_CHUNK_ENTRIES = 80
+LONG_ROUTE_WORKERS = None
+# If set, the rendered chunks of long routes are kept here (at most
+# CHUNK_CACHE_MAX of them), so re-rendering an edited route only re-renders
+# the pages around the edit.
+CHUNK_CACHE_DIR = os.path.join(_cwd, 'chunk_cache')
+CHUNK_CACHE_MAX = 5000
+
+# Routes with more than PREVIEW_ENTRIES cues, and no PDF yet, first get a
+# quick preview of their first PREVIEW_ENTRIES cues, while the full PDF
+# renders in the background. See /routes/<id>/status. None disables this.
+PREVIEW_ENTRIES = 60
+
+# Static assets built by build_assets.py: content-hashed names, precompressed,
+# and served with long-lived caching. Until they've been built, the files in
+# roboviva/static are served as-is.
+ASSET_DIR = os.path.join(_cwd, 'static_build')
+
+# The most routes /pack will render at once:
+PACK_MAX_ROUTES = 20
+
+# Remember failures for a while, rather than retrying them on every click:
+# route ids RideWithGPS says don't exist, for UNKNOWN_ROUTE_TTL_SECS, and
+# LaTeX that pdflatex choked on, for FAILED_RENDER_TTL_SECS. See /cache/negative.
+UNKNOWN_ROUTE_TTL_SECS = 300
+FAILED_RENDER_TTL_SECS = 3600
+
+# If set, request trace spans are appended to this file, one JSON object per
+# line. See roboviva/tracing.py.
+TRACE_LOG_FILE = None
+
+# Profiling of slow requests; see roboviva/profiling.py. Requests slower than
+# PROFILE_SLOW_REQUEST_SECS have their stack samples written to PROFILE_DIR.
+# None disables this. If PROFILE_ADMIN_TOKEN is set, any request can be
+# profiled on demand by adding '?profile=<token>' to its URL.
+PROFILE_SLOW_REQUEST_SECS = None
+PROFILE_ADMIN_TOKEN = None
+PROFILE_DIR = os.path.join(_cwd, 'profiles')
+PROFILE_KEEP = 50
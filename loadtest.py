@@ -0,0 +1,219 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+End-to-end load test for Roboviva.
+
+Starts a local RideWithGPS stand-in (roboviva/standin.py), points the real
+Flask app at it, serves the app over HTTP on localhost, and then hammers
+/roboviva/routes/<id> (following the redirect to /roboviva/pdfs/<id>.pdf)
+from a pool of client threads. A fraction of requests go to a small set of
+"hot" routes, which will mostly be cache hits; the rest go to never-before-seen
+"cold" routes, which need a full fetch + render.
+
+Reports throughput, p50/p95/p99 latency per endpoint, and Roboviva's cache
+hit ratios (as reported by /roboviva/metrics).
+
+Example:
+  python loadtest.py --clients 8 --requests 500 --hot-fraction 0.9 \
+      --upstream-latency 0.1 --upstream-error-rate 0.01
+'''
+
+import argparse
+import collections
+import logging
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+import werkzeug.serving
+
+import roboviva
+from roboviva import ridewithgps
+from roboviva import standin
+
+class _NoRedirect(urllib2.HTTPRedirectHandler):
+  '''Hands redirects back to us as-is, so each hop can be timed separately.'''
+  def http_error_302(self, req, fp, code, msg, headers):
+    return fp
+  http_error_301 = http_error_303 = http_error_307 = http_error_302
+
+def _percentile(sorted_values, fraction):
+  if not sorted_values:
+    return float('nan')
+  index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+  return sorted_values[index]
+
+class LoadTest(object):
+  def __init__(self, base_url, n_requests, n_clients, hot_fraction, n_hot,
+               timeout_secs, seed = None):
+    self.base_url     = base_url
+    self.n_requests   = n_requests
+    self.n_clients    = n_clients
+    self.hot_fraction = hot_fraction
+    self.hot_routes   = [1000 + i for i in xrange(n_hot)]
+    self.timeout_secs = timeout_secs
+    self.latencies    = collections.defaultdict(list)
+    self.statuses     = collections.Counter()
+    self._next_cold   = 1000000
+    self._issued      = 0
+    self._lock        = threading.Lock()
+    self._rng         = random.Random(seed)
+    self._opener      = urllib2.build_opener(_NoRedirect)
+
+  def _nextRoute(self):
+    '''Returns the next route id to request, or None when we're done.'''
+    with self._lock:
+      if self._issued >= self.n_requests:
+        return None
+      self._issued += 1
+      if self._rng.random() < self.hot_fraction:
+        return ('hot', self._rng.choice(self.hot_routes))
+      self._next_cold += 1
+      return ('cold', self._next_cold)
+
+  def _get(self, kind, url):
+    start = time.time()
+    try:
+      resp = self._opener.open(url, timeout = self.timeout_secs)
+      resp.read()
+      status, location = resp.getcode(), resp.info().getheader("Location")
+    except urllib2.HTTPError as e:
+      status, location = e.code, None
+    except Exception as e:
+      status, location = type(e).__name__, None
+    elapsed = time.time() - start
+    with self._lock:
+      self.latencies[kind].append(elapsed)
+      self.statuses["%s %s" % (kind, status)] += 1
+    return status, location, elapsed
+
+  def _client(self):
+    while True:
+      route = self._nextRoute()
+      if route is None:
+        return
+      temperature, route_id = route
+      status, location, route_secs = self._get(
+          "route", "%s/roboviva/routes/%d" % (self.base_url, route_id))
+      pdf_secs = 0.0
+      if location:
+        if location.startswith("/"):
+          location = self.base_url + location
+        status, _, pdf_secs = self._get("pdf", location)
+      with self._lock:
+        self.latencies["%s total" % temperature].append(route_secs + pdf_secs)
+
+  def run(self):
+    start = time.time()
+    clients = [threading.Thread(target = self._client) for i in xrange(self.n_clients)]
+    for client in clients:
+      client.start()
+    for client in clients:
+      client.join()
+    return time.time() - start
+
+def _cacheCounts(base_url):
+  '''Scrapes roboviva_cache_lookups_total from the app's metrics.'''
+  text = urllib2.urlopen("%s/roboviva/metrics" % base_url).read()
+  counts = {}
+  for result, value in re.findall(r'^roboviva_cache_lookups_total\{result="(\w+)"\} (\S+)$',
+                                  text, re.M):
+    counts[result] = float(value)
+  return counts
+
+def main(argv):
+  parser = argparse.ArgumentParser(description = __doc__,
+                                   formatter_class = argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--requests",     type = int,   default = 200,
+                      help = "Total number of route requests to make.")
+  parser.add_argument("--clients",      type = int,   default = 4,
+                      help = "Number of concurrent client threads.")
+  parser.add_argument("--hot-fraction", type = float, default = 0.8,
+                      help = "Fraction of requests that go to hot routes.")
+  parser.add_argument("--hot-routes",   type = int,   default = 20,
+                      help = "Number of distinct hot routes.")
+  parser.add_argument("--cues",         type = int,   default = 60,
+                      help = "Number of cues in each (synthetic) route.")
+  parser.add_argument("--timeout",      type = float, default = 120.0,
+                      help = "Client-side timeout per request, in seconds.")
+  parser.add_argument("--seed",         type = int,   default = None)
+  parser.add_argument("--upstream-latency",      type = float, default = 0.0)
+  parser.add_argument("--upstream-jitter",       type = float, default = 0.0)
+  parser.add_argument("--upstream-error-rate",   type = float, default = 0.0)
+  parser.add_argument("--upstream-timeout-rate", type = float, default = 0.0)
+  args = parser.parse_args(argv[1:])
+
+  upstream = standin.StandInServer(latency_secs = args.upstream_latency,
+                                   jitter_secs  = args.upstream_jitter,
+                                   error_rate   = args.upstream_error_rate,
+                                   timeout_rate = args.upstream_timeout_rate,
+                                   n_cues       = args.cues).start()
+  work_dir = tempfile.mkdtemp(prefix = "roboviva-loadtest-")
+  app = roboviva.app
+  app.config['PDF_CACHE_DIR']   = work_dir
+  app.config['SHELVE_FILENAME'] = "%s/shelf" % work_dir
+  ridewithgps.Base_Url = upstream.url
+  # Keep the per-request access log quiet:
+  logging.getLogger("werkzeug").setLevel(logging.WARNING)
+  server = werkzeug.serving.make_server("127.0.0.1", 0, app, threaded = True)
+  server_thread = threading.Thread(target = server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  base_url = "http://127.0.0.1:%d" % server.server_port
+
+  try:
+    print "Upstream stand-in: %s, Roboviva: %s, scratch: %s" % (upstream.url, base_url, work_dir)
+    test = LoadTest(base_url, args.requests, args.clients, args.hot_fraction,
+                    args.hot_routes, args.timeout, args.seed)
+    elapsed = test.run()
+
+    print
+    print "%d requests from %d clients in %.1f s: %.1f routes/s" % (
+        args.requests, args.clients, elapsed, args.requests / elapsed)
+    print
+    print "%-12s %7s %9s %9s %9s %9s" % ("latency", "n", "p50", "p95", "p99", "max")
+    for kind in sorted(test.latencies):
+      values = sorted(test.latencies[kind])
+      print "%-12s %7d %8.3fs %8.3fs %8.3fs %8.3fs" % (
+          kind, len(values), _percentile(values, 0.5), _percentile(values, 0.95),
+          _percentile(values, 0.99), values[-1])
+    print
+    print "Responses:"
+    for status, count in sorted(test.statuses.items()):
+      print "  %-20s %d" % (status, count)
+    print
+    counts = _cacheCounts(base_url)
+    lookups = sum(counts.values())
+    print "Cache lookups: %d" % lookups
+    for result in sorted(counts):
+      print "  %-20s %5d (%.1f%%)" % (result, counts[result], 100.0 * counts[result] / max(1, lookups))
+    print
+    print "Upstream: %s" % ", ".join("%s: %d" % kv for kv in sorted(upstream.counts.items()))
+  finally:
+    server.shutdown()
+    upstream.stop()
+    shutil.rmtree(work_dir, ignore_errors = True)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -28,8 +28,7 @@ def main(argv):
   print "%% Downloading route from ridewithgps...",
   etag, cues = ridewithgps.getETagAndCuesheet_viaJSON(route_id)
   print "%% Done [etag: %s]" % etag
-  src = latex.makeLatex(cues)
-  print src
+  latex.writeLatex(cues, sys.stdout)
 
 if __name__ == "__main__":
   sys.exit(main(sys.argv))
@@ -17,25 +17,55 @@
 import sys
 from roboviva import ridewithgps
 from roboviva import latex
+from roboviva import pack
 from roboviva import tex
 
 def main(argv):
-  if len(argv) != 2:
-    print "Usage: %s route_id" % argv[0]
+  if len(argv) < 2:
+    print "Usage: %s route_id [route_id ...] [--pack pack.pdf]" % argv[0]
+    print "  With several route ids, all of the routes are rendered in one go."
+    print "  --pack also writes them all out as a single PDF."
     return 1
 
-  route_id = int(argv[1])
-  print "Downloading route from ridewithgps...",
-  etag, cues = ridewithgps.getETagAndCuesheet_viaJSON(route_id)
-  print " Done [etag: %s]" % etag
-  print "Generating latex...",
-  src = latex.makeLatex(cues)
-  print " Done."
-  filename = "%s.pdf" % route_id
-  print "Rendering PDF to '%s'..." % filename,
-  with open(filename, 'wb') as pdf_file:
-    pdf_file.write(tex.latex2pdf(src))
+  args = argv[1:]
+  pack_filename = None
+  if "--pack" in args:
+    i = args.index("--pack")
+    pack_filename = args[i + 1]
+    del args[i:i + 2]
+  route_ids = [int(arg) for arg in args]
+
+  routes = []
+  for route_id in route_ids:
+    print "Downloading route %s from ridewithgps..." % route_id,
+    etag, cues = ridewithgps.getETagAndCuesheet_viaJSON(route_id)
+    print " Done [etag: %s]" % etag
+    routes.append(cues)
+
+  if len(routes) == 1 and not pack_filename:
+    filename = "%s.pdf" % route_ids[0]
+    print "Rendering PDF to '%s'..." % filename,
+    # Stream the latex straight into the renderer, rather than building up the
+    # whole document in memory first:
+    pdf_data = tex.latex2pdf(latex.generateLatex(routes[0]))
+    with open(filename, 'wb') as pdf_file:
+      pdf_file.write(pdf_data)
+    print " Done."
+    return 0
+
+  print "Rendering %d routes..." % len(routes),
+  pack_pdf, route_pdfs = pack.renderPack(routes)
   print " Done."
+  for route_id, pdf_data in zip(route_ids, route_pdfs):
+    filename = "%s.pdf" % route_id
+    print "Writing '%s'" % filename
+    with open(filename, 'wb') as pdf_file:
+      pdf_file.write(pdf_data)
+  if pack_filename:
+    print "Writing '%s'" % pack_filename
+    with open(pack_filename, 'wb') as pdf_file:
+      pdf_file.write(pack_pdf)
+  return 0
 
 if __name__ == "__main__":
   sys.exit(main(sys.argv))
@@ -0,0 +1,92 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Re-renders cached PDFs from the local store of parsed routes, without
+contacting RideWithGPS. Useful after changing the renderer or the sheet
+layout.
+
+Usage: rebuild_pdfs.py [--outdated] [--rate N] [route_id ...]
+
+With no route ids, every stored route is re-rendered. With --outdated, only
+routes whose cached PDF was made by an older renderer are; --rate spreads the
+work out, so a renderer change can be trickled out in the background while the
+site keeps serving.
+'''
+
+import argparse
+import sys
+import time
+
+import roboviva
+from roboviva import upstream
+from roboviva import views
+
+def rebuildRoute(route_id, outdated_only):
+  '''Re-renders one route. Returns "OK", "SKIPPED", or an error string.'''
+  # The cache db is only locked to read and write the entry, not while
+  # rendering, so the site keeps serving while a rebuild trickles out:
+  with roboviva.app.test_request_context():
+    if outdated_only:
+      with views._cacheDb() as hash_db:
+        entry = views._cacheEntry(hash_db, str(route_id))
+      if entry is None or entry[2] == views._configuredRenderer().version:
+        return "SKIPPED"
+    stored = views._routeStore().latest(route_id)
+    if stored is None:
+      return "not in route store"
+    etag, route = stored
+    if views._renderRoute(int(route_id), route):
+      return "FAILED"
+    with views._cacheDb() as hash_db:
+      views._markRendered(hash_db, route_id, etag, route)
+    return "OK"
+
+def main(argv):
+  parser = argparse.ArgumentParser(description = "Re-render cached PDFs.")
+  parser.add_argument("route_ids", nargs = "*",
+                      help = "Routes to re-render (default: all stored routes)")
+  parser.add_argument("--outdated", action = "store_true",
+                      help = "Only re-render PDFs made by an older renderer")
+  parser.add_argument("--rate", type = float, default = 0,
+                      help = "Re-render at most this many routes per second (0: no limit)")
+  args = parser.parse_args(argv[1:])
+
+  route_ids = args.route_ids
+  with roboviva.app.test_request_context():
+    if not route_ids:
+      route_ids = sorted(views._routeStore().routeIds(), key = int)
+    renderer = views._configuredRenderer()
+    print "Renderer: %s (version %s)" % (renderer.name, renderer.version)
+  bucket = upstream.TokenBucket(args.rate, 1) if args.rate > 0 else None
+
+  counts = {}
+  for route_id in route_ids:
+    if bucket:
+      bucket.acquire()
+    start = time.time()
+    result = rebuildRoute(route_id, args.outdated)
+    counts[result] = counts.get(result, 0) + 1
+    if result != "SKIPPED":
+      print "%10s: %s (%.2f s)" % (route_id, result, time.time() - start)
+  n_failed = len(route_ids) - counts.get("OK", 0) - counts.get("SKIPPED", 0)
+  print "%d routes re-rendered, %d up to date, %d failed." % (
+      counts.get("OK", 0), counts.get("SKIPPED", 0), n_failed)
+  return 1 if n_failed else 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
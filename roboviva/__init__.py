@@ -17,6 +17,8 @@
 from flask import Flask
 from flask.ext import shelve
 from .views import blueprint
+from . import ridewithgps
+from . import profiling
 
 import sys
 import logging
@@ -30,9 +32,22 @@ app.config.from_object('config')
 app.register_blueprint(blueprint,
                        url_prefix="/roboviva")
 
+ridewithgps.configure(app.config)
+
 if not app.debug:
   # In production mode, add log handler to sys.stderr.
   app.logger.addHandler(logging.StreamHandler())
   app.logger.setLevel(logging.WARN)
 
+if app.config.get('TRACE_LOG_FILE'):
+  # Trace spans are one JSON object per line; keep them in their own file, so
+  # they can be fed straight into whatever rebuilds the timelines:
+  trace_handler = logging.FileHandler(app.config['TRACE_LOG_FILE'])
+  trace_handler.setFormatter(logging.Formatter("%(message)s"))
+  trace_logger = logging.getLogger("roboviva.trace")
+  trace_logger.addHandler(trace_handler)
+  trace_logger.setLevel(logging.INFO)
+  trace_logger.propagate = False
+
 shelve.init_app(app)
+profiling.init_app(app)
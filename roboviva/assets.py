@@ -0,0 +1,151 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Builds the static assets for serving with long-lived caching.
+
+buildAssets() copies each asset (CSS, JS, images, ...) to the output directory
+under a name with a hash of its contents in it (robo.css -> robo.1a2b3c4d5e.css),
+so a changed file gets a new URL, and a given URL's contents never change. The
+HTML pages keep their names - they're what people bookmark - but their
+references to assets are rewritten to the hashed names. Text files are also
+stored precompressed, as <name>.gz and, if the brotli module is installed,
+<name>.br, so they can be served without compressing them per request.
+
+The original -> hashed names are written to Manifest_Name in the output
+directory, as JSON.
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+Manifest_Name    = "manifest.json"
+Html_Extensions  = (".html",)
+# Images are already compressed; compressing them again just wastes space:
+Compressible_Extensions = (".html", ".css", ".js", ".svg", ".txt")
+
+# href= / src= attribute values, quoted or not:
+_Reference_Re = re.compile(r'''((?:href|src)\s*=\s*["']?)([^"'\s>]+)''', re.IGNORECASE)
+
+def hashedName(filename, data):
+  '''Returns 'filename', with a hash of 'data' before its extension.'''
+  base, ext = os.path.splitext(filename)
+  return "%s.%s%s" % (base, hashlib.sha1(data).hexdigest()[:10], ext)
+
+def rewriteReferences(html, manifest):
+  '''Returns 'html', with every href / src that names an asset in 'manifest'
+  pointing at the asset's hashed name instead.'''
+  def replace(match):
+    return match.group(1) + manifest.get(match.group(2), match.group(2))
+  return _Reference_Re.sub(replace, html)
+
+def _brotli():
+  try:
+    import brotli
+    return brotli
+  except ImportError:
+    return None
+
+def _writeFile(path, data):
+  '''Writes 'data' to 'path' via a temp file, so readers never see half of it.'''
+  fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path))
+  with os.fdopen(fd, 'wb') as out:
+    out.write(data)
+  os.rename(tmp_path, path)
+
+def _writeCompressed(path, data):
+  '''Writes 'data' to 'path', plus precompressed copies if it's worth it.'''
+  _writeFile(path, data)
+  if not path.endswith(Compressible_Extensions):
+    return
+  fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path))
+  with os.fdopen(fd, 'wb') as out:
+    # (mtime = 0, so unchanged files compress to the same bytes every build.)
+    with gzip.GzipFile(os.path.basename(path), 'wb', 9, out, mtime = 0) as gz:
+      gz.write(data)
+  os.rename(tmp_path, path + ".gz")
+  brotli = _brotli()
+  if brotli:
+    _writeFile(path + ".br", brotli.compress(data))
+
+def buildAssets(src_dir, out_dir):
+  '''Builds the assets in 'src_dir' into 'out_dir' (see above), replacing
+  anything already there. Returns the manifest.
+
+  The new build is made in a directory next to 'out_dir', and renamed into
+  place once it's complete, so a server running from 'out_dir' never serves
+  pages that point at assets that aren't there yet.'''
+  out_dir = os.path.abspath(out_dir)
+  parent  = os.path.dirname(out_dir)
+  if not os.path.isdir(parent):
+    os.makedirs(parent)
+  build_dir = tempfile.mkdtemp(dir = parent, prefix = "." + os.path.basename(out_dir) + ".")
+  try:
+    manifest = _build(src_dir, build_dir)
+  except:
+    shutil.rmtree(build_dir)
+    raise
+  # (mkdtemp() makes it private; the web server may be running as someone else.)
+  os.chmod(build_dir, 0755)
+
+  # A directory can't be renamed over another, so move the old one aside
+  # first. In between, there's no build at all, and the originals are served:
+  old_dir = None
+  if os.path.isdir(out_dir):
+    old_dir = build_dir + ".old"
+    os.rename(out_dir, old_dir)
+  os.rename(build_dir, out_dir)
+  if old_dir:
+    shutil.rmtree(old_dir)
+  return manifest
+
+def _build(src_dir, out_dir):
+  '''Builds the assets in 'src_dir' into the (empty) 'out_dir'. Returns the
+  manifest.'''
+  filenames = sorted(filename for filename in os.listdir(src_dir)
+                     if os.path.isfile(os.path.join(src_dir, filename)))
+  manifest = {}
+  pages    = []
+  for filename in filenames:
+    with open(os.path.join(src_dir, filename), 'rb') as asset:
+      data = asset.read()
+    if filename.endswith(Html_Extensions):
+      pages.append((filename, data))
+      continue
+    manifest[filename] = hashedName(filename, data)
+    _writeCompressed(os.path.join(out_dir, manifest[filename]), data)
+
+  for filename, data in pages:
+    _writeCompressed(os.path.join(out_dir, filename), rewriteReferences(data, manifest))
+
+  _writeFile(os.path.join(out_dir, Manifest_Name),
+             json.dumps(manifest, indent = 2, sort_keys = True))
+  return manifest
+
+def loadManifest(out_dir):
+  '''Returns the manifest of the assets built into 'out_dir', or {} if none
+  have been.'''
+  try:
+    with open(os.path.join(out_dir, Manifest_Name)) as manifest:
+      return json.load(manifest)
+  except IOError:
+    return {}
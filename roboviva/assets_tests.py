@@ -0,0 +1,107 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import assets
+
+class AssetsTestCase(unittest.TestCase):
+  '''Tests for the assets library'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.src = os.path.join(self.directory, "src")
+    self.out = os.path.join(self.directory, "out")
+    os.makedirs(self.src)
+    for filename, data in (("index.html", '<link href="robo.css"><script src=robo.js></script>'
+                                          '<a href=tips.html>Tips</a>'),
+                           ("robo.css",   "body { color: red; }"),
+                           ("robo.js",    "function doViva() {}"),
+                           ("tips.gif",   "GIF89a")):
+      with open(os.path.join(self.src, filename), 'wb') as asset:
+        asset.write(data)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def read(self, filename):
+    with open(os.path.join(self.out, filename), 'rb') as asset:
+      return asset.read()
+
+  def test_hashedName(self):
+    self.assertEqual(assets.hashedName("robo.css", "a"), assets.hashedName("robo.css", "a"))
+    self.assertNotEqual(assets.hashedName("robo.css", "a"), assets.hashedName("robo.css", "b"))
+    self.assertTrue(assets.hashedName("robo.css", "a").startswith("robo."))
+    self.assertTrue(assets.hashedName("robo.css", "a").endswith(".css"))
+
+  def test_rewriteReferences(self):
+    manifest = {"robo.css" : "robo.123.css"}
+    self.assertEqual('<link href="robo.123.css"> <a href=robo.123.css> <img src="other.gif">',
+                     assets.rewriteReferences(
+                         '<link href="robo.css"> <a href=robo.css> <img src="other.gif">',
+                         manifest))
+
+  def test_buildAssets(self):
+    manifest = assets.buildAssets(self.src, self.out)
+    self.assertEqual(["robo.css", "robo.js", "tips.gif"], sorted(manifest))
+    self.assertEqual(manifest, json.loads(self.read(assets.Manifest_Name)))
+    self.assertEqual(manifest, assets.loadManifest(self.out))
+
+    # Assets are under their hashed names; pages keep theirs, and point at
+    # the hashed names:
+    self.assertEqual("body { color: red; }", self.read(manifest["robo.css"]))
+    self.assertFalse(os.path.exists(os.path.join(self.out, "robo.css")))
+    self.assertEqual('<link href="%s"><script src=%s></script><a href=tips.html>Tips</a>' %
+                     (manifest["robo.css"], manifest["robo.js"]),
+                     self.read("index.html"))
+
+    # Text is precompressed, images aren't:
+    with gzip.open(os.path.join(self.out, manifest["robo.css"] + ".gz")) as gz:
+      self.assertEqual("body { color: red; }", gz.read())
+    self.assertTrue(os.path.exists(os.path.join(self.out, "index.html.gz")))
+    self.assertFalse(os.path.exists(os.path.join(self.out, manifest["tips.gif"] + ".gz")))
+
+  def test_rebuildIsReproducible(self):
+    assets.buildAssets(self.src, self.out)
+    first = dict((filename, self.read(filename)) for filename in os.listdir(self.out))
+    assets.buildAssets(self.src, self.out)
+    second = dict((filename, self.read(filename)) for filename in os.listdir(self.out))
+    self.assertEqual(first, second)
+
+  def test_rebuildSwapsInPlace(self):
+    assets.buildAssets(self.src, self.out)
+    with open(os.path.join(self.src, "robo.css"), 'wb') as asset:
+      asset.write("body { color: blue; }")
+    manifest = assets.buildAssets(self.src, self.out)
+    self.assertEqual(manifest, assets.loadManifest(self.out))
+    self.assertEqual("body { color: blue; }", self.read(manifest["robo.css"]))
+    # The old build's files are gone, and so is the directory it was built in:
+    self.assertEqual(sorted(manifest.values() + [assets.Manifest_Name, "index.html"]),
+                     sorted(filename for filename in os.listdir(self.out)
+                            if not filename.endswith((".gz", ".br"))))
+    self.assertEqual(["out", "src"], sorted(os.listdir(self.directory)))
+
+  def test_noManifest(self):
+    self.assertEqual({}, assets.loadManifest(self.out))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,169 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+A queryable index of the PDF cache, for the admin pages.
+
+The cache db (a shelve, keyed on route id) can only be walked end to end, so
+listing, sorting or purging it means loading every entry. This keeps a copy of
+each entry's metadata - etag, when it was rendered, by which renderer, and the
+PDF's size - in an SQLite table with indexes on age and size, so the admin
+pages can ask for one filtered, sorted page of entries at a time.
+
+The cache db stays the source of truth: views.py updates the index whenever it
+updates the db, and rebuild() re-creates it from the db (e.g. if it's lost, or
+the db was changed by something that doesn't know about it).
+'''
+
+import contextlib
+import sqlite3
+
+# Columns entries can be sorted on, by the names the admin pages use:
+Sort_Columns = { "id"   : "route_id",
+                 "age"  : "timestamp",
+                 "size" : "pdf_size" }
+
+_Schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+  route_id         INTEGER PRIMARY KEY,
+  etag             TEXT,
+  timestamp        REAL,
+  renderer_version TEXT,
+  pdf_size         INTEGER
+);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE INDEX IF NOT EXISTS entries_pdf_size  ON entries (pdf_size);
+'''
+
+class Query(object):
+  '''Which entries to list, and in what order. Ages are in seconds, sizes in
+  bytes; None means no limit. 'now' is the time ages are relative to.'''
+  def __init__(self,
+               now,
+               min_age    = None,
+               max_age    = None,
+               min_size   = None,
+               max_size   = None,
+               min_id     = None,
+               max_id     = None,
+               sort       = "age",
+               descending = False):
+    if sort not in Sort_Columns:
+      raise ValueError("Can't sort on '%s'; try one of: %s" %
+                       (sort, ", ".join(sorted(Sort_Columns))))
+    self.now        = now
+    self.min_age    = min_age
+    self.max_age    = max_age
+    self.min_size   = min_size
+    self.max_size   = max_size
+    self.min_id     = min_id
+    self.max_id     = max_id
+    self.sort       = sort
+    self.descending = descending
+
+  def where(self):
+    '''Returns the (WHERE clause, parameters) selecting matching entries.'''
+    clauses = []
+    params  = []
+    # Older entries have *smaller* timestamps:
+    for value, clause in ((self.min_age,  "timestamp <= ?"),
+                          (self.max_age,  "timestamp >= ?")):
+      if value is not None:
+        clauses.append(clause)
+        params.append(self.now - value)
+    for value, clause in ((self.min_size, "pdf_size >= ?"),
+                          (self.max_size, "pdf_size <= ?"),
+                          (self.min_id,   "route_id >= ?"),
+                          (self.max_id,   "route_id <= ?")):
+      if value is not None:
+        clauses.append(clause)
+        params.append(value)
+    if not clauses:
+      return "", params
+    return "WHERE " + " AND ".join(clauses), params
+
+  def orderBy(self):
+    '''Returns the ORDER BY clause. Ties are broken on route id, so pages
+    don't overlap.'''
+    direction = "DESC" if self.descending else "ASC"
+    # "Sort by age" is oldest-first, i.e. by ascending timestamp:
+    return "ORDER BY %s %s, route_id %s" % (Sort_Columns[self.sort], direction, direction)
+
+class CacheIndex(object):
+  '''The index, stored in the SQLite database at 'path'.'''
+  def __init__(self, path):
+    self.path = path
+
+  @contextlib.contextmanager
+  def _connect(self):
+    # A connection per use: they're cheap, and can't be shared across
+    # threads anyway.
+    db = sqlite3.connect(self.path, timeout = 30)
+    try:
+      db.executescript(_Schema)
+      with db:
+        yield db
+    finally:
+      db.close()
+
+  def put(self, route_id, etag, timestamp, renderer_version, pdf_size):
+    '''Adds or replaces the entry for 'route_id'.'''
+    with self._connect() as db:
+      db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                 (int(route_id), etag, timestamp, renderer_version, pdf_size))
+
+  def remove(self, route_ids):
+    '''Removes the entries for the given route ids, if there are any.'''
+    with self._connect() as db:
+      db.executemany("DELETE FROM entries WHERE route_id = ?",
+                     [(int(route_id),) for route_id in route_ids])
+
+  def rebuild(self, entries):
+    '''Replaces the whole index with 'entries', an iterable of (route_id,
+    etag, timestamp, renderer_version, pdf_size) tuples. Returns how many
+    there were.'''
+    with self._connect() as db:
+      db.execute("DELETE FROM entries")
+      db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                     ((int(route_id), etag, timestamp, version, size)
+                      for route_id, etag, timestamp, version, size in entries))
+      return db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+  def count(self, query = None):
+    '''Returns the number of entries matching 'query' (default: all of them).'''
+    where, params = query.where() if query else ("", [])
+    with self._connect() as db:
+      return db.execute("SELECT COUNT(*) FROM entries " + where, params).fetchone()[0]
+
+  def totalSize(self, query = None):
+    '''Returns the total PDF size, in bytes, of the entries matching 'query'.'''
+    where, params = query.where() if query else ("", [])
+    with self._connect() as db:
+      return db.execute("SELECT COALESCE(SUM(pdf_size), 0) FROM entries " + where,
+                        params).fetchone()[0]
+
+  def select(self, query, limit = None, offset = 0):
+    '''Returns the (route_id, etag, timestamp, renderer_version, pdf_size)
+    tuples matching 'query', in its order; at most 'limit' of them, skipping
+    the first 'offset'.'''
+    where, params = query.where()
+    sql = "SELECT * FROM entries %s %s" % (where, query.orderBy())
+    if limit is not None:
+      sql += " LIMIT ? OFFSET ?"
+      params += [limit, offset]
+    with self._connect() as db:
+      return db.execute(sql, params).fetchall()
@@ -0,0 +1,83 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import cache_index
+
+class CacheIndexTestCase(unittest.TestCase):
+  '''Tests for the cache_index library'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.index = cache_index.CacheIndex(os.path.join(self.directory, "index"))
+    # Route n was rendered n * 100 seconds ago, and is n kB:
+    self.index.rebuild((route_id, '"etag%d"' % route_id, 10000 - route_id * 100, "v1",
+                        route_id * 1024)
+                       for route_id in range(1, 11))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def routeIds(self, query, limit = None, offset = 0):
+    return [row[0] for row in self.index.select(query, limit, offset)]
+
+  def test_count(self):
+    self.assertEqual(10, self.index.count())
+    self.assertEqual(10 * 11 / 2 * 1024, self.index.totalSize())
+
+  def test_sort(self):
+    # Oldest first, by default:
+    self.assertEqual(range(10, 0, -1), self.routeIds(cache_index.Query(10000)))
+    self.assertEqual(range(1, 11), self.routeIds(cache_index.Query(10000, descending = True)))
+    self.assertEqual(range(1, 11), self.routeIds(cache_index.Query(10000, sort = "size")))
+    self.assertEqual(range(10, 0, -1),
+                     self.routeIds(cache_index.Query(10000, sort = "id", descending = True)))
+    self.assertRaises(ValueError, cache_index.Query, 10000, sort = "etag")
+
+  def test_filter(self):
+    query = cache_index.Query(10000, min_age = 300, max_age = 700)
+    self.assertEqual([7, 6, 5, 4, 3], self.routeIds(query))
+    self.assertEqual(5, self.index.count(query))
+    self.assertEqual((3 + 4 + 5 + 6 + 7) * 1024, self.index.totalSize(query))
+    query = cache_index.Query(10000, min_size = 2048, max_size = 4096, sort = "id")
+    self.assertEqual([2, 3, 4], self.routeIds(query))
+    query = cache_index.Query(10000, min_id = 9, sort = "id")
+    self.assertEqual([9, 10], self.routeIds(query))
+    query = cache_index.Query(10000, max_id = 2, min_age = 200, sort = "id")
+    self.assertEqual([2], self.routeIds(query))
+
+  def test_pages(self):
+    query = cache_index.Query(10000, sort = "id")
+    self.assertEqual([1, 2, 3], self.routeIds(query, 3))
+    self.assertEqual([4, 5, 6], self.routeIds(query, 3, 3))
+    self.assertEqual([10], self.routeIds(query, 3, 9))
+    self.assertEqual([], self.routeIds(query, 3, 12))
+
+  def test_putAndRemove(self):
+    self.index.put(5, '"new"', 10000, "v2", None)
+    self.assertEqual(10, self.index.count())
+    self.assertEqual((5, '"new"', 10000, "v2", None),
+                     self.index.select(cache_index.Query(10000, min_id = 5, max_id = 5))[0])
+    self.index.remove([5, 6, 12345])
+    self.assertEqual(8, self.index.count())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,217 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Parallel, incremental rendering of long routes.
+
+pdflatex is single-threaded, and each of its passes re-typesets the whole
+document, so the render time of a multi-day route with hundreds of cues
+grows with its length, however many cores are idle. Here, the cue entries
+are split into chunks of about a page each, every chunk is rendered as its
+own document (without page numbers) by its own pdflatex process, and then
+the pieces are stitched together with pdfpages, which also stamps on the
+"Page X of Y" footers. Stitching is cheap: it only places finished pages.
+
+Rendered chunks can also be kept in a ChunkStore, keyed on their content.
+Chunk boundaries are picked by the content of the entries too (like rsync
+does with blocks), so when an organizer edits, adds or removes a cue, only
+the chunk around it changes, and re-rendering the route only re-renders that
+chunk; the rest of the pages come from the store, and the page numbers are
+re-stamped over all of them.
+
+Each chunk starts on a fresh page, so a chunk that doesn't fill its last
+page leaves a little blank space behind it.
+'''
+
+import hashlib
+import os
+import tempfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import latex
+import tex
+import tracing
+
+def _entryContent(entry):
+  '''Everything about 'entry' that makes it onto the sheet, as a string.'''
+  return repr(latex._entryKey(entry))
+
+def splitEntries(entries, chunk_entries, content = _entryContent):
+  '''
+  Splits 'entries' into consecutive chunks of, on average, about
+  'chunk_entries' entries each (and at most twice that).
+
+  A chunk ends after an entry whose content ('content(entry)') hashes to a
+  multiple of a certain number, so the boundaries move with the entries:
+  adding or removing an entry only changes the chunk it's in, rather than
+  shifting every chunk after it. A short last chunk is merged into the one
+  before it, rather than being given a mostly-empty page of its own.
+  '''
+  if chunk_entries < 1:
+    raise ValueError("chunk_entries must be at least 1")
+  min_entries = max(1, chunk_entries / 2)
+  modulus     = chunk_entries - min_entries + 1
+  chunks  = []
+  current = []
+  for entry in entries:
+    current.append(entry)
+    if (len(current) >= 2 * chunk_entries or
+        (len(current) >= min_entries and
+         (zlib.crc32(content(entry)) & 0xffffffff) % modulus == 0)):
+      chunks.append(current)
+      current = []
+  if current:
+    if chunks and len(current) < min_entries / 2:
+      chunks[-1] = chunks[-1] + current
+    else:
+      chunks.append(current)
+  return chunks
+
+def chunkKey(route, chunk):
+  '''Returns a key identifying the rendered PDF of 'chunk' (a list of entries
+  of 'route'): it changes whenever anything on its pages would.'''
+  digest = hashlib.sha1(latex.Renderer_Version)
+  # The page heads show the route's name, number and stats:
+  digest.update(latex._makeRouteHeads(route).encode("utf-8"))
+  for entry in chunk:
+    digest.update(_entryContent(entry))
+  return digest.hexdigest()
+
+class ChunkStore(object):
+  '''A directory of rendered chunk PDFs, keyed by chunkKey(). Holds at most
+  'max_chunks' of them, dropping the least recently used ones.'''
+  def __init__(self, directory, max_chunks = 5000):
+    self.directory  = directory
+    self.max_chunks = max_chunks
+
+  def _path(self, key):
+    return os.path.join(self.directory, "%s.pdf" % key)
+
+  def get(self, key):
+    '''Returns the PDF stored under 'key', or None.'''
+    try:
+      with open(self._path(key), 'rb') as chunk_file:
+        data = chunk_file.read()
+    except IOError:
+      return None
+    # Mark it as recently used:
+    try:
+      os.utime(self._path(key), None)
+    except OSError:
+      pass
+    return data
+
+  def put(self, key, data):
+    '''Stores 'data' under 'key'.'''
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    # Write to a temp file and rename, so readers never see half a chunk:
+    fd, tmp_path = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+    try:
+      with os.fdopen(fd, 'wb') as tmp_file:
+        tmp_file.write(data)
+      os.rename(tmp_path, self._path(key))
+    except:
+      os.unlink(tmp_path)
+      raise
+
+  def prune(self):
+    '''Drops the least recently used chunks, beyond the newest max_chunks.
+    Returns the number dropped.'''
+    if not os.path.isdir(self.directory):
+      return 0
+    chunks = []
+    for name in os.listdir(self.directory):
+      if name.endswith(".pdf"):
+        path = os.path.join(self.directory, name)
+        try:
+          chunks.append((os.stat(path).st_mtime, path))
+        except OSError:
+          pass
+    chunks.sort(reverse = True)
+    for mtime, path in chunks[self.max_chunks:]:
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+    return max(0, len(chunks) - self.max_chunks)
+
+def renderChunked(route, chunk_entries, workers, stats = None, store = None,
+                  deadline = None):
+  '''
+  Renders 'route' to PDF, about 'chunk_entries' cue entries at a time, with up
+  to 'workers' pdflatex processes running at once. If 'store' (a ChunkStore)
+  is given, chunks already in it aren't rendered again, and newly rendered
+  ones are added to it. 'deadline' is passed on to tex.convert().
+
+  If 'stats' is a dict, stats['chunks'] is set to the number of chunks,
+  stats['chunks_rendered'] to the number that had to be rendered,
+  stats['runs'] to the most pdflatex passes any one chunk needed (chunks
+  have no cross-references, so just the one), and
+  stats['settled'] to False if any pass was skipped to meet the deadline.
+
+  Returns the PDF, as a byte string. Throws a ValueError (from tex.convert())
+  if any chunk fails to render.
+  '''
+  chunks = splitEntries(route.entries, chunk_entries)
+  keys   = [chunkKey(route, chunk) for chunk in chunks]
+  pieces = [store.get(key) if store else None for key in keys]
+  todo   = [i for i, piece in enumerate(pieces) if piece is None]
+  settled = [True] * len(chunks)
+  if stats is not None:
+    stats['chunks'] = len(chunks)
+    stats['chunks_rendered'] = len(todo)
+  def renderChunk(i):
+    with tracing.activate(trace, parent_id):
+      chunk_stats = {}
+      try:
+        # Only the assembly needs LastPage, so chunks have no labels for a
+        # second pass to settle:
+        return tex.latex2pdf(latex.generateLatex(route, chunks[i], page_numbers = False),
+                             stats = chunk_stats, single_pass = True,
+                             deadline = deadline)
+      finally:
+        settled[i] = chunk_stats.get('settled', True)
+        if stats is not None and 'runs' in chunk_stats:
+          stats['runs'] = max(stats.get('runs', 0), chunk_stats['runs'])
+
+  with tracing.span("chunked.render", chunks = len(chunks), rendered = len(todo),
+                    workers = workers):
+    # The chunks are rendered from worker threads (pdflatex does the real
+    # work, in its own process), so hand them our trace:
+    trace, parent_id = tracing.current(), tracing.currentSpanId()
+    if todo:
+      pool = ThreadPool(max(1, min(workers, len(todo))))
+      try:
+        rendered = pool.map(renderChunk, todo)
+      finally:
+        pool.close()
+      for i, piece in zip(todo, rendered):
+        pieces[i] = piece
+        # (Chunks cut short are good enough for now, but not to keep.)
+        if store and settled[i]:
+          store.put(keys[i], piece)
+    filenames = ["chunk-%04d.pdf" % i for i in xrange(len(pieces))]
+    assembly_stats = {}
+    with tracing.span("chunked.assemble"):
+      pdf_data = tex.latex2pdf(latex.makeAssemblyLatex(filenames),
+                               files = dict(zip(filenames, pieces)),
+                               stats = assembly_stats, deadline = deadline)
+    if stats is not None:
+      stats['settled'] = all(settled) and assembly_stats.get('settled', True)
+    return pdf_data
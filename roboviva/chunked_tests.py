@@ -0,0 +1,176 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import json
+import logging
+import threading
+import unittest
+import chunked
+import cue
+import latex
+import tracing
+
+def MakeRoute(n_entries):
+  entries = [cue.Entry(cue.Instruction.RIGHT, "Street %d" % i, i * 0.5, for_distance = 0.5)
+             for i in range(n_entries)]
+  return cue.Route(entries, n_entries * 0.5, 123, "Long Route", 10000)
+
+class _ListHandler(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(json.loads(record.getMessage()))
+
+class ChunkedTestCase(unittest.TestCase):
+  '''Tests for rendering long routes in pieces'''
+
+  def test_splitEntries(self):
+    self.assertEqual([], chunked.splitEntries([], 10, content = str))
+    self.assertEqual([[1, 2, 3]], chunked.splitEntries([1, 2, 3], 10, content = str))
+    entries = range(1000)
+    chunks = chunked.splitEntries(entries, 20, content = str)
+    self.assertEqual(entries, sum(chunks, []))
+    self.assertTrue(all(len(chunk) <= 40 for chunk in chunks))
+    self.assertTrue(all(len(chunk) >= 5 for chunk in chunks))
+    self.assertTrue(25 <= len(chunks) <= 100)
+    self.assertRaises(ValueError, chunked.splitEntries, entries, 0)
+
+  def test_splitEntriesIsLocal(self):
+    # Adding an entry in the middle of a route only changes the chunk it's
+    # added to:
+    before = chunked.splitEntries(range(1000), 20, content = str)
+    after  = chunked.splitEntries(range(500) + [-1] + range(500, 1000), 20, content = str)
+    self.assertEqual(len(before), len(after))
+    changed = [i for i, (a, b) in enumerate(zip(before, after)) if a != b]
+    self.assertEqual(1, len(changed))
+    self.assertTrue(-1 in after[changed[0]])
+
+  def test_chunkKey(self):
+    route = MakeRoute(10)
+    key = chunked.chunkKey(route, route.entries[:5])
+    self.assertEqual(key, chunked.chunkKey(MakeRoute(10), MakeRoute(10).entries[:5]))
+    self.assertNotEqual(key, chunked.chunkKey(route, route.entries[:6]))
+    renamed = MakeRoute(10)
+    renamed.name = "Longer Route"
+    self.assertNotEqual(key, chunked.chunkKey(renamed, renamed.entries[:5]))
+
+  def test_chunkStore(self):
+    directory = tempfile.mkdtemp()
+    try:
+      store = chunked.ChunkStore(os.path.join(directory, "chunks"), max_chunks = 2)
+      self.assertEqual(None, store.get("a"))
+      self.assertEqual(0, store.prune())
+      for key in ("a", "b", "c"):
+        store.put(key, "%PDF-" + key)
+      os.utime(os.path.join(directory, "chunks", "a.pdf"), (0, 0))
+      self.assertEqual(1, store.prune())
+      self.assertEqual(None, store.get("a"))
+      self.assertEqual("%PDF-c", store.get("c"))
+    finally:
+      shutil.rmtree(directory)
+
+  def test_chunkLatex(self):
+    route = MakeRoute(10)
+    chunk = latex.makeLatex(route)
+    self.assertTrue("LastPage" in chunk)
+    piece = u"".join(latex.generateLatex(route, route.entries[:5], page_numbers = False))
+    self.assertFalse("LastPage" in piece)
+    self.assertFalse("\\label" in piece or "\\pageref" in piece)
+    self.assertTrue("Street 4" in piece)
+    self.assertFalse("Street 5" in piece)
+
+    assembly = latex.makeAssemblyLatex(["chunk-0000.pdf", "chunk-0001.pdf"])
+    self.assertTrue("LastPage" in assembly)
+    self.assertTrue(assembly.index("chunk-0000.pdf") < assembly.index("chunk-0001.pdf"))
+
+  def test_renderChunked(self):
+    stats = {}
+    pdf = chunked.renderChunked(MakeRoute(300), 100, 3, stats = stats)
+    self.assertEqual('%PDF-', pdf[:5])
+    self.assertEqual(stats['chunks'], stats['chunks_rendered'])
+    self.assertEqual(1, stats['runs'])
+
+  def test_chunkSpans(self):
+    # Chunks rendered at the same time are each children of chunked.render,
+    # and are rendered in a single pass; only the assembly waits for LastPage:
+    in_flight = [0]
+    lock      = threading.Lock()
+    both      = threading.Event()
+    calls     = []
+    def latex2pdf(source, **kwargs):
+      calls.append(kwargs.get('single_pass', False))
+      if 'files' in kwargs:
+        return "%PDF-assembled"
+      with tracing.span("tex.convert"):
+        with lock:
+          in_flight[0] += 1
+          if in_flight[0] == 2:
+            both.set()
+        both.wait(5)
+        with tracing.span("tex.run"):
+          return "%PDF-chunk"
+    handler = _ListHandler()
+    logger  = logging.getLogger("roboviva.trace")
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    original_latex2pdf = chunked.tex.latex2pdf
+    chunked.tex.latex2pdf = latex2pdf
+    try:
+      tracing.start()
+      self.assertEqual("%PDF-assembled", chunked.renderChunked(MakeRoute(300), 100, 3))
+    finally:
+      tracing.finish()
+      chunked.tex.latex2pdf = original_latex2pdf
+      logger.removeHandler(handler)
+    self.assertTrue(both.is_set())
+    self.assertEqual([True] * (len(calls) - 1) + [False], calls)
+
+    spans = handler.records
+    render = [span for span in spans if span['name'] == "chunked.render"][0]
+    converts = [span for span in spans if span['name'] == "tex.convert"]
+    self.assertTrue(len(converts) >= 2)
+    for convert in converts:
+      self.assertEqual(render['span_id'], convert['parent_id'])
+    convert_ids = set(convert['span_id'] for convert in converts)
+    runs = [span for span in spans if span['name'] == "tex.run"]
+    self.assertEqual(convert_ids, set(run['parent_id'] for run in runs))
+
+  def test_renderIncremental(self):
+    directory = tempfile.mkdtemp()
+    try:
+      store = chunked.ChunkStore(directory)
+      route = MakeRoute(300)
+      stats = {}
+      chunked.renderChunked(route, 60, 2, stats = stats, store = store)
+      self.assertEqual(stats['chunks'], stats['chunks_rendered'])
+      route.entries[150].description = "Edited St"
+      stats = {}
+      pdf = chunked.renderChunked(route, 60, 2, stats = stats, store = store)
+      self.assertEqual('%PDF-', pdf[:5])
+      # Just the edited chunk (or two, if the edit moved a chunk boundary):
+      self.assertTrue(1 <= stats['chunks_rendered'] <= 2)
+      self.assertTrue(stats['chunks_rendered'] < stats['chunks'])
+    finally:
+      shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  unittest.main()
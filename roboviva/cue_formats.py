@@ -0,0 +1,95 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Lightweight, non-PDF versions of a cue sheet, made straight from a parsed
+cue.Route: JSON (for bike computers and apps), plain text (for screen readers
+and the like) and an HTML fragment. These take microseconds, where a PDF
+takes a pdflatex run.
+
+Descriptions and notes are as cleaned up by ridewithgps.py. JSON keeps their
+markdown-style *emphasis* as-is; HTML turns it into <em> / <strong>, and text
+drops the markers.
+'''
+
+import cgi
+import json
+
+import cue_utils
+
+# Bump when the output of any format changes, so clients' cached copies are
+# revalidated (it's part of the ETag views.py hands out):
+Format_Version = 2
+
+def htmlFormat(text):
+  '''Escapes 'text' for HTML, with its emphasis as <strong> and <em>.'''
+  return cue_utils.FormatEmphasis(cgi.escape(text or u""),
+                                  u"<strong>%s</strong>", u"<em>%s</em>")
+
+def textFormat(text):
+  '''Returns 'text' without its emphasis markers.'''
+  return cue_utils.FormatEmphasis(text or u"", u"%s", u"%s")
+
+def routeStats(route):
+  '''Returns the route's length (and climb, if known), e.g. "45.2 mi / 2300 ft".'''
+  if route.elevation_gain_ft:
+    return u"%.1f mi / %d ft" % (route.length_mi, route.elevation_gain_ft)
+  return u"%.1f mi" % route.length_mi
+
+def toDict(route):
+  '''Returns 'route' as a dict of plain (JSON-able) values.'''
+  return {
+    "format_version"    : Format_Version,
+    "route_id"          : route.id,
+    "name"              : route.name,
+    "length_mi"         : route.length_mi,
+    "elevation_gain_ft" : route.elevation_gain_ft,
+    "entries"           : [{ "instruction"       : entry.instruction,
+                             "modifier"          : entry.modifier,
+                             "description"       : entry.description,
+                             "note"              : entry.note,
+                             "absolute_distance" : entry.absolute_distance,
+                             "for_distance"      : entry.for_distance,
+                             "color"             : entry.color }
+                           for entry in route.entries] }
+
+def toJson(route):
+  '''Returns 'route' as JSON; see toDict().'''
+  return json.dumps(toDict(route), sort_keys = True, separators = (',', ':'))
+
+def toText(route):
+  '''Returns 'route' as a plain text table, one cue per line, with the same
+  Go / At / On / For columns as the PDF.'''
+  if route.name:
+    lines = [u"%s (%s)" % (route.name, routeStats(route)),
+             u"Route #%d" % route.id]
+  else:
+    lines = [u"Route #%d (%s)" % (route.id, routeStats(route))]
+  lines += [u"", u"%-4s %6s  %-50s %5s" % (u"Go", u"At", u"On", u"For")]
+  for entry in route.entries:
+    description = textFormat(entry.description)
+    if entry.note:
+      if description.strip() == u"":
+        description = textFormat(entry.note)
+      else:
+        description += u" (%s)" % textFormat(entry.note)
+    for_str = u"%5.1f" % entry.for_distance if entry.for_distance else u""
+    lines.append((u"%-4s %6.1f  %-50s %5s" % (entry.modifier + entry.instruction,
+                                             entry.absolute_distance,
+                                             description,
+                                             for_str)).rstrip())
+  return u"\n".join(lines) + u"\n"
@@ -0,0 +1,80 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import json
+import unittest
+import cue
+import cue_formats
+
+def MakeRoute(route_name = "Test Route"):
+  entries = [ cue.Entry(cue.Instruction.NONE,  "Start of route", 0.0, for_distance = 1.0),
+              cue.Entry(cue.Instruction.RIGHT, u"**Caf\xe9** St", 1.0, note = "Coffee!",
+                        modifier = cue.Modifier.QUICK, for_distance = 0.5,
+                        color = cue.Color.GRAY),
+              cue.Entry(cue.Instruction.DANGER, "", 1.5, note = "Potholes <big ones>",
+                        color = cue.Color.YELLOW),
+              cue.Entry(cue.Instruction.NONE,  "End of route", 5.0)]
+  return cue.Route(entries, 5.0, 12345, route_name, 1000.5)
+
+class CueFormatsTestCase(unittest.TestCase):
+  '''Tests for the cue_formats library'''
+
+  def test_htmlFormat(self):
+    self.assertEqual(u"Turn <strong>left</strong> on <em>Main</em> &lt;St&gt; a * b",
+                     cue_formats.htmlFormat(u"Turn **left** on *Main* <St> a * b"))
+    self.assertEqual(u"", cue_formats.htmlFormat(None))
+
+  def test_textFormat(self):
+    self.assertEqual(u"Turn left on Main St", cue_formats.textFormat(u"Turn **left *on* Main** St"))
+
+  def test_routeStats(self):
+    route = MakeRoute()
+    self.assertEqual(u"5.0 mi / 1000 ft", cue_formats.routeStats(route))
+    route.elevation_gain_ft = None
+    self.assertEqual(u"5.0 mi", cue_formats.routeStats(route))
+
+  def test_toJson(self):
+    data = json.loads(cue_formats.toJson(MakeRoute()))
+    self.assertEqual(12345, data["route_id"])
+    self.assertEqual("Test Route", data["name"])
+    self.assertEqual(4, len(data["entries"]))
+    self.assertEqual({ "instruction"       : "R",
+                       "modifier"          : "Q",
+                       "description"       : u"**Caf\xe9** St",
+                       "note"              : "Coffee!",
+                       "absolute_distance" : 1.0,
+                       "for_distance"      : 0.5,
+                       "color"             : "Gray" },
+                     data["entries"][1])
+    self.assertEqual(None, data["entries"][3]["for_distance"])
+
+  def test_toText(self):
+    lines = cue_formats.toText(MakeRoute()).splitlines()
+    self.assertEqual(u"Test Route (5.0 mi / 1000 ft)", lines[0])
+    self.assertEqual(u"Route #12345", lines[1])
+    self.assertTrue(lines[5].startswith(u"QR      1.0  Caf\xe9 St (Coffee!)"))
+    self.assertTrue(lines[5].endswith(u"0.5"))
+    # A note with no description stands in for it:
+    self.assertTrue(lines[6].startswith(u"!       1.5  Potholes <big ones>"))
+    self.assertEqual(8, len(lines))
+
+    lines = cue_formats.toText(MakeRoute(route_name = None)).splitlines()
+    self.assertEqual(u"Route #12345 (5.0 mi / 1000 ft)", lines[0])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import cue
+import re
 
 def AdjustStartAndEnd(route):
   '''
@@ -47,3 +48,30 @@ def AdjustStartAndEnd(route):
       next_entry = route.entries[index + 1]
       prev_entry.for_distance = next_entry.absolute_distance - prev_entry.absolute_distance
       del route.entries[index]
+
+def FormatEmphasis(text, strong, emph):
+  '''
+  Replaces markdown-style **strong emphasis** and *emphasis* in 'text' with
+  'strong' and 'emph': format strings, each taking the emphasized text, e.g.
+  u"<b>%s</b>". Whitespace-delimited *'s and **'s are left as they are, as are
+  backslash-escaped ones (minus the backslash).
+  '''
+  # Step 0: Escape any whitespace-delimited *'s and **'s:
+  text = re.sub(ur'\s\*\s', ur' \* ', text)
+  text = re.sub(ur'\s\*\*\s', ur' \*\* ', text)
+
+  # Do this in two passes. Each pass will replace **...** with 'strong', and
+  # *...* with 'emph', where "..." DOES NOT CONTAIN ANY NESTED **...** or *...*
+  # PATTERNS. We should do this to fixed point, but if people are seriously
+  # doing this:
+  # **Foo *bar **baz *foobar******
+  # Screw 'em :)
+  Num_Passes = 2
+  for p in xrange(Num_Passes):
+    text = re.sub(ur'(\*\*)(?!\s)((\\.|[^\\\*])*?[^\s\\])\1',
+                  lambda match: strong % match.group(2), text)
+    text = re.sub(ur'\*(?!\s)((\\.|[^\\\*])*?[^\s\\*])\*',
+                  lambda match: emph % match.group(1), text)
+
+  # Finally, un-escape any escaped *'s:
+  return re.sub(ur'\\(\*|_)', ur'\1', text)
@@ -70,5 +70,13 @@ class CueUtilsTestCase(unittest.TestCase):
     self.assertEqual(None, route.entries[-1].for_distance)
     self.assertEqual(cue.Instruction.NONE, route.entries[-1].instruction)
 
+  def test_FormatEmphasis(self):
+    self.assertEqual(u"[Main] {St} a * b ** c *d*",
+                     cue_utils.FormatEmphasis(u"**Main** *St* a * b ** c \\*d\\*", u"[%s]", u"{%s}"))
+    self.assertEqual(u"[Foo {bar}]",
+                     cue_utils.FormatEmphasis(u"**Foo *bar***", u"[%s]", u"{%s}"))
+    # The templates are format strings, the text isn't:
+    self.assertEqual(u"[100%]", cue_utils.FormatEmphasis(u"**100%**", u"[%s]", u"{%s}"))
+
 if __name__ == '__main__':
   unittest.main()
@@ -15,7 +15,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import cue
+import cue_utils
+import hashlib
+import latex_check
+import logging
+import lru
+import metrics
+import os
 import re
+import tracing
+
+_log = logging.getLogger("roboviva.latex")
+
+_rows_repaired = metrics.counter(
+    "roboviva_latex_rows_repaired_total",
+    "Cue rows whose LaTeX failed latex_check, and were rendered as plain text instead.")
+
+# The same cue rows ("R | Main St | TRO", pit stops, etc.) show up over and
+# over again, across routes and across re-renders of the same route, so we
+# keep the rendered supertabular rows around:
+Row_Cache_Size = 8192
+_row_cache = lru.LRUCache(Row_Cache_Size)
 
 def _makeClimb(climb_type):
   '''Very simple utility method -- provides a common way to specify climb types'''
@@ -64,29 +84,7 @@ def _escape(text):
 def _format(text):
   '''Looks for markdown-style *emphasis* and **strong emphasis** in the text,
   turning it into \emph and \textbf, accordingly.'''
-
-  # Step 0: Escape any whitespace-delimited *'s and **'s:
-  text = re.sub(ur'\s\*\s', ur' \* ', text)
-  text = re.sub(ur'\s\*\*\s', ur' \*\* ', text)
-
-  # Do this in two passes. Each pass will replace **...** with \textbf{...},
-  # and *...* with \emph{...}, where "..." DOES NOT CONTAIN ANY NESTED **...**
-  # or *...* PATTERNS. We should do this to fixed point, but if people are
-  # seriously doing this:
-  # **Foo *bar **baz *foobar******
-  # Screw 'em :)
-
-  Num_Passes = 2
-  for p in xrange(Num_Passes):
-    text = re.sub(ur'(\*\*)(?!\s)((\\.|[^\\\*])*?[^\s\\])\1',
-                  ur'\\textbf{\2}',
-                  text)
-    text = re.sub(ur'\*(?!\s)((\\.|[^\\\*])*?[^\s\\*])\*',
-                  ur'\emph{\1}',
-                  text)
-  # Finally, un-escape any escaped *'s:
-  text = re.sub(ur'\\(\*|_)', ur'\1', text)
-  return text
+  return cue_utils.FormatEmphasis(text, ur'\textbf{%s}', ur'\emph{%s}')
 
 def _entryColor(entry):
   '''Figures out what color, if any, this entry should have. Returns a color
@@ -100,7 +98,77 @@ def _entryColor(entry):
     color = ur'[gray]{0.8}'
   return color
 
+def _entryKey(entry):
+  '''Returns a hashable key capturing everything that affects how 'entry' is
+  rendered. Distances are keyed on their formatted values, since that's all
+  that makes it into the row.'''
+  for_str = ""
+  if entry.for_distance:
+    for_str = "%5.1f" % entry.for_distance
+  return (entry.instruction,
+          entry.modifier,
+          entry.description,
+          entry.note,
+          "%5.1f" % entry.absolute_distance,
+          for_str,
+          entry.color)
+
+def routeFingerprint(route):
+  '''Returns a hash of everything in 'route' that makes it onto the rendered
+  sheet, at the precision it's printed with. Two routes with the same
+  fingerprint render to the same PDF (given the same Renderer_Version).'''
+  stats = "%.1f" % route.length_mi
+  if route.elevation_gain_ft:
+    stats += " / %d" % route.elevation_gain_ft
+  digest = hashlib.sha1()
+  digest.update(repr((route.id, route.name, stats)))
+  for entry in route.entries:
+    digest.update(repr(_entryKey(entry)))
+  return digest.hexdigest()
+
 def _entryToLatex(entry):
+  '''Converts a cue.Entry into a latex supertabular row string, reusing a
+  previously rendered row if an identical one has been seen before.'''
+  key = _entryKey(entry)
+  row = _row_cache.get(key)
+  if row is None:
+    row = _checkedEntry(entry)
+    _row_cache.put(key, row)
+  return row
+
+def _checkedEntry(entry):
+  '''Renders 'entry' with _renderEntry(), and checks the row will get through
+  pdflatex (see latex_check). If it won't, 'entry' is rendered again with its
+  description and note as plain text. Throws a latex_check.LatexCheckError if
+  even that won't do.'''
+  row = _renderEntry(entry)
+  problems = latex_check.checkRow(row)
+  if not problems:
+    return row
+  _rows_repaired.inc()
+  _log.warning("Cue at %.1f mi (%r / %r) makes bad LaTeX, rendering it as plain text: %s",
+               entry.absolute_distance, entry.description, entry.note,
+               "; ".join(problems))
+  plain = cue.Entry(entry.instruction,
+                    latex_check.plainText(entry.description),
+                    entry.absolute_distance,
+                    note         = latex_check.plainText(entry.note),
+                    modifier     = entry.modifier,
+                    for_distance = entry.for_distance,
+                    color        = entry.color)
+  row = _renderEntry(plain)
+  problems = latex_check.checkRow(row)
+  if problems:
+    raise latex_check.LatexCheckError("Can't render cue at %.1f mi (%r): %s" %
+                                      (entry.absolute_distance, entry.description,
+                                       "; ".join(problems)))
+  return row
+
+def rowCacheStats():
+  '''Returns a dict of size / hit-rate statistics for the rendered row cache.'''
+  return _row_cache.stats()
+
+def _renderEntry(entry):
   '''Converts a cue.Entry into a latex supertabular row string'''
 
   color_str = ""
@@ -135,6 +203,27 @@ def _entryToLatex(entry):
                                                    note_str,
                                                    for_str)
 
+def generateLatex(route, entries = None, page_numbers = True):
+  ''' Generates a full latex document from a cue.Route object, one chunk at a
+      time: first the header, then one chunk per cue entry, then the footer.
+      Nothing here holds onto the full document, so callers can stream the
+      chunks straight to a file (see writeLatex()) or to tex.convert().
+
+      route        - a Cue.Route object, fully initialized.
+      entries      - the cue entries to include (default: all of route.entries).
+                     Used to render a long route in pieces.
+      page_numbers - whether to put "Page X of Y" in the footer. Pieces of a
+                     long route leave this to makeAssemblyLatex().
+
+      Yields the Latex output generated from 'route', as unicode strings.
+  '''
+  if entries is None:
+    entries = route.entries
+  yield _makeHeader(route, page_numbers)
+  for ent in entries:
+    yield _entryToLatex(ent) + u"\n"
+  yield LatexFooter
+
 def makeLatex(route):
   ''' Makes a full latex document from a cue.Route object
 
@@ -142,28 +231,38 @@ def makeLatex(route):
 
       Returns the Latex output generated from 'route', as a string.
   '''
-  ents = route.entries
-  route_id = _escape("%s" % route.id)
-  route_name = _escape("%s" % route.name)
-  ret = _makeHeader(route)
-  for ent in ents:
-    ret = ret + _entryToLatex(ent) + "\n"
-  ret = ret + LatexFooter
-  return ret
+  with tracing.span("latex.makeLatex", entries = len(route.entries)):
+    return u"".join(generateLatex(route))
 
-def _makeHeader(route):
+def writeLatex(route, out_file, encoding = "UTF-8"):
+  ''' Streams the latex document for 'route' into 'out_file', one chunk at a
+      time.
+
+      route    - a Cue.Route object, fully initialized.
+      out_file - a file-like object, opened for (binary) writing.
+      encoding - the encoding to write the document in.
+  '''
+  for chunk in generateLatex(route):
+    out_file.write(chunk.encode(encoding))
+
+def _makeHeader(route, page_numbers = True):
   '''
   Generates the beginning of a Latex document, meaning everything from \documentclass to the beginning of the supertable.
 
   route: a cue.Route object to use when filling in the header
+  page_numbers: whether to include the "Page X of Y" footer
   '''
+  header = _Preamble + _makeRouteHeads(route)
+  if page_numbers:
+    header += _pageNumberFooter()
+  header += _PageSetup
+  header += unicode(r'''
 
-  route_id = route.id
-  route_name = route.name
-  elevation_gain_ft = route.elevation_gain_ft
-  total_distance_mi = route.length_mi
+\begin{document}''')
+  header += _TableStart
+  return header
 
-  header = unicode(r'''
+_Preamble = unicode(r'''
 \documentclass[11pt]{article}
 \usepackage[left=0.20in,right=0.20in,top=0.7in,bottom=0.25in]{geometry}
 \geometry{letterpaper}
@@ -180,6 +279,15 @@ def _makeHeader(route):
 \pagestyle{fancy}
 \fancyhf{}''')
 
+def _makeRouteHeads(route):
+  '''Generates the \lhead / \rhead commands showing the route's name, number
+  and stats at the top of each page.'''
+  route_id = route.id
+  route_name = route.name
+  elevation_gain_ft = route.elevation_gain_ft
+  total_distance_mi = route.length_mi
+  heads = u""
+
   # Fill in left, right headers.
   lhead = None
   rhead = r"\emph{Route \#%d}" % route_id
@@ -198,21 +306,22 @@ def _makeHeader(route):
     rhead += r" \emph{(%s)}" % route_stats_esc
 
   if lhead:
-    header += unicode(r'''
+    heads += unicode(r'''
 \lhead{\small %s}''' % lhead)
 
   if rhead:
-    header += unicode(r'''
+    heads += unicode(r'''
 \rhead{\small %s}''' % rhead)
 
-  header += unicode(r'''
-\fancyfoot[C]{\footnotesize{\emph{Page~\thepage~of~\pageref{LastPage}}}}
+  return heads
+
+_PageSetup = unicode(r'''
 \setlength{\footskip}{0.0in}
 \setlength{\headsep}{0.2in}
 
-\renewcommand{\familydefault}{\sfdefault}
+\renewcommand{\familydefault}{\sfdefault}''')
 
-\begin{document}
+_TableStart = unicode(r'''
 \renewcommand{\arraystretch}{1.15}
 \twocolumn
 \tablehead{
@@ -231,11 +340,152 @@ def _makeHeader(route):
   \hline
 ''')
 
-  return header
-
 LatexFooter = unicode(r'''
 \end{supertabular}
 \end{center}
 \end{document}
 ''')
 
+def _pageNumberFooter(last_page_label = "LastPage"):
+  '''Generates the "Page X of Y" footer, where Y is the page number of the
+  label 'last_page_label'.'''
+  return unicode(r'''
+\fancyfoot[C]{\footnotesize{\emph{Page~\thepage~of~\pageref{%s}}}}''' % last_page_label)
+
+_PreviewFooter = unicode(r'''
+\fancyfoot[C]{\footnotesize{\emph{Preview: first page only. The full cue sheet is on its way, reload in a moment.}}}''')
+
+def makePreviewLatex(route, n_entries):
+  ''' Makes a latex document holding just the first 'n_entries' entries of
+      'route' (about a page's worth), marked as a preview. It has no page
+      numbers, or other cross-references, so it can be rendered in a single
+      pdflatex pass.
+
+      Returns the Latex document, as a string.
+  '''
+  doc = [_Preamble, _makeRouteHeads(route), _PreviewFooter, _PageSetup,
+         unicode(r'''
+
+\begin{document}'''), _TableStart]
+  for ent in route.entries[:n_entries]:
+    doc.append(_entryToLatex(ent) + u"\n")
+  doc.append(LatexFooter)
+  return u"".join(doc)
+
+def _packLabel(index):
+  '''The label marking the last page of the index'th route of a pack.'''
+  return "RouteEnd:%d" % index
+
+def generatePackLatex(routes):
+  ''' Generates a single latex document holding the cue sheets for all of
+      'routes', one after the other, so they can be rendered in one go. Each
+      route starts on a new page, with its own headers, and its own "Page X
+      of Y" count. See packPageCounts() for splitting the result back up.
+
+      routes - a list of cue.Route objects, fully initialized.
+
+      Yields the Latex output, as unicode strings.
+  '''
+  yield _Preamble + _PageSetup + unicode(r'''
+
+\begin{document}''')
+  for index, route in enumerate(routes):
+    # The previous route's last page has been shipped out by now, so the
+    # headers and page numbers can be switched over:
+    yield (unicode(r'''
+\clearpage
+\fancyhf{}''') + _makeRouteHeads(route) +
+           _pageNumberFooter(_packLabel(index)) + unicode(r'''
+\setcounter{page}{1}''') + _TableStart)
+    for ent in route.entries:
+      yield _entryToLatex(ent) + u"\n"
+    yield unicode(r'''
+\end{supertabular}
+\end{center}
+\label{%s}
+''' % _packLabel(index))
+  yield unicode(r'''
+\end{document}
+''')
+
+def packPageCounts(aux, n_routes):
+  ''' Returns the number of pages each route of a pack took up, given the
+      contents of the .aux file from rendering generatePackLatex().
+  '''
+  counts = []
+  for index in xrange(n_routes):
+    match = re.search(r"\\newlabel\{%s\}\{\{[^{}]*\}\{(\d+)\}" % re.escape(_packLabel(index)),
+                      aux)
+    if not match:
+      raise ValueError("No page count for route %d of the pack" % index)
+    counts.append(int(match.group(1)))
+  return counts
+
+def makeExtractLatex(pdf_filename, first_page, last_page):
+  ''' Makes a latex document holding just pages 'first_page' through
+      'last_page' (counting from 1) of 'pdf_filename'.'''
+  return unicode(r'''
+\documentclass{article}
+\usepackage{pdfpages}
+\begin{document}
+\includepdf[pages=%d-%d]{%s}
+\end{document}
+''' % (first_page, last_page, pdf_filename))
+
+def makeAssemblyLatex(pdf_filenames):
+  ''' Makes a latex document that concatenates the given PDFs (each a piece
+      of the same route, rendered with page_numbers = False), and stamps
+      "Page X of Y" on each page, just where _makeHeader() would have.
+
+      pdf_filenames - the PDFs to concatenate, in order.
+
+      Returns the Latex document, as a string.
+  '''
+  doc = unicode(r'''
+\documentclass[11pt]{article}
+\usepackage[left=0.20in,right=0.20in,top=0.7in,bottom=0.25in]{geometry}
+\geometry{letterpaper}
+\usepackage{pdfpages}
+\usepackage{helvet}
+\usepackage{fancyhdr}
+\usepackage{lastpage}
+
+\pagestyle{fancy}
+\fancyhf{}
+\renewcommand{\headrulewidth}{0pt}''')
+  doc += _pageNumberFooter()
+  doc += unicode(r'''
+\setlength{\footskip}{0.0in}
+\setlength{\headsep}{0.2in}
+
+\renewcommand{\familydefault}{\sfdefault}
+
+\begin{document}
+''')
+  for filename in pdf_filenames:
+    doc += u"\\includepdf[pages=-,pagecommand={\\thispagestyle{fancy}}]{%s}\n" % filename
+  doc += u"\\end{document}\n"
+  return doc
+
+
+# Bump this when the output changes for reasons Renderer_Version can't see,
+# e.g. a change to the LaTeX packages or fonts installed on the server:
+Renderer_Revision = 1
+
+# The modules whose code decides what a rendered cue sheet looks like:
+# generating the LaTeX, checking its rows (latex_check decides which are
+# rendered as plain text), formatting emphasis and splitting long routes into
+# chunks. They're named by file, as chunked imports this module.
+Renderer_Sources = ("latex.py", "latex_check.py", "cue_utils.py", "chunked.py")
+
+def _rendererVersion():
+  '''Returns a short hash of Renderer_Sources. Cached PDFs are tagged with it,
+  so they can be re-rendered (lazily) once the renderer changes.'''
+  digest = hashlib.sha1(str(Renderer_Revision))
+  here = os.path.dirname(os.path.abspath(__file__))
+  for filename in Renderer_Sources:
+    with open(os.path.join(here, filename), "rb") as source:
+      digest.update(source.read())
+  return digest.hexdigest()[:12]
+
+Renderer_Version = _rendererVersion()
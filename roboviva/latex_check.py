@@ -0,0 +1,182 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+A quick, pure-Python check of the LaTeX latex.py generates, so that a
+document pdflatex is bound to choke on is caught before paying for a
+pdflatex run (and a temp directory, and reading back its log).
+
+It's not a LaTeX parser; it checks the things that go wrong when user text
+(descriptions, notes, route names) gets past latex._escape() / _format():
+
+  - braces, math mode ($...$) and \begin / \end environments are balanced
+  - only the control sequences latex.py itself uses appear
+  - no stray special characters (#, %, ^, _ outside math)
+  - no characters pdflatex can't typeset with our fonts (e.g. emoji)
+  - table rows have exactly four columns
+
+checkRow() checks a single table row, checkDocument() a whole document.
+Both return a list of problems, as strings; an empty list means all's well.
+'''
+
+import re
+
+class LatexCheckError(Exception):
+  '''Thrown when generated LaTeX fails the checks, and can't be repaired.'''
+  pass
+
+# Control words latex.py generates (see _Preamble, _TableStart, _renderEntry,
+# makeAssemblyLatex, ...). Add to this when adding to those.
+Allowed_Control_Words = frozenset("""
+  Large Mountain Plus Rightarrow arraystretch begin clearpage danger
+  documentclass emph end familydefault fancyfoot fancyhf footnotesize
+  footskip geometry headrulewidth headsep hline includepdf label large
+  lhead newline pageref pagestyle raisebox renewcommand rhead rowcolor
+  setcounter setlength sfdefault small tablehead tablelasttail tabletail
+  text textbackslash textbf textcolor textit textunderscore thepage
+  thispagestyle twocolumn underset usepackage
+""".split())
+
+# Control symbols: \\, \{, \#, and so on:
+Allowed_Control_Symbols = frozenset(u"\\{}$#&%_ ,~")
+
+# Beyond printable ASCII: Latin-1, Latin Extended-A, and the usual
+# typographic punctuation, all of which pdflatex handles out of the box.
+_Allowed_Unicode = [(0xa0, 0x17f)] + [(c, c) for c in (0x2013, 0x2014, 0x2018, 0x2019,
+                                                        0x201a, 0x201c, 0x201d, 0x201e,
+                                                        0x2022, 0x2026)]
+
+_Token_Re = re.compile(ur'\\([A-Za-z]+|.)|.', re.DOTALL)
+_Environment_Re = re.compile(ur'\s*\{([A-Za-z*]+)\}')
+
+def isAllowedCharacter(char):
+  '''Returns True if pdflatex can typeset 'char' as-is (ignoring LaTeX's own
+  special characters).'''
+  code = ord(char)
+  if 0x20 <= code < 0x7f or char in u"\n\r\t":
+    return True
+  return any(low <= code <= high for low, high in _Allowed_Unicode)
+
+def plainText(text):
+  '''Returns 'text' (user text, before escaping) with anything that might
+  trip up latex._escape() / _format() - emphasis markers, characters LaTeX
+  has no way to print as-is, and characters pdflatex can't typeset -
+  replaced, so it renders as plain text.'''
+  return u"".join(u"" if char == u"*" else
+                  u"?" if char in u"^~" or not isAllowedCharacter(char) else
+                  char
+                  for char in (text or u""))
+
+class _Scan(object):
+  '''The result of scanning some LaTeX: problems found, plus the state at
+  the end, so the caller can check it's balanced.'''
+  def __init__(self):
+    self.problems     = []
+    self.depth        = 0
+    self.math         = False
+    self.environments = []
+    self.columns      = 1
+    # &'s that can't be column separators:
+    self.nested_tabs  = 0
+
+def _describe(text, offset):
+  '''Returns a short bit of 'text' around 'offset', for problem reports.'''
+  start = max(0, offset - 20)
+  return repr(text[start:offset + 20])
+
+def _scan(text, line_offsets = None):
+  '''Scans 'text', returning a _Scan.'''
+  scan = _Scan()
+  def problem(offset, message):
+    if line_offsets is not None:
+      line = 1 + sum(1 for line_start in line_offsets if line_start <= offset)
+      message = "line %d: %s" % (line, message)
+    scan.problems.append("%s near %s" % (message, _describe(text, offset)))
+
+  for match in _Token_Re.finditer(text):
+    offset = match.start()
+    name   = match.group(1)
+    if name is not None:
+      if len(name) == 1 and not name.isalpha():
+        if name not in Allowed_Control_Symbols:
+          problem(offset, "unsupported control symbol \\%s" % name)
+      elif name not in Allowed_Control_Words:
+        problem(offset, "unsupported control sequence \\%s" % name)
+      elif name in ("begin", "end"):
+        environment = _Environment_Re.match(text, match.end())
+        if environment is None:
+          problem(offset, "\\%s without an environment name" % name)
+        elif name == "begin":
+          scan.environments.append(environment.group(1))
+        elif not scan.environments or scan.environments[-1] != environment.group(1):
+          problem(offset, "\\end{%s} doesn't match \\begin{%s}" %
+                  (environment.group(1), scan.environments[-1] if scan.environments else ""))
+        else:
+          scan.environments.pop()
+      continue
+
+    char = match.group(0)
+    if char == u"{":
+      scan.depth += 1
+    elif char == u"}":
+      scan.depth -= 1
+      if scan.depth < 0:
+        problem(offset, "unbalanced }")
+        scan.depth = 0
+    elif char == u"$":
+      scan.math = not scan.math
+    elif char == u"&":
+      if scan.math or scan.depth:
+        scan.nested_tabs += 1
+      else:
+        scan.columns += 1
+    elif char in u"#%":
+      problem(offset, "unescaped %s" % char)
+    elif char in u"^_" and not scan.math:
+      problem(offset, "%s outside math" % char)
+    elif not isAllowedCharacter(char):
+      problem(offset, "unsupported character U+%04X" % ord(char))
+  return scan
+
+def checkRow(row):
+  '''Checks a single table row, as made by latex._renderEntry(). Returns a
+  list of problems; [] if there aren't any.'''
+  scan = _scan(row)
+  if scan.depth:
+    scan.problems.append("%d unclosed {" % scan.depth)
+  if scan.math:
+    scan.problems.append("unclosed $")
+  if scan.environments:
+    scan.problems.append("unclosed \\begin{%s}" % scan.environments[-1])
+  if scan.nested_tabs:
+    scan.problems.append("& inside a group or math")
+  if scan.columns != 4:
+    scan.problems.append("%d columns, not 4" % scan.columns)
+  return scan.problems
+
+def checkDocument(latex):
+  '''Checks a whole document (a unicode string). Returns a list of problems,
+  each with the line it's on; [] if there aren't any.'''
+  line_offsets = [match.end() for match in re.finditer(u"\n", latex)]
+  scan = _scan(latex, line_offsets)
+  if scan.depth:
+    scan.problems.append("%d unclosed { at the end" % scan.depth)
+  if scan.math:
+    scan.problems.append("unclosed $ at the end")
+  if scan.environments:
+    scan.problems.append("unclosed \\begin{%s} at the end" % scan.environments[-1])
+  return scan.problems
@@ -0,0 +1,88 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import cue
+import latex
+import latex_check
+
+def MakeRoute():
+  entries = [ cue.Entry(cue.Instruction.NONE,  "Start of route", 0.0, for_distance = 1.0),
+              cue.Entry(cue.Instruction.RIGHT, u"**Caf\xe9** St_x & {y} 50% #1 <a|b> \\z", 1.0,
+                        note = "*Coffee!*", modifier = cue.Modifier.QUICK,
+                        for_distance = 0.5, color = cue.Color.GRAY),
+              cue.Entry(cue.Instruction.CAT_1, u"Climb \u2014 \u201csteep\u201d", 2.0,
+                        color = cue.Color.YELLOW),
+              cue.Entry(cue.Instruction.DANGER, "", 2.5, note = "Potholes"),
+              cue.Entry("Custom", "Main St", 3.5),
+              cue.Entry(cue.Instruction.NONE,  "End of route", 5.0)]
+  return cue.Route(entries, 5.0, 12345, u"Test_Route #1 & co", 1000)
+
+def Row(description = "", note = "", instruction = cue.Instruction.LEFT):
+  return latex._renderEntry(cue.Entry(instruction, description, 1.0, note = note))
+
+class LatexCheckTestCase(unittest.TestCase):
+  '''Tests for the latex_check library'''
+
+  def test_generatedDocumentsPass(self):
+    route = MakeRoute()
+    for name, doc in [("route",    latex.makeLatex(route)),
+                      ("preview",  latex.makePreviewLatex(route, 3)),
+                      ("pack",     u"".join(latex.generatePackLatex([route, route]))),
+                      ("assembly", latex.makeAssemblyLatex(["chunk-0000.pdf",
+                                                            "chunk-0001.pdf"])),
+                      ("extract",  latex.makeExtractLatex("pack.pdf", 1, 2))]:
+      self.assertEqual([], latex_check.checkDocument(doc), name)
+
+  def test_generatedRowsPass(self):
+    for entry in MakeRoute().entries:
+      self.assertEqual([], latex_check.checkRow(latex._renderEntry(entry)))
+
+  def test_badRows(self):
+    good = Row("Main St")
+    self.assertEqual([], latex_check.checkRow(good))
+    self.assertTrue(latex_check.checkRow(good.replace("Main", "{Main")))
+    self.assertTrue(latex_check.checkRow(good.replace("Main", "Main}")))
+    self.assertTrue(latex_check.checkRow(good.replace("Main", "Main & St")))
+    self.assertTrue(latex_check.checkRow(good.replace("Main", "\\input{/etc/passwd}")))
+    self.assertTrue(latex_check.checkRow(good.replace("Main", "$x")))
+    self.assertTrue(latex_check.checkRow(good.replace("Main", "50%")))
+    self.assertTrue(latex_check.checkRow(good.replace("Main", "\\begin{center}")))
+
+  def test_unsupportedCharacters(self):
+    self.assertTrue(latex_check.checkRow(Row("Climb ^ x")))
+    problems = latex_check.checkRow(Row(note = u"Bikes \U0001F6B2"))
+    self.assertEqual(1, len(problems))
+    self.assertTrue("U+1F6B2" in problems[0], problems)
+
+  def test_checkDocument(self):
+    doc = latex.makeLatex(MakeRoute())
+    self.assertTrue(latex_check.checkDocument(doc.replace("\\end{document}", "")))
+    self.assertTrue(latex_check.checkDocument(doc + "}"))
+    self.assertTrue(latex_check.checkDocument(doc + "\\write18{ls}"))
+    problems = latex_check.checkDocument(u"a\nb\n\\bogus\n")
+    self.assertEqual(1, len(problems))
+    self.assertTrue("line 3" in problems[0], problems)
+
+  def test_plainText(self):
+    self.assertEqual(u"Turn left", latex_check.plainText(u"Turn **left**"))
+    self.assertEqual(u"a ? b ? c", latex_check.plainText(u"a ^ b ~ c"))
+    self.assertEqual(u"Caf\xe9 \u2014 ?", latex_check.plainText(u"Caf\xe9 \u2014 \U0001F6B2"))
+    self.assertEqual(u"", latex_check.plainText(None))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import inspect
+import os
 import unittest
 import latex
 import cue
@@ -167,6 +169,114 @@ class LatexTestCase(unittest.TestCase):
     latex_code = latex.makeLatex(r)
     pdf_data = tex.latex2pdf(latex_code)
 
+  def test_generateLatex(self):
+    '''
+    Verify the streaming generator yields the header, one chunk per entry and
+    the footer, and that those chunks make up the same document as makeLatex:
+    '''
+    ents = [cue.Entry(cue.Instruction.LEFT,  "Foo St", 0.0, for_distance = 1.0),
+            cue.Entry(cue.Instruction.RIGHT, "Bar St", 1.0)]
+    r = cue.Route(ents, route_id=123, length_mi=1.0)
+    chunks = list(latex.generateLatex(r))
+    self.assertEqual(len(ents) + 2, len(chunks))
+    self.assertEqual(latex._makeHeader(r), chunks[0])
+    self.assertEqual(latex.LatexFooter, chunks[-1])
+    self.assertEqual(latex.makeLatex(r), u"".join(chunks))
+
+  def test_rowCache(self):
+    '''
+    Verify cached rows are reused, but never mixed up between rows that
+    differ only in their distances:
+    '''
+    latex._row_cache.clear()
+    ent      = cue.Entry(cue.Instruction.RIGHT, "Main St", 1.0, for_distance = 2.0)
+    same_ent = cue.Entry(cue.Instruction.RIGHT, "Main St", 1.0, for_distance = 2.0)
+    far_ent  = cue.Entry(cue.Instruction.RIGHT, "Main St", 5.0, for_distance = 2.0)
+    last_ent = cue.Entry(cue.Instruction.RIGHT, "Main St", 1.0)
+
+    row = latex._entryToLatex(ent)
+    self.assertEqual(latex._renderEntry(ent), row)
+    self.assertEqual(row, latex._entryToLatex(same_ent))
+    self.assertEqual(latex._renderEntry(far_ent),  latex._entryToLatex(far_ent))
+    self.assertEqual(latex._renderEntry(last_ent), latex._entryToLatex(last_ent))
+    self.assertNotEqual(row, latex._entryToLatex(far_ent))
+    self.assertNotEqual(row, latex._entryToLatex(last_ent))
+
+    stats = latex.rowCacheStats()
+    self.assertEqual(3, stats['size'])
+    self.assertTrue(stats['hits'] >= 3)
+
+  def test_badRowsRenderedAsPlainText(self):
+    '''
+    Rows that would trip up pdflatex should come out as plain text instead:
+    '''
+    import latex_check
+    latex._row_cache.clear()
+    ent   = cue.Entry(cue.Instruction.CAT_1, u"**Climb** ^ up", 1.0,
+                      note = u"Bikes \U0001F6B2", color = cue.Color.YELLOW)
+    plain = cue.Entry(cue.Instruction.CAT_1, u"Climb ? up", 1.0,
+                      note = u"Bikes ?", color = cue.Color.YELLOW)
+    self.assertTrue(latex_check.checkRow(latex._renderEntry(ent)))
+    row = latex._entryToLatex(ent)
+    self.assertEqual([], latex_check.checkRow(row))
+    self.assertEqual(latex._renderEntry(plain), row)
+
+  def test_routeFingerprint(self):
+    '''
+    Only changes that make it onto the sheet should change the fingerprint:
+    '''
+    def MakeRoute(name = "Loop", climb = 1000.2, end = 5.01):
+      ents = [cue.Entry(cue.Instruction.LEFT,  "Foo St", 0.0, for_distance = end),
+              cue.Entry(cue.Instruction.NONE,  "End of route", end)]
+      return cue.Route(ents, end, 123, name, climb)
+    fingerprint = latex.routeFingerprint(MakeRoute())
+    self.assertEqual(fingerprint, latex.routeFingerprint(MakeRoute()))
+    # Below the printed precision:
+    self.assertEqual(fingerprint, latex.routeFingerprint(MakeRoute(climb = 1000.7)))
+    self.assertEqual(fingerprint, latex.routeFingerprint(MakeRoute(end = 5.02)))
+    # Visible changes:
+    self.assertNotEqual(fingerprint, latex.routeFingerprint(MakeRoute(name = "Loop 2")))
+    self.assertNotEqual(fingerprint, latex.routeFingerprint(MakeRoute(climb = 1100)))
+    self.assertNotEqual(fingerprint, latex.routeFingerprint(MakeRoute(end = 5.2)))
+
+  def test_previewLatex(self):
+    ents = [cue.Entry(cue.Instruction.RIGHT, "Street %d" % i, i * 1.0) for i in range(10)]
+    r = cue.Route(ents, route_id=123, length_mi=10.0)
+    preview = latex.makePreviewLatex(r, 3)
+    self.assertTrue("Street 2" in preview)
+    self.assertFalse("Street 3" in preview)
+    self.assertTrue("Preview" in preview)
+    # No cross-references, so one pdflatex pass will do:
+    self.assertFalse(r"\pageref" in preview)
+
+  def test_rendererVersion(self):
+    self.assertEqual(12, len(latex.Renderer_Version))
+    self.assertEqual(latex.Renderer_Version, latex._rendererVersion())
+    old_revision = latex.Renderer_Revision
+    try:
+      latex.Renderer_Revision += 1
+      self.assertNotEqual(latex.Renderer_Version, latex._rendererVersion())
+    finally:
+      latex.Renderer_Revision = old_revision
+
+    # Everything that decides what a sheet looks like counts, including the
+    # row checks (which decide which rows are rendered as plain text) and the
+    # way long routes are split into chunks:
+    import chunked
+    import cue_utils
+    import latex_check
+    for code in (latex.generateLatex, latex.makePreviewLatex, latex.generatePackLatex,
+                 latex._renderEntry, latex._makeHeader,
+                 latex_check.checkRow, cue_utils.FormatEmphasis,
+                 chunked.splitEntries, chunked._entryContent):
+      self.assertIn(os.path.basename(inspect.getsourcefile(code)), latex.Renderer_Sources)
+    old_sources = latex.Renderer_Sources
+    try:
+      latex.Renderer_Sources = old_sources[:-1]
+      self.assertNotEqual(latex.Renderer_Version, latex._rendererVersion())
+    finally:
+      latex.Renderer_Sources = old_sources
+
 class FormatterTestCase(unittest.TestCase):
   '''
   Tests Roboviva's **bold** and *italic* formatting functionality. Cases are
@@ -0,0 +1,141 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+import time
+
+class LRUCache(object):
+  '''A bounded, thread-safe, least-recently-used cache. Keeps track of its own
+  hit / miss counts, so callers can see whether it's earning its keep.'''
+  def __init__(self, max_size):
+    '''
+      max_size - The maximum number of entries to hold. Once full, the least
+                 recently used entry is evicted to make room for new ones.
+    '''
+    if max_size < 1:
+      raise ValueError("max_size must be at least 1")
+    self.max_size = max_size
+    self.hits     = 0
+    self.misses   = 0
+    self._entries = collections.OrderedDict()
+    self._lock    = threading.Lock()
+
+  def get(self, key, default = None):
+    '''Returns the value stored for 'key', or 'default' if there isn't one.'''
+    with self._lock:
+      try:
+        value = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      # Re-insert, to mark this as the most recently used entry:
+      self._entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    '''Stores 'value' for 'key', evicting the least recently used entry if the
+    cache is full.'''
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last = False)
+
+  def remove(self, key):
+    '''Removes 'key' from the cache, if it's there.'''
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    '''Empties the cache, and resets the hit / miss counts.'''
+    with self._lock:
+      self._entries.clear()
+      self.hits   = 0
+      self.misses = 0
+
+  def hitRate(self):
+    '''Returns the fraction of lookups that were hits, or 0.0 if there haven't
+    been any lookups yet.'''
+    lookups = self.hits + self.misses
+    if lookups == 0:
+      return 0.0
+    return float(self.hits) / lookups
+
+  def stats(self):
+    '''Returns a dict summarizing the state of the cache.'''
+    return { 'size'     : len(self),
+             'max_size' : self.max_size,
+             'hits'     : self.hits,
+             'misses'   : self.misses,
+             'hit_rate' : self.hitRate() }
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+class ExpiringCache(LRUCache):
+  '''An LRUCache whose entries also expire, a while after they're stored.
+  Handy for remembering failures, which shouldn't be remembered forever.'''
+  def __init__(self, max_size, ttl_secs, clock = time.time):
+    '''
+      max_size - The maximum number of entries to hold.
+      ttl_secs - How long entries live for, unless put() says otherwise.
+      clock    - Returns the current time, in seconds.
+    '''
+    LRUCache.__init__(self, max_size)
+    self.ttl_secs = ttl_secs
+    self._clock   = clock
+
+  def get(self, key, default = None):
+    '''Returns the value stored for 'key', or 'default' if there isn't one, or
+    it has expired.'''
+    with self._lock:
+      try:
+        expires_at, value = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      if expires_at <= self._clock():
+        self.misses += 1
+        return default
+      self._entries[key] = (expires_at, value)
+      self.hits += 1
+      return value
+
+  def put(self, key, value, ttl_secs = None):
+    '''Stores 'value' for 'key', for 'ttl_secs' seconds (default: the cache's
+    ttl_secs).'''
+    if ttl_secs is None:
+      ttl_secs = self.ttl_secs
+    LRUCache.put(self, key, (self._clock() + ttl_secs, value))
+
+  def items(self):
+    '''Returns a list of (key, value, expires_at) for the unexpired entries,
+    least recently used first.'''
+    now = self._clock()
+    with self._lock:
+      return [(key, value, expires_at)
+              for key, (expires_at, value) in self._entries.items()
+              if expires_at > now]
+
+  def __contains__(self, key):
+    entry = self._entries.get(key)
+    return entry is not None and entry[0] > self._clock()
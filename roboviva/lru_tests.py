@@ -0,0 +1,92 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import lru
+
+class LRUCacheTestCase(unittest.TestCase):
+  '''Tests for the lru library'''
+
+  def test_getAndPut(self):
+    cache = lru.LRUCache(2)
+    self.assertEqual(None, cache.get("a"))
+    self.assertEqual("default", cache.get("a", "default"))
+    cache.put("a", 1)
+    self.assertEqual(1, cache.get("a"))
+    self.assertEqual(1, len(cache))
+    self.assertTrue("a" in cache)
+
+  def test_evictsLeastRecentlyUsed(self):
+    cache = lru.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # Touch 'a', so 'b' becomes the least recently used entry:
+    cache.get("a")
+    cache.put("c", 3)
+    self.assertEqual(2, len(cache))
+    self.assertTrue("a" in cache)
+    self.assertFalse("b" in cache)
+    self.assertTrue("c" in cache)
+
+  def test_stats(self):
+    cache = lru.LRUCache(10)
+    self.assertEqual(0.0, cache.hitRate())
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    self.assertEqual(3, cache.hits)
+    self.assertEqual(1, cache.misses)
+    self.assertEqual(0.75, cache.hitRate())
+    self.assertEqual(1, cache.stats()['size'])
+    cache.clear()
+    self.assertEqual(0, len(cache))
+    self.assertEqual(0, cache.hits)
+
+  def test_badSize(self):
+    self.assertRaises(ValueError, lru.LRUCache, 0)
+
+  def test_remove(self):
+    cache = lru.LRUCache(2)
+    cache.put("a", 1)
+    cache.remove("a")
+    cache.remove("never there")
+    self.assertEqual(None, cache.get("a"))
+
+class ExpiringCacheTestCase(unittest.TestCase):
+  '''Tests for lru.ExpiringCache'''
+
+  def setUp(self):
+    self.now = 1000.0
+    self.cache = lru.ExpiringCache(10, 60, clock = lambda: self.now)
+
+  def test_expires(self):
+    self.cache.put("a", "gone soon")
+    self.cache.put("b", "gone later", ttl_secs = 120)
+    self.assertEqual("gone soon", self.cache.get("a"))
+    self.assertTrue("a" in self.cache)
+    self.now += 60
+    self.assertEqual(None, self.cache.get("a"))
+    self.assertFalse("a" in self.cache)
+    self.assertEqual("gone later", self.cache.get("b"))
+    self.assertEqual([("b", "gone later", 1120.0)], self.cache.items())
+    self.assertEqual(2, self.cache.hits)
+    self.assertEqual(1, self.cache.misses)
+
+if __name__ == '__main__':
+  unittest.main()
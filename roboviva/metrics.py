@@ -0,0 +1,211 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Very small, dependency-free, in-process metrics: counters, gauges and
+histograms, rendered in the Prometheus text exposition format. Everything
+lives in memory in the current process; nothing is sent anywhere.
+'''
+
+import contextlib
+import threading
+import time
+
+Default_Buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _formatLabels(label_names, label_values, extra = ()):
+  '''Formats a set of labels as '{name="value",...}', or '' if there are none.'''
+  pairs = list(zip(label_names, label_values)) + list(extra)
+  if not pairs:
+    return ""
+  escaped = []
+  for name, value in pairs:
+    value = ("%s" % value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+    escaped.append('%s="%s"' % (name, value))
+  return "{%s}" % ",".join(escaped)
+
+def _formatValue(value):
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value))
+
+class _Metric(object):
+  '''Base class for all metrics: a name, a help string, and a set of label
+  names. Values are stored per distinct tuple of label values.'''
+  metric_type = None
+
+  def __init__(self, name, help_str, label_names = ()):
+    self.name        = name
+    self.help_str    = help_str
+    self.label_names = tuple(label_names)
+    self._values     = {}
+    self._lock       = threading.Lock()
+
+  def _labelValues(self, labels):
+    if set(labels) != set(self.label_names):
+      raise ValueError("%s expects labels %s, got %s" %
+                       (self.name, self.label_names, sorted(labels)))
+    return tuple(labels[name] for name in self.label_names)
+
+  def render(self):
+    '''Returns the Prometheus text exposition for this metric, as a list of lines.'''
+    lines = ["# HELP %s %s" % (self.name, self.help_str),
+             "# TYPE %s %s" % (self.name, self.metric_type)]
+    with self._lock:
+      for label_values in sorted(self._values):
+        lines.extend(self._renderSample(label_values, self._values[label_values]))
+    return lines
+
+  def _renderSample(self, label_values, value):
+    return ["%s%s %s" % (self.name,
+                         _formatLabels(self.label_names, label_values),
+                         _formatValue(value))]
+
+class Counter(_Metric):
+  '''A monotonically increasing count of something.'''
+  metric_type = "counter"
+
+  def inc(self, amount = 1, **labels):
+    key = self._labelValues(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def value(self, **labels):
+    return self._values.get(self._labelValues(labels), 0)
+
+class Gauge(_Metric):
+  '''A value that can go up and down. If 'value_fn' is given, the gauge has no
+  labels, and its value is read from value_fn() at render time.'''
+  metric_type = "gauge"
+
+  def __init__(self, name, help_str, label_names = (), value_fn = None):
+    super(Gauge, self).__init__(name, help_str, label_names)
+    self.value_fn = value_fn
+
+  def set(self, value, **labels):
+    key = self._labelValues(labels)
+    with self._lock:
+      self._values[key] = value
+
+  def render(self):
+    if self.value_fn:
+      self.set(self.value_fn())
+    return super(Gauge, self).render()
+
+class CounterFunction(Gauge):
+  '''A counter whose (label-less) value is read from value_fn() at render
+  time, for things that already keep their own counts.'''
+  metric_type = "counter"
+
+  def __init__(self, name, help_str, value_fn):
+    super(CounterFunction, self).__init__(name, help_str, (), value_fn)
+
+class Histogram(_Metric):
+  '''Counts observations (usually durations, in seconds) into buckets.'''
+  metric_type = "histogram"
+
+  def __init__(self, name, help_str, label_names = (), buckets = Default_Buckets):
+    super(Histogram, self).__init__(name, help_str, label_names)
+    self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+  def observe(self, value, **labels):
+    key = self._labelValues(labels)
+    with self._lock:
+      if key not in self._values:
+        self._values[key] = { 'counts' : [0] * len(self.buckets),
+                              'sum'    : 0.0,
+                              'count'  : 0 }
+      sample = self._values[key]
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          sample['counts'][i] += 1
+      sample['sum']   += value
+      sample['count'] += 1
+
+  @contextlib.contextmanager
+  def time(self, **labels):
+    '''Context manager that observes how long its body took, in seconds.'''
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe(time.time() - start, **labels)
+
+  def count(self, **labels):
+    sample = self._values.get(self._labelValues(labels))
+    if sample is None:
+      return 0
+    return sample['count']
+
+  def _renderSample(self, label_values, sample):
+    lines = []
+    for bound, count in zip(self.buckets, sample['counts']):
+      lines.append("%s_bucket%s %s" %
+                   (self.name,
+                    _formatLabels(self.label_names, label_values,
+                                  [("le", _formatValue(bound))]),
+                    _formatValue(count)))
+    labels = _formatLabels(self.label_names, label_values)
+    lines.append("%s_sum%s %s"   % (self.name, labels, _formatValue(sample['sum'])))
+    lines.append("%s_count%s %s" % (self.name, labels, _formatValue(sample['count'])))
+    return lines
+
+class Registry(object):
+  '''A named collection of metrics.'''
+  def __init__(self):
+    self._metrics = []
+    self._by_name = {}
+    self._lock    = threading.Lock()
+
+  def register(self, metric):
+    '''Adds 'metric' to the registry. If a metric of the same name already
+    exists, that one is returned instead, so modules can safely be reloaded.'''
+    with self._lock:
+      if metric.name in self._by_name:
+        return self._by_name[metric.name]
+      self._metrics.append(metric)
+      self._by_name[metric.name] = metric
+      return metric
+
+  def get(self, name):
+    return self._by_name.get(name)
+
+  def render(self):
+    '''Returns all registered metrics in the Prometheus text format.'''
+    lines = []
+    for metric in list(self._metrics):
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+'''The default registry, served at /roboviva/metrics'''
+REGISTRY = Registry()
+
+def counter(name, help_str, label_names = ()):
+  return REGISTRY.register(Counter(name, help_str, label_names))
+
+def gauge(name, help_str, label_names = (), value_fn = None):
+  return REGISTRY.register(Gauge(name, help_str, label_names, value_fn))
+
+def counterFunction(name, help_str, value_fn):
+  return REGISTRY.register(CounterFunction(name, help_str, value_fn))
+
+def histogram(name, help_str, label_names = (), buckets = Default_Buckets):
+  return REGISTRY.register(Histogram(name, help_str, label_names, buckets))
+
+def render():
+  return REGISTRY.render()
@@ -0,0 +1,63 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import metrics
+
+class MetricsTestCase(unittest.TestCase):
+  '''Tests for the metrics library'''
+
+  def test_counter(self):
+    c = metrics.Counter("test_total", "A test counter.", ["result"])
+    c.inc(result = "hit")
+    c.inc(3, result = "hit")
+    c.inc(result = "miss")
+    self.assertEqual(4, c.value(result = "hit"))
+    self.assertEqual(1, c.value(result = "miss"))
+    self.assertRaises(ValueError, c.inc, stage = "hit")
+    lines = c.render()
+    self.assertTrue("# TYPE test_total counter" in lines)
+    self.assertTrue('test_total{result="hit"} 4.0' in lines)
+
+  def test_gauge(self):
+    g = metrics.Gauge("test_gauge", "A test gauge.", value_fn = lambda: 42)
+    self.assertTrue("test_gauge 42.0" in g.render())
+
+  def test_histogram(self):
+    h = metrics.Histogram("test_seconds", "A test histogram.", buckets = (1, 5))
+    h.observe(0.5)
+    h.observe(3)
+    h.observe(10)
+    with h.time():
+      pass
+    self.assertEqual(4, h.count())
+    lines = h.render()
+    self.assertTrue('test_seconds_bucket{le="1.0"} 2.0' in lines)
+    self.assertTrue('test_seconds_bucket{le="5.0"} 3.0' in lines)
+    self.assertTrue('test_seconds_bucket{le="+Inf"} 4.0' in lines)
+    self.assertTrue('test_seconds_count 4.0' in lines)
+
+  def test_registry(self):
+    r = metrics.Registry()
+    c = r.register(metrics.Counter("test_total", "A test counter."))
+    # Re-registering returns the original:
+    self.assertTrue(c is r.register(metrics.Counter("test_total", "Again.")))
+    c.inc()
+    self.assertTrue("test_total 1.0\n" in r.render())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Rendering many routes at once, e.g. every distance of an event.
+
+Rendering a route on its own pays for starting pdflatex, loading all of its
+packages and at least two passes, which for a typical route costs far more
+than typesetting the cues themselves. Here, all of the routes go into one
+document (see latex.generatePackLatex()), which is rendered once, and then
+split back into one PDF per route. Splitting is cheaper: pdfpages just copies
+finished pages, and as that has no cross-references, a single pass does.
+'''
+
+from multiprocessing.pool import ThreadPool
+
+import latex
+import tex
+import tracing
+
+Pack_Filename = "pack.pdf"
+
+def renderPack(routes, workers = 1, stats = None):
+  '''
+  Renders all of 'routes' (a list of cue.Route objects) in a single pdflatex
+  job, and splits the result back up, using up to 'workers' threads.
+
+  If 'stats' is a dict, stats['runs'] is set to the number of pdflatex passes
+  the pack needed, and stats['pages'] to each route's page count.
+
+  Returns a 2-tuple of the combined PDF, and a list of PDFs, one per route, in
+  the same order as 'routes'. Throws a ValueError (from tex.convert()) if the
+  pack fails to render.
+  '''
+  if not routes:
+    raise ValueError("No routes to render")
+  tex_stats = {}
+  with tracing.span("pack.render", routes = len(routes)):
+    try:
+      pack_pdf = tex.latex2pdf(latex.generatePackLatex(routes), stats = tex_stats)
+    finally:
+      if stats is not None and 'runs' in tex_stats:
+        stats['runs'] = tex_stats['runs']
+  page_counts = latex.packPageCounts(tex_stats['aux'], len(routes))
+  if stats is not None:
+    stats['pages'] = page_counts
+
+  page_ranges = []
+  first_page = 1
+  for n_pages in page_counts:
+    page_ranges.append((first_page, first_page + n_pages - 1))
+    first_page += n_pages
+
+  def extract(page_range):
+    with tracing.activate(trace, parent_id):
+      return tex.latex2pdf(latex.makeExtractLatex(Pack_Filename, *page_range),
+                           files = { Pack_Filename : pack_pdf },
+                           single_pass = True)
+
+  with tracing.span("pack.split", routes = len(routes)):
+    # The splitting is done from worker threads, so hand them our trace:
+    trace, parent_id = tracing.current(), tracing.currentSpanId()
+    pool = ThreadPool(max(1, min(workers, len(routes))))
+    try:
+      route_pdfs = pool.map(extract, page_ranges)
+    finally:
+      pool.close()
+  return pack_pdf, route_pdfs
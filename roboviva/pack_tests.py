@@ -0,0 +1,110 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import unittest
+import cue
+import latex
+import pack
+import tracing
+
+class _ListHandler(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(json.loads(record.getMessage()))
+
+def MakeRoute(route_id, name = None):
+  entries = [cue.Entry(cue.Instruction.RIGHT, "Street %d-%d" % (route_id, i), i * 0.5)
+             for i in range(5)]
+  return cue.Route(entries, 2.5, route_id, name)
+
+class PackTestCase(unittest.TestCase):
+  '''Tests for rendering many routes at once'''
+
+  def test_packLatex(self):
+    routes = [MakeRoute(1, "Short"), MakeRoute(2)]
+    doc = u"".join(latex.generatePackLatex(routes))
+    self.assertEqual(1, doc.count(r"\begin{document}"))
+    self.assertEqual(2, doc.count(r"\begin{supertabular}"))
+    # Each route resets the page count, and numbers its pages up to its own
+    # last page:
+    self.assertEqual(2, doc.count(r"\setcounter{page}{1}"))
+    self.assertTrue(r"\pageref{RouteEnd:0}" in doc)
+    self.assertTrue(r"\label{RouteEnd:1}" in doc)
+    self.assertFalse("LastPage}" in doc)
+    # ...and clears the headers of the route before:
+    second = doc[doc.index(r"\label{RouteEnd:0}"):]
+    self.assertTrue(r"\fancyhf{}" in second)
+    self.assertFalse("Short" in second)
+    self.assertTrue("Street 2-4" in second)
+
+  def test_packPageCounts(self):
+    aux = "\\relax\n\\newlabel{RouteEnd:0}{{}{2}}\n\\newlabel{RouteEnd:1}{{}{11}}\n"
+    self.assertEqual([2, 11], latex.packPageCounts(aux, 2))
+    self.assertRaises(ValueError, latex.packPageCounts, aux, 3)
+
+  def test_renderPack(self):
+    stats = {}
+    pack_pdf, route_pdfs = pack.renderPack([MakeRoute(1), MakeRoute(2), MakeRoute(3)],
+                                           workers = 2, stats = stats)
+    self.assertEqual('%PDF-', pack_pdf[:5])
+    self.assertEqual(3, len(route_pdfs))
+    self.assertEqual([1, 1, 1], stats['pages'])
+    for pdf in route_pdfs:
+      self.assertEqual('%PDF-', pdf[:5])
+
+  def test_splitIsSinglePass(self):
+    # Only the pack itself waits for its page counts to settle; splitting it
+    # is one pdflatex pass per route, traced under pack.split:
+    calls = []
+    def latex2pdf(source, **kwargs):
+      with tracing.span("tex.convert") as span:
+        calls.append((kwargs.get('single_pass', False), span['parent_id']))
+      if 'files' not in kwargs:
+        kwargs['stats']['aux'] = "".join("\\newlabel{RouteEnd:%d}{{}{%d}}\n" % (i, i + 1)
+                                         for i in range(3))
+        return "%PDF-pack"
+      return "%PDF-route"
+    handler = _ListHandler()
+    logger  = logging.getLogger("roboviva.trace")
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    original_latex2pdf = pack.tex.latex2pdf
+    pack.tex.latex2pdf = latex2pdf
+    try:
+      tracing.start()
+      pack_pdf, route_pdfs = pack.renderPack([MakeRoute(1), MakeRoute(2), MakeRoute(3)],
+                                             workers = 3)
+    finally:
+      tracing.finish()
+      pack.tex.latex2pdf = original_latex2pdf
+      logger.removeHandler(handler)
+    self.assertEqual(["%PDF-route"] * 3, route_pdfs)
+    split = [span for span in handler.records if span['name'] == "pack.split"][0]
+    self.assertEqual([True] * 3, [single_pass for single_pass, parent_id in calls[1:]])
+    self.assertEqual([split['span_id']] * 3, [parent_id for single_pass, parent_id in calls[1:]])
+    self.assertFalse(calls[0][0])
+
+  def test_noRoutes(self):
+    self.assertRaises(ValueError, pack.renderPack, [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,165 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Opt-in profiling of slow requests.
+
+While a request is being handled, a background thread samples its Python
+stack every few milliseconds. If the request turns out to be slow (or an
+admin asked for a profile via the query string), the samples are written to
+PROFILE_DIR in "collapsed stack" format (one 'frame;frame;frame count' line
+per distinct stack, as consumed by flamegraph.pl and speedscope), alongside a
+JSON file with the route id, latency and stage timings. Only the newest
+PROFILE_KEEP profiles are kept.
+
+Relevant config values:
+  PROFILE_SLOW_REQUEST_SECS - Keep profiles of requests slower than this.
+                              None disables automatic profiling.
+  PROFILE_ADMIN_TOKEN       - If set, '?profile=<token>' profiles that request
+                              and always keeps the result.
+  PROFILE_DIR               - Where profiles are written.
+  PROFILE_KEEP              - How many profiles to keep around.
+  PROFILE_INTERVAL_SECS     - Time between stack samples.
+'''
+
+import collections
+import flask
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+class Sampler(threading.Thread):
+  '''Periodically samples the stack of another thread, counting how often
+  each distinct stack is seen.'''
+  def __init__(self, thread_ident, interval_secs):
+    super(Sampler, self).__init__(name = "profiler-%s" % thread_ident)
+    self.daemon        = True
+    self.thread_ident  = thread_ident
+    self.interval_secs = interval_secs
+    self.samples       = collections.Counter()
+    self._stopped      = threading.Event()
+
+  def run(self):
+    while not self._stopped.is_set():
+      frame = sys._current_frames().get(self.thread_ident)
+      if frame is None:
+        break
+      self.samples[_collapseStack(frame)] += 1
+      self._stopped.wait(self.interval_secs)
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
+  def collapsed(self):
+    '''Returns the samples in collapsed stack format, one line per stack.'''
+    return "".join("%s %d\n" % (stack, count)
+                   for stack, count in sorted(self.samples.items()))
+
+def _collapseStack(frame):
+  '''Turns 'frame' and its callers into a 'outermost;...;innermost' string.'''
+  names = []
+  while frame is not None:
+    code = frame.f_code
+    names.append("%s (%s:%d)" % (code.co_name,
+                                 os.path.basename(code.co_filename),
+                                 code.co_firstlineno))
+    frame = frame.f_back
+  return ";".join(reversed(names))
+
+def _wantsProfile(app):
+  '''Returns (profile, forced): whether to profile the current request, and
+  whether an admin asked for it explicitly.'''
+  token = app.config.get('PROFILE_ADMIN_TOKEN')
+  if token and flask.request.args.get('profile') == token:
+    return (True, True)
+  return (app.config.get('PROFILE_SLOW_REQUEST_SECS') is not None, False)
+
+def _rotate(profile_dir, keep):
+  '''Deletes all but the newest 'keep' profiles in 'profile_dir'.'''
+  infos = sorted(glob.glob(os.path.join(profile_dir, "*.json")))
+  for info in infos[:max(0, len(infos) - keep)]:
+    base = os.path.splitext(info)[0]
+    for filename in (info, base + ".folded"):
+      try:
+        os.unlink(filename)
+      except OSError:
+        pass
+
+def _writeProfile(app, sampler, latency_secs, forced, error):
+  profile_dir = app.config['PROFILE_DIR']
+  if not os.path.isdir(profile_dir):
+    os.makedirs(profile_dir)
+
+  trace    = flask.g.get('roboviva_trace')
+  route_id = (flask.request.view_args or {}).get('route_id')
+  base     = os.path.join(profile_dir, "%.3f-%s" % (time.time(), route_id))
+  info = { 'route_id'     : route_id,
+           'url'          : flask.request.url,
+           'latency_secs' : latency_secs,
+           'forced'       : forced,
+           'error'        : str(error) if error else None,
+           'trace_id'     : trace.trace_id if trace else None,
+           'stages'       : trace.stageTimings() if trace else [],
+           'samples'      : sum(sampler.samples.values()),
+           'interval_secs': sampler.interval_secs }
+  with open(base + ".folded", 'w') as folded_file:
+    folded_file.write(sampler.collapsed())
+  with open(base + ".json", 'w') as info_file:
+    json.dump(info, info_file, indent = 2)
+  _rotate(profile_dir, app.config['PROFILE_KEEP'])
+  return base
+
+def init_app(app):
+  '''Installs the profiling hooks on 'app'.'''
+  app.config.setdefault('PROFILE_SLOW_REQUEST_SECS', None)
+  app.config.setdefault('PROFILE_ADMIN_TOKEN',       None)
+  app.config.setdefault('PROFILE_DIR',               'profiles')
+  app.config.setdefault('PROFILE_KEEP',              50)
+  app.config.setdefault('PROFILE_INTERVAL_SECS',     0.005)
+
+  @app.before_request
+  def startProfile():
+    profile, forced = _wantsProfile(app)
+    if not profile:
+      return
+    sampler = Sampler(threading.current_thread().ident,
+                      app.config['PROFILE_INTERVAL_SECS'])
+    flask.g.roboviva_profile = (sampler, time.time(), forced)
+    sampler.start()
+
+  # A teardown, not an after_request, as those are skipped when the view
+  # raises, and the sampler would never be stopped:
+  @app.teardown_request
+  def finishProfile(error):
+    profile = flask.g.pop('roboviva_profile', None)
+    if profile is None:
+      return
+    sampler, start, forced = profile
+    sampler.stop()
+    latency_secs = time.time() - start
+    threshold = app.config['PROFILE_SLOW_REQUEST_SECS']
+    if forced or (threshold is not None and latency_secs > threshold):
+      try:
+        base = _writeProfile(app, sampler, latency_secs, forced, error)
+        app.logger.warning("[profile]: %.2fs request to %s, profile: %s",
+                           latency_secs, flask.request.path, base)
+      except Exception as e:
+        app.logger.error("[profile]: Error writing profile: %s", e)
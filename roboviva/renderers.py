@@ -0,0 +1,95 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The ways Roboviva can turn a cue.Route into a PDF.
+
+Each renderer has a 'name' (used in the RENDERER config value, and in
+'?renderer=<name>' on /routes/<id>, which renders with it without caching the
+result), a 'version' (stored with cached PDFs, so they're re-rendered when the
+renderer changes), available(), which says whether its dependencies are installed, and
+render(route, stats = None), which returns the PDF as a byte string.
+
+  latex     - latex.py + pdflatex. Needs pdflatex, and the Helvetica fonts.
+  reportlab - reportlab_render.py. In-process, but needs ReportLab.
+'''
+
+import distutils.spawn
+import hashlib
+import inspect
+
+import cue_utils
+import latex
+import tex
+
+class LatexRenderer(object):
+  '''Renders via LaTeX, in a pdflatex subprocess.'''
+  name = "latex"
+
+  @property
+  def version(self):
+    return latex.Renderer_Version
+
+  def available(self):
+    return distutils.spawn.find_executable("pdflatex") is not None
+
+  def render(self, route, stats = None):
+    return tex.latex2pdf(latex.generateLatex(route), stats = stats)
+
+class ReportLabRenderer(object):
+  '''Renders in-process, with ReportLab.'''
+  name = "reportlab"
+
+  _version = None
+
+  @property
+  def version(self):
+    if self._version is None:
+      import reportlab_render
+      digest = hashlib.sha1(inspect.getsource(reportlab_render))
+      digest.update(inspect.getsource(cue_utils.FormatEmphasis))
+      self._version = "reportlab-" + digest.hexdigest()[:12]
+    return self._version
+
+  def available(self):
+    try:
+      import reportlab_render
+      return True
+    except ImportError:
+      return False
+
+  def render(self, route, stats = None):
+    import reportlab_render
+    return reportlab_render.renderPdf(route)
+
+_renderers = {}
+
+def register(renderer):
+  '''Makes 'renderer' available under its name.'''
+  _renderers[renderer.name] = renderer
+
+def names():
+  '''Returns the names of all registered renderers, available or not.'''
+  return sorted(_renderers)
+
+def get(name):
+  '''Returns the renderer called 'name'. Throws a KeyError if there's no such
+  renderer.'''
+  return _renderers[name]
+
+register(LatexRenderer())
+register(ReportLabRenderer())
@@ -0,0 +1,103 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+import unittest
+import zlib
+import cue
+import latex
+import renderers
+
+def MakeRoute():
+  entries = [cue.Entry(cue.Instruction.NONE, "Start of route", 0.0, for_distance = 1.0),
+             cue.Entry(cue.Instruction.LEFT, "**Main** St", 1.0, note = "*Careful*",
+                       for_distance = 2.0, color = cue.Color.YELLOW),
+             cue.Entry(cue.Instruction.CAT_2, "Big Hill", 3.0, for_distance = 1.0,
+                       color = cue.Color.GRAY),
+             cue.Entry(cue.Instruction.DANGER, "Rough & <bumpy>", 4.0, for_distance = 1.0),
+             cue.Entry(cue.Instruction.NONE, "End of route", 5.0)]
+  return cue.Route(entries, 5.0, 123, u"Caf\xe9 Loop", 1200)
+
+def PdfText(pdf):
+  '''Returns the (decompressed) content streams of a ReportLab PDF: the text
+  it draws, as "(...) Tj" operators, and so on.'''
+  from reportlab.lib.rl_accel import asciiBase85Decode
+  return "\n".join(zlib.decompress(asciiBase85Decode(stream.strip()))
+                   for stream in re.findall(r'stream\r?\n(.*?)endstream', pdf, re.S))
+
+class RenderersTestCase(unittest.TestCase):
+  '''Tests for the renderer registry, and the in-process renderer'''
+
+  def test_registry(self):
+    self.assertEqual(["latex", "reportlab"], renderers.names())
+    self.assertEqual(latex.Renderer_Version, renderers.get("latex").version)
+    self.assertRaises(KeyError, renderers.get, "crayon")
+
+  @unittest.skipUnless(renderers.get("reportlab").available(), "needs ReportLab")
+  def test_reportlab(self):
+    renderer = renderers.get("reportlab")
+    self.assertTrue(renderer.version.startswith("reportlab-"))
+    self.assertNotEqual(renderers.get("latex").version, renderer.version)
+    pdf = renderer.render(MakeRoute())
+    self.assertEqual('%PDF-', pdf[:5])
+
+  @unittest.skipUnless(renderers.get("reportlab").available(), "needs ReportLab")
+  def test_reportlabFormat(self):
+    import reportlab_render
+    self.assertEqual(u"<b>Main</b> St &amp; <i>more</i> a * b",
+                     reportlab_render._format(u"**Main** St & *more* a * b"))
+
+  @unittest.skipUnless(renderers.get("reportlab").available(), "needs ReportLab")
+  def test_reportlabMatchesLatex(self):
+    # Everything the LaTeX sheet shows for the route, the ReportLab one draws:
+    route = MakeRoute()
+    route.entries.insert(-1, cue.Entry(cue.Instruction.FIRST_AID, "", 4.5,
+                                       note = "Clinic", for_distance = 0.5))
+    text = PdfText(renderers.get("reportlab").render(route))
+    self.assertIn(r"(Caf\351 Loop \(5.0 mi / 1200 ft\)) Tj", text)
+    self.assertIn("(Route #123) Tj", text)
+    self.assertIn("(Page 1 of 1) Tj", text)
+    for title in ("Go", "At", "On", "For"):
+      self.assertIn("/F3 10 Tf 12 TL (%s) Tj" % title, text)
+    for entry in route.entries:
+      self.assertIn("(%5.1f) Tj" % entry.absolute_distance, text)
+    self.assertEqual(4, len(re.findall(r"\(  1\.0\) Tj", text))) # Three For's, one At
+    # Bold instructions, emphasis and notes (in italics), escaping:
+    self.assertIn("(L) Tj", text)
+    self.assertIn("/F3 10 Tf 0 0 0 rg (Main) Tj /F1 10 Tf ( St) Tj  T* /F2 10 Tf (Careful) Tj", text)
+    self.assertIn("(Rough & <) Tj (bumpy) Tj (>) Tj", text)
+    # A note with no description stands in for it, in the regular font:
+    self.assertIn("/F1 10 Tf 12 TL (Clinic) Tj", text)
+    # Climb, danger and first aid glyphs, rather than ZapfDingbats' fallback
+    # (a black square, 'n'):
+    self.assertRegexpMatches(text, r"/F4 10 Tf [^()]*\(s\) Tj [^()]*/F3 10 Tf \(2\) Tj")
+    self.assertRegexpMatches(text, r"/F3 14 Tf [^()]*\(!\) Tj")
+    self.assertRegexpMatches(text, r"/F4 10 Tf [^()]*\(:\) Tj")
+    self.assertNotIn("(n) Tj", text)
+    # Yellow and gray rows:
+    self.assertIn("1 1 0 rg", text)
+    self.assertIn(".8 .8 .8 rg", text)
+
+  @unittest.skipUnless(renderers.get("reportlab").available(), "needs ReportLab")
+  def test_reportlabLongRoute(self):
+    entries = [cue.Entry(cue.Instruction.RIGHT, "Street %d" % i, i * 0.5, for_distance = 0.5)
+               for i in range(400)]
+    pdf = renderers.get("reportlab").render(cue.Route(entries, 200.0, 123))
+    self.assertEqual('%PDF-', pdf[:5])
+
+if __name__ == '__main__':
+  unittest.main()
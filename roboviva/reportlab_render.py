@@ -0,0 +1,185 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Renders cue sheets to PDF in-process, with ReportLab, rather than via LaTeX.
+
+Draws the same sheet as latex.py: a two-column Go / At / On / For table with
+a repeated black header row, gray and yellow rows, climb / danger / first aid
+glyphs, markdown-style *emphasis*, the route name and stats at the top of
+each page and "Page X of Y" at the bottom. No subprocess, no temp files, and
+a single pass.
+
+Needs ReportLab (pip install reportlab); see renderers.py.
+'''
+
+import cStringIO
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.pdfgen import canvas
+from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate, Paragraph, Table, TableStyle
+
+import cue
+import cue_utils
+
+# Page layout, matching the LaTeX geometry:
+Page_Size     = letter
+Left_Margin   = 0.20 * inch
+Right_Margin  = 0.20 * inch
+Top_Margin    = 0.70 * inch
+Bottom_Margin = 0.25 * inch
+Column_Gap    = 0.20 * inch
+Column_Width  = (Page_Size[0] - Left_Margin - Right_Margin - Column_Gap) / 2
+# Go, At, On, For:
+Col_Widths    = (0.50 * inch, 0.45 * inch, Column_Width - 1.40 * inch, 0.45 * inch)
+
+Row_Colors = { cue.Color.YELLOW : colors.yellow,
+               cue.Color.GRAY   : colors.Color(0.8, 0.8, 0.8) }
+
+_cell_style   = ParagraphStyle("cell", fontName = "Helvetica", fontSize = 10, leading = 12)
+_go_style     = ParagraphStyle("go", parent = _cell_style, alignment = TA_CENTER)
+_header_style = ParagraphStyle("header", parent = _cell_style,
+                               fontName = "Helvetica-Bold", textColor = colors.white)
+
+# Glyphs from ZapfDingbats, one of the 14 fonts every PDF viewer has. ReportLab
+# maps them from their Unicode code points (anything else comes out as a
+# black square):
+_Mountain = u'<font name="ZapfDingbats">\u25b2</font>' # Black up-pointing triangle
+_Cross    = u'<font name="ZapfDingbats">\u271a</font>' # Heavy greek cross
+
+_Climbs = { cue.Instruction.CAT_1  : "1",
+            cue.Instruction.CAT_2  : "2",
+            cue.Instruction.CAT_3  : "3",
+            cue.Instruction.CAT_4  : "4",
+            cue.Instruction.CAT_5  : "5",
+            cue.Instruction.CAT_HC : "HC",
+            cue.Instruction.SUMMIT : "End" }
+
+def _instructionMarkup(instruction, modifier):
+  '''Maps a cue.Instruction to the Paragraph markup used to draw it.'''
+  if instruction in _Climbs:
+    return u"%s<br/><b>%s</b>" % (_Mountain, _Climbs[instruction])
+  elif instruction == cue.Instruction.DANGER:
+    return u'<font size="14"><b>!</b></font>'
+  elif instruction == cue.Instruction.FIRST_AID:
+    return _Cross
+  return u"<b>%s%s</b>" % (escape(modifier), escape(instruction))
+
+def _format(text):
+  '''Escapes 'text' for a Paragraph, turning markdown-style **strong emphasis**
+  and *emphasis* into bold and italics, like latex._format() does.'''
+  return cue_utils.FormatEmphasis(escape(text), u"<b>%s</b>", u"<i>%s</i>")
+
+def _entryRow(entry):
+  '''Converts a cue.Entry into a row of table cells.'''
+  description = _format(entry.description)
+  if entry.note:
+    # As in the LaTeX version: a note without a description stands in for
+    # the description, otherwise it goes underneath, in italics:
+    if description.strip() == "":
+      description = _format(entry.note)
+    else:
+      description += u"<br/><i>%s</i>" % _format(entry.note)
+  for_str = ""
+  if entry.for_distance:
+    for_str = "%5.1f" % entry.for_distance
+  return [Paragraph(_instructionMarkup(entry.instruction, entry.modifier), _go_style),
+          "%5.1f" % entry.absolute_distance,
+          Paragraph(description, _cell_style),
+          for_str]
+
+def _makeTable(route):
+  '''Makes the Go / At / On / For table for 'route'.'''
+  rows = [[Paragraph(title, _header_style) for title in ("Go", "At", "On", "For")]]
+  style = [("GRID",       (0, 0), (-1, -1), 0.5, colors.black),
+           ("BACKGROUND", (0, 0), (-1, 0),  colors.black),
+           ("FONTNAME",   (0, 1), (-1, -1), "Helvetica"),
+           ("FONTSIZE",   (0, 1), (-1, -1), 10),
+           ("VALIGN",     (0, 0), (-1, -1), "MIDDLE")]
+  for i, entry in enumerate(route.entries):
+    rows.append(_entryRow(entry))
+    if entry.color in Row_Colors:
+      style.append(("BACKGROUND", (0, i + 1), (-1, i + 1), Row_Colors[entry.color]))
+  return Table(rows, colWidths = Col_Widths, repeatRows = 1, style = TableStyle(style))
+
+def _heads(route):
+  '''Returns the (left, right) page header text for 'route'.'''
+  if route.elevation_gain_ft:
+    stats = "%.1f mi / %d ft" % (route.length_mi, route.elevation_gain_ft)
+  else:
+    stats = "%.1f mi" % route.length_mi
+  rhead = u"Route #%s" % route.id
+  if route.name:
+    return (u"%s (%s)" % (route.name, stats), rhead)
+  return (u"", u"%s (%s)" % (rhead, stats))
+
+class _NumberedCanvas(canvas.Canvas):
+  '''A Canvas that holds on to its pages until the end, so it can stamp
+  "Page X of Y" on each of them once Y is known.'''
+  def __init__(self, *args, **kwargs):
+    canvas.Canvas.__init__(self, *args, **kwargs)
+    self._page_states = []
+
+  def showPage(self):
+    self._page_states.append(dict(self.__dict__))
+    self._startPage()
+
+  def save(self):
+    n_pages = len(self._page_states)
+    for state in self._page_states:
+      self.__dict__.update(state)
+      self.setFont("Helvetica-Oblique", 8)
+      self.drawCentredString(Page_Size[0] / 2.0, 0.12 * inch,
+                             "Page %d of %d" % (self._pageNumber, n_pages))
+      canvas.Canvas.showPage(self)
+    canvas.Canvas.save(self)
+
+def renderPdf(route):
+  '''
+  Renders 'route' (a cue.Route) to PDF.
+
+  Returns the PDF, as a byte string.
+  '''
+  lhead, rhead = _heads(route)
+  def drawHeads(page, doc):
+    page.saveState()
+    page.setFont("Helvetica-Oblique", 9)
+    y = Page_Size[1] - Top_Margin + 0.25 * inch
+    page.drawString(Left_Margin, y, lhead)
+    page.drawRightString(Page_Size[0] - Right_Margin, y, rhead)
+    page.setLineWidth(0.4)
+    page.line(Left_Margin, y - 4, Page_Size[0] - Right_Margin, y - 4)
+    page.restoreState()
+
+  height = Page_Size[1] - Top_Margin - Bottom_Margin
+  frames = [Frame(Left_Margin, Bottom_Margin, Column_Width, height,
+                  leftPadding = 0, rightPadding = 0, id = "left"),
+            Frame(Left_Margin + Column_Width + Column_Gap, Bottom_Margin, Column_Width, height,
+                  leftPadding = 0, rightPadding = 0, id = "right")]
+  out = cStringIO.StringIO()
+  doc = BaseDocTemplate(out,
+                        pagesize = Page_Size,
+                        title = route.name or "Route #%s" % route.id,
+                        pageTemplates = [PageTemplate(id = "cues", frames = frames,
+                                                      onPage = drawHeads)])
+  doc.build([_makeTable(route)], canvasmaker = _NumberedCanvas)
+  return out.getvalue()
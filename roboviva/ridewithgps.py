@@ -19,14 +19,99 @@ import cue
 import cue_utils
 import hashlib
 import json
+import metrics
 import re
 import socket
+import time
+import tracing
+import upstream
 import urllib2
+import zlib
+
+# Where RideWithGPS lives. Overridden by the app's RWGPS_BASE_URL config value,
+# e.g. to point at a local stand-in server (see standin.py) for load testing.
+Base_Url = "http://ridewithgps.com"
+
+# How hard we lean on RideWithGPS. See configure(), below, for the app config
+# values that override these.
+Max_Attempts      = 3
+Timeout_Secs      = 5
+Backoff_Base_Secs = 0.25
+Backoff_Cap_Secs  = 4.0
+Max_Wait_For_Token_Secs = 5.0
+# Statuses meaning there's no such route, which are worth remembering (see
+# RideWithGpsUnknownRoute):
+Unknown_Route_Codes = (404, 410)
+# Responses are read (and decompressed) this many bytes at a time, and
+# refused if they decompress to more than Max_Body_Bytes:
+Read_Chunk_Bytes  = 64 * 1024
+Max_Body_Bytes    = 64 * 1024 * 1024
+rate_limiter = upstream.TokenBucket(rate = 10, burst = 20)
+breaker      = upstream.CircuitBreaker(failure_threshold = 5, reset_secs = 30)
+# Optional; an upstream.Hedger, if hedged requests are turned on:
+hedger       = None
+
+_attempts = metrics.counter(
+    "roboviva_rwgps_attempts_total",
+    "Individual requests made to RideWithGPS, by outcome.",
+    ["outcome"])
+_bytes_received = metrics.counter(
+    "roboviva_rwgps_bytes_total",
+    "Bytes received from RideWithGPS: 'wire' as sent, 'decoded' after decompression.",
+    ["kind"])
+_fast_failures = metrics.counter(
+    "roboviva_rwgps_fast_failures_total",
+    "RideWithGPS fetches failed without a request being made, by reason.",
+    ["reason"])
+metrics.counterFunction("roboviva_rwgps_hedges_issued_total",
+                        "Hedge requests sent to RideWithGPS.",
+                        lambda: hedger.hedges_issued if hedger else 0)
+metrics.counterFunction("roboviva_rwgps_hedges_won_total",
+                        "Hedge requests that answered before the original request.",
+                        lambda: hedger.hedges_won if hedger else 0)
+metrics.gauge("roboviva_rwgps_breaker_open",
+              "1 if the RideWithGPS circuit breaker is open (or half open), 0 if closed.",
+              value_fn = lambda: 0 if breaker.state == upstream.CircuitBreaker.CLOSED else 1)
+
+def configure(config):
+  '''
+      Applies the RideWithGPS-related values from an app config (a dict) to
+      this module: base url, timeouts, retries, rate limits and circuit
+      breaker settings. Missing values are left as they are.
+  '''
+  global Base_Url, Max_Attempts, Timeout_Secs, rate_limiter, breaker, hedger
+  Base_Url     = config.get('RWGPS_BASE_URL', Base_Url)
+  Max_Attempts = config.get('RWGPS_MAX_ATTEMPTS', Max_Attempts)
+  Timeout_Secs = config.get('RWGPS_TIMEOUT_SECS', Timeout_Secs)
+  if 'RWGPS_RATE_LIMIT' in config:
+    rate_limiter = upstream.TokenBucket(config['RWGPS_RATE_LIMIT'],
+                                        config.get('RWGPS_RATE_BURST', 1))
+  if 'RWGPS_BREAKER_THRESHOLD' in config:
+    breaker = upstream.CircuitBreaker(config['RWGPS_BREAKER_THRESHOLD'],
+                                      config.get('RWGPS_BREAKER_RESET_SECS', 30))
+  if config.get('RWGPS_HEDGE'):
+    hedger = upstream.Hedger(percentile = config.get('RWGPS_HEDGE_PERCENTILE', 0.95),
+                             max_rate   = config.get('RWGPS_HEDGE_MAX_RATE', 0.05))
 
 class RideWithGpsError(Exception):
   '''Thrown by getCueSheet() in the event of an error'''
   pass
 
+class RideWithGpsUnavailable(RideWithGpsError):
+  '''Thrown when RideWithGPS itself is in trouble (timeouts, 429s, 5xxs),
+  rather than there being a problem with the route being asked for. Also
+  thrown, without asking, while the circuit breaker is open.'''
+  pass
+
+class RideWithGpsUnknownRoute(RideWithGpsError):
+  '''Thrown when RideWithGPS says there's no such route (e.g. a 404).'''
+  pass
+
+class RideWithGpsDeadlineExceeded(RideWithGpsUnavailable):
+  '''Thrown when the caller's deadline ran out before RideWithGPS answered
+  (or before it was worth asking again).'''
+  pass
+
 class RWGPS_Entry(object):
   '''Simple storage class containing the RWGPS-provided data for a single cue entry'''
   def __init__(self,
@@ -43,29 +128,238 @@ class RWGPS_Entry(object):
    self.next_absolute_distance = next_absolute_distance
    self.note_str = note_str
 
-def getEtagForCSV(route_id):
+def _makeRequest(url, etag = None):
+  '''
+      Builds a urllib2.Request for 'url'. If 'etag' is non-None, it's passed
+      in the 'If-None-Match' header. If a trace is active, its id is passed
+      along, so RWGPS-side logs (or a stand-in server's) can be correlated.
+  '''
+  req = urllib2.Request(url)
+  req.add_header("Accept-Encoding", "gzip, deflate")
+  if etag:
+    req.add_header("If-None-Match", etag)
+  trace = tracing.current()
+  if trace:
+    req.add_header(tracing.Trace_Header, trace.trace_id)
+  return req
+
+class _StreamDecoder(object):
+  '''Incrementally decodes a gzip or deflate response body, a chunk at a
+  time, as it comes off the wire.'''
+  def __init__(self, content_encoding):
+    self.content_encoding = content_encoding
+    if content_encoding in ("gzip", "x-gzip"):
+      self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+      # "deflate" is supposed to be zlib-wrapped, but plenty of servers send
+      # raw deflate data; figure out which on the first chunk.
+      self._decompressor = None
+    self.decoded_bytes = 0
+
+  def decompress(self, chunk):
+    if self._decompressor is None:
+      try:
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        return self._count(self._decompressor.decompress(chunk))
+      except zlib.error:
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    return self._count(self._decompressor.decompress(chunk))
+
+  def flush(self):
+    if self._decompressor is None:
+      return ""
+    return self._count(self._decompressor.flush())
+
+  def _count(self, data):
+    self.decoded_bytes += len(data)
+    if self.decoded_bytes > Max_Body_Bytes:
+      raise RideWithGpsError("Response from RideWithGPS decompressed to over %d bytes" %
+                             Max_Body_Bytes)
+    return data
+
+def _readBody(resp):
+  '''
+      Reads the body of 'resp' a chunk at a time, decompressing each chunk as
+      it arrives if the server compressed the response. Returns a 2-tuple of
+      the decoded body and the number of bytes that came over the wire.
+  '''
+  content_encoding = (resp.info().getheader("Content-Encoding") or "").strip().lower()
+  decoder = None
+  if content_encoding in ("gzip", "x-gzip", "deflate"):
+    decoder = _StreamDecoder(content_encoding)
+  elif content_encoding not in ("", "identity"):
+    raise RideWithGpsError("Unsupported Content-Encoding from RideWithGPS: %s" %
+                           content_encoding)
+
+  pieces     = []
+  wire_bytes = 0
+  try:
+    while True:
+      chunk = resp.read(Read_Chunk_Bytes)
+      if not chunk:
+        break
+      wire_bytes += len(chunk)
+      if decoder:
+        chunk = decoder.decompress(chunk)
+      elif wire_bytes > Max_Body_Bytes:
+        raise RideWithGpsError("Response from RideWithGPS is over %d bytes" % Max_Body_Bytes)
+      pieces.append(chunk)
+    if decoder:
+      pieces.append(decoder.flush())
+  except zlib.error as e:
+    raise RideWithGpsError("Corrupt %s response from RideWithGPS: %s" % (content_encoding, e))
+  return ("".join(pieces), wire_bytes)
+
+def _fetchOnce(req, attempt, timeout_secs):
+  '''
+      Makes a single attempt at fetching 'req', waiting on the socket for at
+      most 'timeout_secs' at a time, and returns a 2-tuple of the response's
+      ETag header and (decompressed) body. Any urllib2 / socket exceptions are
+      passed through to the caller.
+  '''
+  with tracing.span("rwgps.request", url = req.get_full_url(), attempt = attempt) as span:
+    resp = urllib2.urlopen(req, timeout = timeout_secs)
+    new_etag = resp.info().getheader("ETag")
+    body, wire_bytes = _readBody(resp)
+    _bytes_received.inc(wire_bytes, kind = "wire")
+    _bytes_received.inc(len(body),  kind = "decoded")
+    span['bytes']      = len(body)
+    span['wire_bytes'] = wire_bytes
+    return (new_etag, body)
+
+def _isRetryable(error):
+  '''Returns True if 'error' (raised by _fetchOnce()) means RideWithGPS is
+  struggling, and the request is worth retrying.'''
+  if isinstance(error, urllib2.HTTPError):
+    return error.code == 429 or error.code >= 500
+  return isinstance(error, (socket.timeout, socket.error, urllib2.URLError))
+
+def _retryAfterSecs(error):
+  '''Returns the delay asked for by a 429 / 503's Retry-After header, if any.'''
+  if isinstance(error, urllib2.HTTPError) and error.hdrs:
+    try:
+      return float(error.hdrs.getheader("Retry-After"))
+    except (TypeError, ValueError):
+      pass
+  return 0.0
+
+def _attempt(req, attempt, timeout_secs):
+  '''
+      Makes a single attempt at fetching 'req', via _fetchOnce(). If hedging
+      is on, and the request is slower than usual, an identical request is
+      sent alongside it, and whichever answers first is used.
+  '''
+  if hedger is None:
+    return _fetchOnce(req, attempt, timeout_secs)
+  # The requests are made from worker threads, so hand them our trace:
+  trace, parent_id = tracing.current(), tracing.currentSpanId()
+  def fetch():
+    with tracing.activate(trace, parent_id):
+      return _fetchOnce(req, attempt, timeout_secs)
+  return hedger.call(fetch,
+                     is_usable_error = lambda e: not _isRetryable(e),
+                     may_hedge       = rate_limiter.tryAcquire)
+
+def _fetch(req, route_id, deadline = None):
+  '''
+      Fetches 'req' from RideWithGPS, politely: requests go through the rate
+      limiter, retryable failures (timeouts, 429s, 5xxs) are retried with
+      jittered exponential backoff, and nothing is sent at all while the
+      circuit breaker is open.
+
+      Returns a 2-tuple of the response's ETag and body, or None if the
+      server replied 304: Not Modified.
+
+      If 'deadline' (an upstream.Deadline) is given, no attempt is allowed to
+      run past it, and no retry is started that couldn't get an answer before
+      it.
+
+      Throws a RideWithGpsError if the route doesn't exist, a
+      RideWithGpsUnavailable if RideWithGPS couldn't be reached, and a
+      RideWithGpsDeadlineExceeded if 'deadline' ran out first.
+  '''
+  if not breaker.allow():
+    _fast_failures.inc(reason = "breaker_open")
+    raise RideWithGpsUnavailable("RideWithGPS is unhealthy; not asking for %s" % route_id)
+
+  def outOfTime(tries):
+    # Not RideWithGPS's fault (or not provably), so the breaker isn't told,
+    # but a half-open trial has to be handed back:
+    breaker.release()
+    if tries == 0:
+      _fast_failures.inc(reason = "deadline")
+    return RideWithGpsDeadlineExceeded("Out of time asking for %s after %d tries: %s" %
+                                       (route_id, tries, last_error))
+
+  delays     = upstream.backoffDelays(Backoff_Base_Secs, Backoff_Cap_Secs)
+  last_error = None
+  for n_tries in xrange(Max_Attempts):
+    if n_tries > 0:
+      delay = min(Backoff_Cap_Secs, max(delays.next(), _retryAfterSecs(last_error)))
+      if deadline and deadline.remaining() <= delay:
+        raise outOfTime(n_tries)
+      time.sleep(delay)
+    token_wait = Max_Wait_For_Token_Secs
+    if deadline:
+      token_wait = deadline.timeout(token_wait)
+    if not rate_limiter.acquire(timeout = token_wait):
+      if deadline and deadline.expired():
+        raise outOfTime(n_tries)
+      _fast_failures.inc(reason = "rate_limited")
+      breaker.release()
+      raise RideWithGpsUnavailable("Rate limited; gave up waiting to ask for %s" % route_id)
+    timeout_secs = Timeout_Secs
+    if deadline:
+      if deadline.expired():
+        raise outOfTime(n_tries)
+      timeout_secs = deadline.timeout(timeout_secs)
+    try:
+      result = _attempt(req, n_tries + 1, timeout_secs)
+      _attempts.inc(outcome = "200")
+      breaker.recordSuccess()
+      return result
+    except Exception as e:
+      if isinstance(e, urllib2.HTTPError) and e.code == 304:
+        # Not Modified, which means the etag we passed was still current:
+        _attempts.inc(outcome = "304")
+        breaker.recordSuccess()
+        return None
+      if not _isRetryable(e):
+        if isinstance(e, urllib2.HTTPError):
+          # RideWithGPS is fine, it's the request it didn't like:
+          _attempts.inc(outcome = str(e.code))
+          breaker.recordSuccess()
+          if e.code in Unknown_Route_Codes:
+            raise RideWithGpsUnknownRoute("Unknown Route ID: %s" % route_id)
+          # e.g. a private route (401 / 403), which may not stay that way:
+          raise RideWithGpsError("RideWithGPS said %d for %s" % (e.code, route_id))
+        # Garbled responses, dropped connections and the like:
+        breaker.recordFailure()
+        raise
+      _attempts.inc(outcome = str(getattr(e, 'code', type(e).__name__)))
+      last_error = e
+      if deadline and deadline.expired():
+        raise outOfTime(n_tries + 1)
+  breaker.recordFailure()
+  raise RideWithGpsUnavailable("No data from RideWithGPS after %d tries: %s" %
+                               (Max_Attempts, last_error))
+
+def getEtagForCSV(route_id, etag = None):
   '''
       Queries RideWithGPS for the CSV file of the given route_id. Returns the
       HTTP etag header value for this route id, discarding the actual result.
+      If 'etag' is given, the request is conditional, and if 'etag' is still
+      current, the server doesn't send the body at all.
       For testing purposes only.
   '''
-  url = "http://ridewithgps.com/routes/%s.csv" % route_id
-  Max_Attempts = 3
-  for n_tries in xrange(Max_Attempts):
-    try:
-      headers = urllib2.urlopen(url, timeout = 5).info()
-      etag = headers.getheader("ETag")
-      break
-    except urllib2.HTTPError as e:
-      # Probably a 404, so don't bother retrying
-      raise RideWithGpsError("Unknown Route ID: %s" % route_id)
-    except socket.timeout as e:
-      # Timeout, let this pass:
-      pass
+  url = "%s/routes/%s.csv" % (Base_Url, route_id)
+  result = _fetch(_makeRequest(url, etag), route_id)
+  if result is not None:
+    etag = result[0]
   print "etag: %s" % etag
   return etag
 
-def getETagAndCuesheet_viaJSON(route_id, etag=None, api_key=None):
+def getETagAndCuesheet_viaJSON(route_id, etag=None, api_key=None, deadline=None):
   '''
       Queries RideWithGPS for the cue data for 'route_id'. If 'etag' is
       non-None, then 'etag' is passed to the server in the 'If-None-Match' HTTP
@@ -83,35 +377,20 @@ def getETagAndCuesheet_viaJSON(route_id, etag=None, api_key=None):
                  want a fresh copy.
       api_key  - A RWGPS api_key to use when requesting the json. For now, this
                  seems to be unnecessary, so passing 'None' is OK.
+      deadline - An upstream.Deadline to give up by, if any; see _fetch().
 
       Throws a RideWithGpsError in the event of a problem (invalid route id, etc.)
   '''
-  url = "http://ridewithgps.com/routes/%s.json?api_key=%s&version=2" % (route_id, api_key)
-  req = urllib2.Request(url)
-  if etag:
-    req.add_header("If-None-Match", etag)
-
-  raw_json = None
-  Max_Attempts = 3
-  for n_tries in xrange(Max_Attempts):
-    try:
-      resp = urllib2.urlopen(req, timeout = 5)
-      new_etag = resp.info().getheader("ETag")
-      raw_json = resp.read()
-      break
-    except urllib2.HTTPError as e:
-      # This might be a 304: Not Modified, which means the etag we passed was still current:
-      if e.code == 304:
-        # Return the original ETag, and 'None" for the cue entries, as specified:
-        return (etag, None)
-
-      # Otherwise, this is probably a 404:
-      raise RideWithGpsError("Unknown Route ID: %s" % route_id)
-    except socket.timeout as e:
-      # Timeout, let this pass:
-      pass
+  url = "%s/routes/%s.json?api_key=%s&version=2" % (Base_Url, route_id, api_key)
+  req = _makeRequest(url, etag)
+
+  result = _fetch(req, route_id, deadline)
+  if result is None:
+    # Return the original ETag, and 'None" for the cue entries, as specified:
+    return (etag, None)
+  new_etag, raw_json = result
   if not raw_json:
-    raise RideWithGpsError("No data from RideWithGPS after %d tries" % Max_Attempts)
+    raise RideWithGpsError("No data from RideWithGPS for route %s" % route_id)
 
   try:
     data = json.loads(raw_json)
@@ -195,32 +474,16 @@ def getETagAndCuesheet_viaCSV(route_id, etag=None):
 
       Throws a RideWithGpsError in the event of a problem (invalid route id, etc.)
   '''
-  url = "http://ridewithgps.com/routes/%s.csv" % route_id
-  req = urllib2.Request(url)
-  if etag:
-    req.add_header("If-None-Match", etag)
-
-  raw_csv      = None
-  Max_Attempts = 3
-  for n_tries in xrange(Max_Attempts):
-    try:
-      resp = urllib2.urlopen(req, timeout = 5)
-      new_etag = resp.info().getheader("ETag")
-      raw_csv = resp.read()
-      break
-    except urllib2.HTTPError as e:
-      # This might be a 304: Not Modified, which means the etag we passed was still current:
-      if e.code == 304:
-        # Return the original ETag, and 'None" for the cue entries, as specified:
-        return (etag, None)
-
-      # Otherwise, this is probably a 404:
-      raise RideWithGpsError("Unknown Route ID: %s" % route_id)
-    except socket.timeout as e:
-      # Timeout, let this pass:
-      pass
+  url = "%s/routes/%s.csv" % (Base_Url, route_id)
+  req = _makeRequest(url, etag)
+
+  result = _fetch(req, route_id)
+  if result is None:
+    # Return the original ETag, and 'None" for the cue entries, as specified:
+    return (etag, None)
+  new_etag, raw_csv = result
   if not raw_csv:
-    raise RideWithGpsError("No data from RideWithGPS after %d tries" % Max_Attempts)
+    raise RideWithGpsError("No data from RideWithGPS for route %s" % route_id)
 
   # Read in CSV rows:
   reader = csv.DictReader(raw_csv.split("\n"),
@@ -17,7 +17,11 @@
 import unittest
 import ridewithgps
 import cue
+import standin
+import upstream
 import tex
+import time
+import zlib
 
 class RWGPSTestCase(unittest.TestCase):
   '''Tests for Roboviva's RWGPS-facing functions'''
@@ -255,5 +259,179 @@ class RWGPSTestCase(unittest.TestCase):
     self.assertEqual(None, cues)
     self.assertEqual(Expected_ETag, etag)
 
+class StandInTestCase(unittest.TestCase):
+  '''Tests the RWGPS client against a local stand-in server'''
+
+  def setUp(self):
+    self.server = standin.StandInServer().start()
+    self.original_base_url = ridewithgps.Base_Url
+    self.original_breaker  = ridewithgps.breaker
+    self.original_backoff  = ridewithgps.Backoff_Base_Secs
+    ridewithgps.Base_Url = self.server.url
+    ridewithgps.breaker  = upstream.CircuitBreaker(failure_threshold = 2, reset_secs = 60)
+    ridewithgps.Backoff_Base_Secs = 0.001
+
+  def tearDown(self):
+    ridewithgps.Base_Url = self.original_base_url
+    ridewithgps.breaker  = self.original_breaker
+    ridewithgps.Backoff_Base_Secs = self.original_backoff
+    self.server.stop()
+
+  def test_fixtureAndETag(self):
+    etag, route = ridewithgps.getETagAndCuesheet_viaJSON(6260667)
+    self.assertEqual("Roboviva Unit Test Route", route.name)
+    self.assertEqual(["Start of route", "A", "B", "C", "End of route"],
+                     [e.description for e in route.entries])
+    self.assertEqual(cue.Modifier.QUICK, route.entries[2].modifier)
+    self.assertEqual("Custom Instruction", route.entries[3].instruction)
+
+    # Same ETag -> 304 -> no route:
+    self.assertEqual((etag, None), ridewithgps.getETagAndCuesheet_viaJSON(6260667, etag))
+
+    # Edited route -> new ETag, new route:
+    self.server.bump(6260667)
+    new_etag, route = ridewithgps.getETagAndCuesheet_viaJSON(6260667, etag)
+    self.assertNotEqual(etag, new_etag)
+    self.assertNotEqual(None, route)
+
+  def test_compression(self):
+    etag, route = ridewithgps.getETagAndCuesheet_viaJSON(42)
+    compressed_bytes = self.server.counts['bytes_sent']
+    self.server.compress = False
+    self.assertEqual((etag, None), ridewithgps.getETagAndCuesheet_viaJSON(42, etag))
+    plain_etag, plain_route = ridewithgps.getETagAndCuesheet_viaJSON(42)
+    self.assertEqual(etag, plain_etag)
+    self.assertEqual(repr(route), repr(plain_route))
+    self.assertTrue(compressed_bytes < self.server.counts['bytes_sent'] - compressed_bytes)
+
+  def test_streamDecoder(self):
+    body = "".join('{"n": "Turn right onto Main St", "d": %d}' % i for i in xrange(5000))
+    gzipper = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    raw_deflater = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    for encoding, data in (("gzip",    gzipper.compress(body) + gzipper.flush()),
+                           ("deflate", zlib.compress(body)),
+                           ("deflate", raw_deflater.compress(body) + raw_deflater.flush())):
+      decoder = ridewithgps._StreamDecoder(encoding)
+      pieces = [decoder.decompress(data[i:i + 100]) for i in xrange(0, len(data), 100)]
+      pieces.append(decoder.flush())
+      self.assertEqual(body, "".join(pieces))
+
+  def test_csv(self):
+    etag, route = ridewithgps.getETagAndCuesheet_viaCSV(6260667)
+    self.assertEqual(5, len(route.entries))
+    self.assertAlmostEqual(0.55, route.length_mi, places = 2)
+
+  def test_unknownRoute(self):
+    self.server.synthesize = False
+    self.assertRaises(ridewithgps.RideWithGpsUnknownRoute,
+                      ridewithgps.getETagAndCuesheet_viaJSON, 12345)
+    # A 404 isn't RideWithGPS's fault, so it's neither retried, nor counted
+    # against the circuit breaker:
+    self.assertEqual(1, self.server.counts['404'])
+    self.assertEqual(0, ridewithgps.breaker.failures)
+
+  def test_refusedRoutes(self):
+    # Only 404s and 410s mean there's no such route; other client errors
+    # (e.g. a private route) are plain errors, and aren't retried either:
+    for fault, error in (('gone',      ridewithgps.RideWithGpsUnknownRoute),
+                         ('forbidden', ridewithgps.RideWithGpsError)):
+      self.server.injectFault = lambda: fault
+      try:
+        ridewithgps.getETagAndCuesheet_viaJSON(6260667)
+        self.fail("No error for %s" % fault)
+      except ridewithgps.RideWithGpsError as e:
+        self.assertEqual(error, type(e))
+    self.assertEqual(1, self.server.counts['410'])
+    self.assertEqual(1, self.server.counts['403'])
+    self.assertEqual(0, ridewithgps.breaker.failures)
+
+  def test_serverErrorsRetriedThenBreakerOpens(self):
+    self.server.error_rate = 1.0
+    for i in xrange(2):
+      self.assertRaises(ridewithgps.RideWithGpsUnavailable,
+                        ridewithgps.getETagAndCuesheet_viaJSON, 6260667)
+    self.assertEqual(2 * ridewithgps.Max_Attempts, self.server.counts['500'])
+
+    # The breaker is now open, so we fail fast without asking:
+    self.assertRaises(ridewithgps.RideWithGpsUnavailable,
+                      ridewithgps.getETagAndCuesheet_viaJSON, 6260667)
+    self.assertEqual(2 * ridewithgps.Max_Attempts, self.server.counts['requests'])
+
+  def test_transientErrorsRetried(self):
+    # Fail the first attempt only:
+    self.server.injectFault = lambda: 'error' if self.server.counts['requests'] == 1 else None
+    etag, route = ridewithgps.getETagAndCuesheet_viaJSON(6260667)
+    self.assertEqual(1, self.server.counts['500'])
+    self.assertEqual(2, self.server.counts['requests'])
+
+  def test_deadline(self):
+    # A slow answer is given up on when the deadline runs out, not after
+    # Timeout_Secs:
+    self.server.latency_secs = 1.0
+    start = time.time()
+    self.assertRaises(ridewithgps.RideWithGpsDeadlineExceeded,
+                      ridewithgps.getETagAndCuesheet_viaJSON, 6260667,
+                      deadline = upstream.Deadline(0.2))
+    self.assertTrue(time.time() - start < 0.8)
+    self.assertEqual(0, ridewithgps.breaker.failures)
+
+    # ...and nothing at all is asked once it's run out:
+    self.server.latency_secs = 0
+    requests = self.server.counts['requests']
+    self.assertRaises(ridewithgps.RideWithGpsDeadlineExceeded,
+                      ridewithgps.getETagAndCuesheet_viaJSON, 6260667,
+                      deadline = upstream.Deadline(0))
+    self.assertEqual(requests, self.server.counts['requests'])
+
+  def test_halfOpenTrialReleased(self):
+    # A half-open trial that ends without a verdict mustn't leave the breaker
+    # stuck waiting for it:
+    ridewithgps.breaker = upstream.CircuitBreaker(failure_threshold = 1, reset_secs = 0.01)
+    ridewithgps.breaker.recordFailure()
+    time.sleep(0.02)
+    self.assertRaises(ridewithgps.RideWithGpsDeadlineExceeded,
+                      ridewithgps.getETagAndCuesheet_viaJSON, 6260667,
+                      deadline = upstream.Deadline(0))
+    self.assertEqual(upstream.CircuitBreaker.HALF_OPEN, ridewithgps.breaker.state)
+
+    original_limiter = ridewithgps.rate_limiter
+    original_wait    = ridewithgps.Max_Wait_For_Token_Secs
+    ridewithgps.rate_limiter = upstream.TokenBucket(rate = 0.001, burst = 1)
+    ridewithgps.rate_limiter.acquire()
+    ridewithgps.Max_Wait_For_Token_Secs = 0
+    try:
+      self.assertRaises(ridewithgps.RideWithGpsUnavailable,
+                        ridewithgps.getETagAndCuesheet_viaJSON, 6260667)
+    finally:
+      ridewithgps.rate_limiter = original_limiter
+      ridewithgps.Max_Wait_For_Token_Secs = original_wait
+    self.assertEqual(0, self.server.counts['requests'])
+
+    # ...so the next call is let through, and closes the breaker:
+    etag, route = ridewithgps.getETagAndCuesheet_viaJSON(6260667)
+    self.assertEqual(upstream.CircuitBreaker.CLOSED, ridewithgps.breaker.state)
+
+  def test_hedging(self):
+    ridewithgps.hedger = upstream.Hedger(max_rate = 1.0, initial_delay_secs = 0.05)
+    try:
+      # Stall the first request past the hedging delay:
+      self.server.injectFault = lambda: (self.server.counts['requests'] == 1 and
+                                         time.sleep(0.5))
+      etag, route = ridewithgps.getETagAndCuesheet_viaJSON(6260667)
+      self.assertEqual("Roboviva Unit Test Route", route.name)
+      self.assertEqual(1, ridewithgps.hedger.hedges_issued)
+      self.assertEqual(1, ridewithgps.hedger.hedges_won)
+    finally:
+      ridewithgps.hedger = None
+
+  def test_configureHedging(self):
+    self.assertTrue(ridewithgps.hedger is None)
+    try:
+      ridewithgps.configure({'RWGPS_HEDGE': True, 'RWGPS_HEDGE_MAX_RATE': 0.5})
+      self.assertTrue(isinstance(ridewithgps.hedger, upstream.Hedger))
+      self.assertEqual(0.5, ridewithgps.hedger.max_rate)
+    finally:
+      ridewithgps.hedger = None
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,280 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+A local store of parsed cue.Route objects, so routes can be re-rendered (e.g.
+after a renderer change) without going back to RideWithGPS, and without
+re-running the description cleanup / regex pipeline.
+
+Routes are kept one file per route id, tagged with the ETag they were fetched
+with, in a compact, versioned binary encoding:
+
+  "RVRT"                 - magic
+  u8                     - format version (Format_Version)
+  string table           - varint count, then each string as a varint
+                           length + utf-8 bytes. Every string in the route
+                           (etag, name, instructions, descriptions, notes,
+                           ...) is stored once, and referred to by index.
+  route                  - etag, route id, name (string indices; name and
+                           etag may be absent), length_mi (f64),
+                           elevation_gain_ft (optional f64)
+  entries                - varint count, then per entry: instruction,
+                           modifier, description, note, color (string
+                           indices), absolute_distance (f64), for_distance
+                           (optional f64)
+
+Optional values are preceded by a single 0 / 1 presence byte.
+'''
+
+import cue
+import os
+import struct
+import tempfile
+
+Magic          = "RVRT"
+Format_Version = 1
+File_Suffix    = ".rvr"
+
+class RouteStoreError(Exception):
+  '''Thrown when a stored route can't be decoded.'''
+  pass
+
+def _writeVarint(out, value):
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if value:
+      out.append(chr(byte | 0x80))
+    else:
+      out.append(chr(byte))
+      return
+
+class _Reader(object):
+  '''Reads the primitive types of the encoding out of a byte string.'''
+  def __init__(self, data):
+    self.data = data
+    self.pos  = 0
+
+  def take(self, n):
+    if self.pos + n > len(self.data):
+      raise RouteStoreError("Truncated route data")
+    chunk = self.data[self.pos:self.pos + n]
+    self.pos += n
+    return chunk
+
+  def byte(self):
+    return ord(self.take(1))
+
+  def varint(self):
+    value = 0
+    shift = 0
+    while True:
+      byte = self.byte()
+      value |= (byte & 0x7f) << shift
+      if not byte & 0x80:
+        return value
+      shift += 7
+
+  def double(self):
+    return struct.unpack("<d", self.take(8))[0]
+
+  def optionalDouble(self):
+    if self.byte():
+      return self.double()
+    return None
+
+class _Encoder(object):
+  def __init__(self):
+    self.strings = []
+    self.index   = {}
+    self.body    = []
+
+  def string(self, value):
+    '''Adds a (unicode or str) string reference to the body.'''
+    if isinstance(value, str):
+      value = value.decode("utf-8")
+    if value not in self.index:
+      self.index[value] = len(self.strings)
+      self.strings.append(value)
+    _writeVarint(self.body, self.index[value])
+
+  def optionalString(self, value):
+    if value is None:
+      self.body.append("\x00")
+    else:
+      self.body.append("\x01")
+      self.string(value)
+
+  def double(self, value):
+    self.body.append(struct.pack("<d", value))
+
+  def optionalDouble(self, value):
+    if value is None:
+      self.body.append("\x00")
+    else:
+      self.body.append("\x01")
+      self.double(value)
+
+  def finish(self):
+    out = [Magic, chr(Format_Version)]
+    _writeVarint(out, len(self.strings))
+    for string in self.strings:
+      encoded = string.encode("utf-8")
+      _writeVarint(out, len(encoded))
+      out.append(encoded)
+    return "".join(out + self.body)
+
+def encodeRoute(route, etag = None):
+  '''Encodes 'route' (and the ETag it was fetched with) as a byte string.'''
+  enc = _Encoder()
+  enc.optionalString(etag)
+  # Route ids are ints from the app, but strings from some callers; keep
+  # whichever we were given:
+  if isinstance(route.id, (int, long)):
+    enc.body.append("i")
+    enc.string("%d" % route.id)
+  else:
+    enc.body.append("s")
+    enc.string(route.id)
+  enc.optionalString(route.name)
+  enc.double(route.length_mi)
+  enc.optionalDouble(route.elevation_gain_ft)
+  _writeVarint(enc.body, len(route.entries))
+  for entry in route.entries:
+    enc.string(entry.instruction)
+    enc.string(entry.modifier)
+    enc.string(entry.description)
+    enc.string(entry.note)
+    enc.string(entry.color)
+    enc.double(entry.absolute_distance)
+    enc.optionalDouble(entry.for_distance)
+  return enc.finish()
+
+def decodeRoute(data):
+  '''Decodes a byte string made by encodeRoute(). Returns a 2-tuple of the
+  ETag and the cue.Route.'''
+  reader = _Reader(data)
+  if reader.take(len(Magic)) != Magic:
+    raise RouteStoreError("Not a stored route")
+  version = reader.byte()
+  if version != Format_Version:
+    raise RouteStoreError("Unsupported route format version: %d" % version)
+  strings = []
+  for i in xrange(reader.varint()):
+    strings.append(reader.take(reader.varint()).decode("utf-8"))
+
+  def string():
+    index = reader.varint()
+    if index >= len(strings):
+      raise RouteStoreError("Bad string index: %d" % index)
+    return strings[index]
+  def optionalString():
+    if reader.byte():
+      return string()
+    return None
+
+  etag = optionalString()
+  if etag is not None:
+    etag = etag.encode("utf-8")
+  id_type  = reader.take(1)
+  route_id = string()
+  if id_type == "i":
+    route_id = int(route_id)
+  else:
+    route_id = route_id.encode("utf-8")
+  name              = optionalString()
+  length_mi         = reader.double()
+  elevation_gain_ft = reader.optionalDouble()
+  entries = []
+  for i in xrange(reader.varint()):
+    instruction  = string()
+    modifier     = string()
+    description  = string()
+    note         = string()
+    color        = string()
+    distance     = reader.double()
+    for_distance = reader.optionalDouble()
+    entries.append(cue.Entry(instruction,
+                             description,
+                             distance,
+                             note,
+                             modifier,
+                             for_distance,
+                             color))
+  return (etag, cue.Route(entries,
+                          length_mi,
+                          route_id,
+                          route_name = name,
+                          elevation_gain_ft = elevation_gain_ft))
+
+class RouteStore(object):
+  '''A directory of encoded routes, one file per route id.'''
+  def __init__(self, directory):
+    self.directory = directory
+
+  def _path(self, route_id):
+    return os.path.join(self.directory, "%s%s" % (route_id, File_Suffix))
+
+  def put(self, route_id, etag, route):
+    '''Stores 'route', as fetched with 'etag', replacing any older copy.'''
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    data = encodeRoute(route, etag)
+    # Write to a temp file and rename, so readers never see half a route:
+    fd, tmp_path = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+    try:
+      with os.fdopen(fd, 'wb') as tmp_file:
+        tmp_file.write(data)
+      os.rename(tmp_path, self._path(route_id))
+    except:
+      os.unlink(tmp_path)
+      raise
+    return len(data)
+
+  def latest(self, route_id):
+    '''Returns a 2-tuple of (etag, cue.Route) for the stored copy of
+    'route_id', or None if there isn't one (or it can't be read).'''
+    try:
+      with open(self._path(route_id), 'rb') as route_file:
+        data = route_file.read()
+    except IOError:
+      return None
+    try:
+      return decodeRoute(data)
+    except RouteStoreError:
+      return None
+
+  def get(self, route_id, etag):
+    '''Returns the stored cue.Route for 'route_id', if it was fetched with
+    'etag'. Otherwise returns None.'''
+    stored = self.latest(route_id)
+    if stored is None or stored[0] != etag:
+      return None
+    return stored[1]
+
+  def remove(self, route_id):
+    try:
+      os.unlink(self._path(route_id))
+    except OSError:
+      pass
+
+  def routeIds(self):
+    '''Returns the ids of all stored routes, as strings.'''
+    if not os.path.isdir(self.directory):
+      return []
+    return [name[:-len(File_Suffix)] for name in os.listdir(self.directory)
+            if name.endswith(File_Suffix)]
@@ -0,0 +1,91 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import cPickle
+import shutil
+import tempfile
+import unittest
+import cue
+import route_store
+
+def MakeRoute(route_id = 12345):
+  entries = [ cue.Entry(cue.Instruction.NONE,  "Start of route", 0.0, for_distance = 1.0),
+              cue.Entry(cue.Instruction.RIGHT, u"Caf\xe9 St", 1.0, note = "Coffee!",
+                        modifier = cue.Modifier.QUICK, for_distance = 0.5,
+                        color = cue.Color.GRAY),
+              cue.Entry("Custom", "Main St", 1.5, for_distance = 2.5),
+              cue.Entry(cue.Instruction.RIGHT, "Main St", 4.0, for_distance = 1.0),
+              cue.Entry(cue.Instruction.NONE,  "End of route", 5.0)]
+  return cue.Route(entries, 5.0, route_id, "Test Route", 1000.5)
+
+class RouteStoreTestCase(unittest.TestCase):
+  '''Tests for the route_store library'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def assertSameRoute(self, expected, actual):
+    for attr in ("id", "name", "elevation_gain_ft", "length_mi"):
+      self.assertEqual(getattr(expected, attr), getattr(actual, attr))
+    self.assertEqual(len(expected.entries), len(actual.entries))
+    for want, got in zip(expected.entries, actual.entries):
+      self.assertEqual(vars(want), vars(got))
+
+  def test_roundTrip(self):
+    for route_id in (12345, "6260667"):
+      route = MakeRoute(route_id)
+      etag, decoded = route_store.decodeRoute(route_store.encodeRoute(route, '"abc"'))
+      self.assertEqual('"abc"', etag)
+      self.assertEqual(route_id, decoded.id)
+      self.assertSameRoute(route, decoded)
+
+  def test_optionalFields(self):
+    route = cue.Route([], 1.0, 1)
+    etag, decoded = route_store.decodeRoute(route_store.encodeRoute(route))
+    self.assertEqual(None, etag)
+    self.assertEqual(None, decoded.name)
+    self.assertEqual(None, decoded.elevation_gain_ft)
+
+  def test_compact(self):
+    route = MakeRoute()
+    self.assertTrue(len(route_store.encodeRoute(route)) < len(cPickle.dumps(route, 2)))
+
+  def test_badData(self):
+    data = route_store.encodeRoute(MakeRoute())
+    self.assertRaises(route_store.RouteStoreError, route_store.decodeRoute, "nope")
+    self.assertRaises(route_store.RouteStoreError, route_store.decodeRoute, data[:-3])
+    future = data[:4] + chr(route_store.Format_Version + 1) + data[5:]
+    self.assertRaises(route_store.RouteStoreError, route_store.decodeRoute, future)
+
+  def test_store(self):
+    store = route_store.RouteStore(self.directory + "/routes")
+    self.assertEqual(None, store.latest(12345))
+    self.assertEqual([], store.routeIds())
+    store.put(12345, '"v1"', MakeRoute())
+    store.put(12345, '"v2"', MakeRoute())
+    self.assertEqual(["12345"], store.routeIds())
+    self.assertEqual('"v2"', store.latest(12345)[0])
+    self.assertEqual(None, store.get(12345, '"v1"'))
+    self.assertSameRoute(MakeRoute(), store.get(12345, '"v2"'))
+    store.remove(12345)
+    self.assertEqual(None, store.latest(12345))
+
+if __name__ == '__main__':
+  unittest.main()
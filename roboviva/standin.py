@@ -0,0 +1,267 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+A local stand-in for ridewithgps.com, for load testing and offline tests.
+
+Serves /routes/<id>.json and /routes/<id>.csv from the recorded fixtures in
+roboviva/fixtures/, or, for route ids without a fixture, from a synthetic
+route generated deterministically from the id. Responses carry an ETag, and
+honor If-None-Match with a 304, like the real thing.
+
+Responses are gzip or deflate compressed if the client asks for it (and
+'compress' is on), and the bytes actually sent are counted, so the effect of
+compression can be measured.
+
+Latency, errors and timeouts can be injected, to see how Roboviva behaves
+when RideWithGPS is having a bad day. Routes can be "edited" (have their ETag
+bumped) by requesting /_standin/bump/<id>.
+
+Usage:
+  server = standin.StandInServer(port = 0, latency_secs = 0.05)
+  server.start()
+  ... point ridewithgps.Base_Url at server.url ...
+  server.stop()
+'''
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import urlparse
+import zlib
+
+Fixture_Dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+_Meters_Per_Mile = 1609.344
+_Instructions    = ["Left", "Right", "Right", "Left", "Straight", "Food", "Danger", "Summit"]
+_Streets         = ["Main St", "Pine St", "Oak Ave", "County Rd %d", "Hwy %d", "Mill Rd",
+                    "River Rd", "Old Stage Rd", "Ridge Rd", "Church St"]
+
+def syntheticRoute(route_id, revision = 0, n_cues = 60):
+  '''Returns the RWGPS JSON export (as a dict) of a made-up, but realistic,
+  route, generated deterministically from 'route_id' and 'revision'.'''
+  rng = random.Random("%s-%s" % (route_id, revision))
+  course_points = []
+  distance_m = 0.0
+  for i in xrange(n_cues):
+    distance_m += rng.uniform(50, 8000)
+    instruction = rng.choice(_Instructions)
+    street = rng.choice(_Streets)
+    if '%d' in street:
+      street = street % rng.randint(1, 200)
+    point = { 't' : instruction, 'n' : "Turn %s onto %s" % (instruction.lower(), street),
+              'd' : distance_m }
+    if rng.random() < 0.1:
+      point['description'] = "Watch out for *gravel* & potholes"
+    course_points.append(point)
+  return { 'route' : { 'id'            : route_id,
+                       'name'          : "Synthetic Route %s (rev %d)" % (route_id, revision),
+                       'metrics'       : { 'distance' : distance_m + 500,
+                                           'ele_gain' : rng.uniform(0, 3000) },
+                       'course_points' : course_points } }
+
+def _jsonToCSV(data):
+  '''Converts a RWGPS JSON export into the equivalent CSV export.'''
+  route = data['route']
+  lines = ["Type,Notes,Distance From Start,Elevation,Description",
+           "Generic,Start of route,0.0,0.0,"]
+  for point in route['course_points']:
+    lines.append('%s,"%s",%.2f,0.0,"%s"' % (point['t'],
+                                             point.get('n', ''),
+                                             point['d'] / _Meters_Per_Mile,
+                                             point.get('description', '')))
+  lines.append("Generic,End of route,%.2f,0.0," %
+               (route['metrics']['distance'] / _Meters_Per_Mile))
+  return "\n".join(lines) + "\n"
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  '''A threaded HTTP server that pretends to be ridewithgps.com.'''
+  daemon_threads      = True
+  allow_reuse_address = True
+
+  def __init__(self,
+               port          = 0,
+               latency_secs  = 0.0,
+               jitter_secs   = 0.0,
+               error_rate    = 0.0,
+               timeout_rate  = 0.0,
+               timeout_secs  = 10.0,
+               synthesize    = True,
+               n_cues        = 60,
+               compress      = True):
+    '''
+      port         - Port to listen on (on localhost). 0 picks a free one.
+      latency_secs - Delay added to every response.
+      jitter_secs  - Random extra delay, uniform in [0, jitter_secs].
+      error_rate   - Fraction of requests answered with a 500.
+      timeout_rate - Fraction of requests that stall for 'timeout_secs'
+                     before answering (i.e. past the client's timeout).
+      synthesize   - If True, route ids without a fixture get a synthetic
+                     route. Otherwise they 404.
+      n_cues       - Number of cues in synthetic routes.
+      compress     - If True, honor the client's Accept-Encoding.
+    '''
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _StandInHandler)
+    self.latency_secs = latency_secs
+    self.jitter_secs  = jitter_secs
+    self.error_rate   = error_rate
+    self.timeout_rate = timeout_rate
+    self.timeout_secs = timeout_secs
+    self.synthesize   = synthesize
+    self.n_cues       = n_cues
+    self.compress     = compress
+    self.revisions    = {}
+    self.counts       = { 'requests' : 0, '200' : 0, '304' : 0, '404' : 0,
+                          '403' : 0, '410' : 0, '500' : 0, 'timeouts' : 0,
+                          'garbled' : 0, 'bytes_sent' : 0 }
+    self._lock        = threading.Lock()
+    self._rng         = random.Random()
+    self._thread      = None
+
+  @property
+  def url(self):
+    return "http://%s:%d" % self.server_address
+
+  def start(self):
+    '''Starts serving on a background thread.'''
+    self._thread = threading.Thread(target = self.serve_forever, name = "rwgps-standin")
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def count(self, what, amount = 1):
+    with self._lock:
+      self.counts[what] += amount
+
+  def bump(self, route_id):
+    '''Simulates an edit of 'route_id', changing its content and ETag.'''
+    with self._lock:
+      self.revisions[route_id] = self.revisions.get(route_id, 0) + 1
+
+  def body(self, route_id, fmt):
+    '''Returns the response body for 'route_id' in format 'fmt' ('json' or
+    'csv'), or None if the route doesn't exist.'''
+    revision = self.revisions.get(route_id, 0)
+    fixture = os.path.join(Fixture_Dir, "%s.%s" % (route_id, fmt))
+    if revision == 0 and os.path.exists(fixture):
+      with open(fixture, 'rb') as fixture_file:
+        return fixture_file.read()
+    if not self.synthesize:
+      return None
+    data = syntheticRoute(route_id, revision, self.n_cues)
+    if fmt == 'json':
+      return json.dumps(data)
+    return _jsonToCSV(data)
+
+  def injectFault(self):
+    '''Sleeps for the configured latency, and returns 'timeout' or 'error' if
+    this request should fail, or None if it should succeed. (Tests can
+    replace it, and also return 'garbled', for a connection closed without
+    any response at all, 'forbidden' for a 403, or 'gone' for a 410.)'''
+    delay = self.latency_secs
+    if self.jitter_secs:
+      delay += self._rng.uniform(0, self.jitter_secs)
+    if delay:
+      time.sleep(delay)
+    roll = self._rng.random()
+    if roll < self.timeout_rate:
+      return 'timeout'
+    if roll < self.timeout_rate + self.error_rate:
+      return 'error'
+    return None
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  _Route_Re = re.compile(r'^/routes/(\d+)\.(json|csv)$')
+  _Bump_Re  = re.compile(r'^/_standin/bump/(\d+)$')
+
+  def log_message(self, *args):
+    # Keep quiet; load tests make a *lot* of requests.
+    pass
+
+  def _respond(self, code, body = "", headers = ()):
+    self.server.count(str(code))
+    self.send_response(code)
+    for name, value in headers:
+      self.send_header(name, value)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      # Count first, so the client never sees the body before it's counted:
+      self.server.count('bytes_sent', len(body))
+      self.wfile.write(body)
+
+  def do_HEAD(self):
+    self.do_GET()
+
+  def do_GET(self):
+    self.server.count('requests')
+    path = urlparse.urlparse(self.path).path
+
+    m = self._Bump_Re.match(path)
+    if m:
+      self.server.bump(int(m.group(1)))
+      return self._respond(200, "bumped\n")
+
+    m = self._Route_Re.match(path)
+    if not m:
+      return self._respond(404, "Not found\n")
+    route_id, fmt = int(m.group(1)), m.group(2)
+
+    fault = self.server.injectFault()
+    if fault == 'timeout':
+      self.server.count('timeouts')
+      time.sleep(self.server.timeout_secs)
+    elif fault == 'error':
+      return self._respond(500, "Internal Server Error\n")
+    elif fault == 'forbidden':
+      return self._respond(403, "Forbidden\n")
+    elif fault == 'gone':
+      return self._respond(410, "Gone\n")
+    elif fault == 'garbled':
+      self.server.count('garbled')
+      self.close_connection = 1
+      return
+
+    body = self.server.body(route_id, fmt)
+    if body is None:
+      return self._respond(404, "Not found\n")
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+    if self.headers.getheader("If-None-Match") == etag:
+      return self._respond(304, "", [("ETag", etag)])
+    content_type = 'application/json' if fmt == 'json' else 'text/csv'
+    headers = [("ETag", etag), ("Content-Type", content_type), ("Vary", "Accept-Encoding")]
+    accept_encoding = self.headers.getheader("Accept-Encoding") or ""
+    encodings = [e.split(";")[0].strip() for e in accept_encoding.split(",")]
+    if self.server.compress and 'gzip' in encodings:
+      compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      body = compressor.compress(body) + compressor.flush()
+      headers.append(("Content-Encoding", "gzip"))
+    elif self.server.compress and 'deflate' in encodings:
+      body = zlib.compress(body)
+      headers.append(("Content-Encoding", "deflate"))
+    return self._respond(200, body, headers)
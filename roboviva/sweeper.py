@@ -0,0 +1,72 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Bulk revalidation of cached routes.
+
+Asks RideWithGPS, with conditional (If-None-Match) requests, whether each
+cached route has changed, from a few worker threads and within a
+requests-per-second budget, so a sweep never crowds out live traffic. Only
+the routes that did change come back with their new cue data, ready to be
+re-rendered.
+'''
+
+import Queue
+import threading
+
+import upstream
+
+def revalidate(entries, fetch, workers = 4, rate = 2.0):
+  '''
+  Revalidates each (route_id, etag) pair in 'entries' by calling
+  fetch(route_id, etag), which should behave like
+  ridewithgps.getETagAndCuesheet_viaJSON(): return the current ETag, plus the
+  route if it changed, or None if it didn't.
+
+  At most 'workers' fetches are in flight at once, and at most 'rate' are
+  started per second (0: no limit). Yields a 4-tuple of (route_id, etag,
+  route, error) as each answer comes in, in no particular order: 'route' is
+  None for unchanged routes, and 'error' is the exception, if the fetch
+  failed.
+  '''
+  todo = Queue.Queue()
+  for entry in entries:
+    todo.put(entry)
+  n_entries = todo.qsize()
+  done = Queue.Queue()
+  bucket = upstream.TokenBucket(rate, 1) if rate > 0 else None
+
+  def work():
+    while True:
+      try:
+        route_id, etag = todo.get_nowait()
+      except Queue.Empty:
+        return
+      if bucket:
+        bucket.acquire()
+      try:
+        new_etag, route = fetch(route_id, etag)
+        done.put((route_id, new_etag, route, None))
+      except Exception as e:
+        done.put((route_id, etag, None, e))
+
+  for _ in xrange(min(workers, n_entries)):
+    worker = threading.Thread(target = work, name = "sweeper")
+    worker.daemon = True
+    worker.start()
+  for _ in xrange(n_entries):
+    yield done.get()
@@ -0,0 +1,66 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import unittest
+import sweeper
+
+class SweeperTestCase(unittest.TestCase):
+  '''Tests for the sweeper library'''
+
+  def test_revalidate(self):
+    def fetch(route_id, etag):
+      if route_id == 3:
+        raise ValueError("no such route")
+      if route_id == 2:
+        return ('"new"', "route 2")
+      return (etag, None)
+    results = sorted(sweeper.revalidate([(1, '"a"'), (2, '"b"'), (3, '"c"')], fetch))
+    self.assertEqual((1, '"a"', None, None), results[0])
+    self.assertEqual((2, '"new"', "route 2", None), results[1])
+    self.assertEqual(3, results[2][0])
+    self.assertTrue(isinstance(results[2][3], ValueError))
+
+  def test_empty(self):
+    self.assertEqual([], list(sweeper.revalidate([], None)))
+
+  def test_boundedConcurrency(self):
+    lock = threading.Lock()
+    in_flight = [0, 0] # current, max
+    def fetch(route_id, etag):
+      with lock:
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+      time.sleep(0.01)
+      with lock:
+        in_flight[0] -= 1
+      return (etag, None)
+    entries = [(i, '"x"') for i in range(20)]
+    self.assertEqual(20, len(list(sweeper.revalidate(entries, fetch, workers = 3, rate = 0))))
+    self.assertTrue(in_flight[1] <= 3)
+
+  def test_rateLimited(self):
+    entries = [(i, '"x"') for i in range(5)]
+    start = time.time()
+    list(sweeper.revalidate(entries, lambda route_id, etag: (etag, None),
+                            workers = 5, rate = 50))
+    # One token up front, then 50/s:
+    self.assertTrue(time.time() - start >= 0.07)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -89,6 +89,11 @@ import shutil
 import string
 import subprocess
 import tempfile
+import time
+import tracing
+
+# How often to check on a TeX run that has a deadline:
+_POLL_SECS = 0.02
 
 def _file_read(filename):
     '''Read the content of a file and close it properly.'''
@@ -103,10 +108,45 @@ def _file_write(filename, content):
     f.write(content)
     f.close()
 
-def convert(tex_source, input_format, output_format, max_runs=5):
-    '''Convert LaTeX or TeX source to PDF or DVI.'''
+def _file_write_chunks(filename, chunks):
+    '''Write an iterable of unicode chunks into a file as UTF-8, one chunk at
+    a time, and close it properly.'''
+    f = file(filename, 'wb')
+    try:
+        for chunk in chunks:
+            assert isinstance(chunk, unicode)
+            f.write(chunk.encode('UTF-8'))
+    finally:
+        f.close()
+
+def convert(tex_source, input_format, output_format, max_runs=5, stats=None,
+            files=None, single_pass=False, deadline=None):
+    '''Convert LaTeX or TeX source to PDF or DVI.
+
+    `tex_source` is either a unicode object, or an iterable (e.g. a generator)
+    of unicode chunks, which are streamed into the source file without ever
+    being joined in memory.
+
+    `files` optionally maps file names to (byte string) contents, to be
+    placed next to the source file, e.g. PDFs for \includepdf.
+
+    If `single_pass` is true, the output of the first run is returned,
+    without waiting for cross-references (e.g. page counts) to settle. Only
+    use this for documents that don't have any.
+
+    `deadline` optionally limits how long the conversion may take; it's
+    anything with a remaining() method giving the seconds left (e.g. an
+    upstream.Deadline). A TeX run that's still going when it runs out is
+    killed, and a ValueError raised. If there isn't time for another run to
+    let cross-references settle, the output so far is returned instead.
+
+    If `stats` is a dict, the number of TeX runs made is stored in
+    stats['runs'], even if the conversion fails, and the final contents of
+    the .aux file (e.g. to look up labels) in stats['aux']. stats['settled']
+    is set to False if a run was skipped for lack of time, else True.'''
     # check arguments
-    assert isinstance(tex_source, unicode)
+    if isinstance(tex_source, unicode):
+        tex_source = [tex_source]
     try:
         (tex_cmd, output_suffix) = {
             ('tex',   'dvi'): ('tex',      '.dvi'),
@@ -119,38 +159,80 @@ def convert(tex_source, input_format, output_format, max_runs=5):
                          % (input_format, output_format))
     if max_runs < 2:
         raise ValueError('max_runs must be at least 2.')
+    with tracing.span('tex.convert', command=tex_cmd):
+        return _convert(tex_source, tex_cmd, output_suffix, max_runs, stats,
+                        files or {}, single_pass, deadline)
+
+def _wait(tex_process, tex_cmd, deadline):
+    '''Waits for `tex_process` to finish, killing it (and raising a
+    ValueError) if `deadline` runs out first.'''
+    if deadline is None:
+        tex_process.wait()
+        return
+    while tex_process.poll() is None:
+        if deadline.remaining() <= 0:
+            tex_process.kill()
+            tex_process.wait()
+            raise ValueError('%s ran out of time' % tex_cmd)
+        time.sleep(min(_POLL_SECS, deadline.remaining()))
+
+def _convert(tex_source, tex_cmd, output_suffix, max_runs, stats, files,
+             single_pass, deadline):
+    '''Does the actual work of convert(), once the arguments are checked.'''
     # create temporary directory
     tex_dir = tempfile.mkdtemp(suffix='', prefix='tex-temp-')
     try:
+        # write any supporting files
+        for filename, content in files.items():
+            if os.path.basename(filename) != filename:
+                raise ValueError('Supporting files must be plain file names: %s'
+                                 % filename)
+            _file_write(os.path.join(tex_dir, filename), content)
         # create LaTeX source file
         tex_filename = os.path.join(tex_dir, 'texput.tex')
-        _file_write(tex_filename, tex_source.encode('UTF-8'))
+        _file_write_chunks(tex_filename, tex_source)
         # run LaTeX processor as often as necessary
         aux_old = None
+        run_secs = 0
         for i in xrange(max_runs):
-            tex_process = subprocess.Popen(
-                [tex_cmd,
-                    '-interaction=batchmode',
-                    '-halt-on-error',
-                    '-no-shell-escape',
-                    tex_filename,
-                ],
-                stdin=file(os.devnull, 'r'),
-                stdout=file(os.devnull, 'w'),
-                stderr=subprocess.STDOUT,
-                close_fds=True,
-                shell=False,
-                cwd=tex_dir,
-                env={'PATH' : os.getenv('PATH'),
-                     'HOME' : os.getenv('HOME')},
-            )
-            tex_process.wait()
+            if i > 0 and deadline is not None and deadline.remaining() < run_secs:
+                # Another run probably wouldn't finish in time, and the
+                # output we have is better than none:
+                if stats is not None:
+                    stats['aux'] = aux_old
+                    stats['settled'] = False
+                return _file_read(os.path.join(tex_dir, 'texput' + output_suffix))
+            if stats is not None:
+                stats['runs'] = i + 1
+            run_start = time.time()
+            with tracing.span('tex.run', run=i + 1):
+                tex_process = subprocess.Popen(
+                    [tex_cmd,
+                        '-interaction=batchmode',
+                        '-halt-on-error',
+                        '-no-shell-escape',
+                        tex_filename,
+                    ],
+                    stdin=file(os.devnull, 'r'),
+                    stdout=file(os.devnull, 'w'),
+                    stderr=subprocess.STDOUT,
+                    close_fds=True,
+                    shell=False,
+                    cwd=tex_dir,
+                    env={'PATH' : os.getenv('PATH'),
+                         'HOME' : os.getenv('HOME')},
+                )
+                _wait(tex_process, tex_cmd, deadline)
+            run_secs = time.time() - run_start
             if tex_process.returncode != 0:
                 log = _file_read(os.path.join(tex_dir, 'texput.log'))
                 raise ValueError(log)
             aux = _file_read(os.path.join(tex_dir, 'texput.aux'))
-            if aux == aux_old:
-                # aux file stabilized
+            if aux == aux_old or single_pass:
+                # aux file stabilized (or we were told not to wait for it)
+                if stats is not None:
+                    stats['aux'] = aux
+                    stats['settled'] = True
                 try:
                     return _file_read(os.path.join(tex_dir, 'texput' + output_suffix))
                 except:
@@ -0,0 +1,149 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Lightweight request tracing. A Trace is started when a request comes in, and
+becomes the "current" trace for that thread; any code running on its behalf
+(the RideWithGPS fetch, the latex build, the pdflatex runs, the cache write)
+can then wrap its work in span(), without having to be handed the trace
+explicitly.
+
+A trace can be shared by several threads (see activate()), but each thread
+keeps its own stack of open spans, so spans running at the same time on
+different threads never become each other's parents.
+
+Each finished span is emitted as a single line of JSON on the
+'roboviva.trace' logger, with the trace id, span id, parent span id, and
+start / end times, so a request's waterfall can be rebuilt from the log files
+of every process it touched.
+'''
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+'''The HTTP header used to pass trace ids between processes'''
+Trace_Header = "X-Roboviva-Trace-Id"
+
+_log   = logging.getLogger("roboviva.trace")
+_local = threading.local()
+
+def newId():
+  '''Returns a new, random trace / span id.'''
+  return uuid.uuid4().hex[:16]
+
+class Trace(object):
+  '''A single traced request: an id, some attributes common to all of its
+  spans (e.g. route_id), and the spans recorded so far. Spans that end after
+  the trace has finished (e.g. a losing hedged request) are logged, but not
+  added to 'spans'.'''
+  def __init__(self, trace_id = None, **attrs):
+    self.trace_id = trace_id or newId()
+    self.attrs    = attrs
+    self.spans    = []
+    self.finished = False
+
+  def stageTimings(self):
+    '''Returns a list of (span name, duration in seconds) for every finished
+    span, in the order they finished.'''
+    return [(s['name'], s['duration']) for s in self.spans]
+
+def current():
+  '''Returns the Trace active on this thread, or None.'''
+  return getattr(_local, 'trace', None)
+
+def _spanStack():
+  '''Returns this thread's stack of open span ids.'''
+  stack = getattr(_local, 'stack', None)
+  if stack is None:
+    stack = _local.stack = []
+  return stack
+
+def currentSpanId():
+  '''Returns the id of the innermost open span on this thread, or None.'''
+  stack = _spanStack()
+  return stack[-1] if stack else None
+
+def start(trace_id = None, **attrs):
+  '''Starts a new Trace, and makes it the current trace for this thread.'''
+  trace = Trace(trace_id, **attrs)
+  _local.trace = trace
+  _local.stack = []
+  return trace
+
+def finish():
+  '''Ends the current trace on this thread, returning it.'''
+  trace = current()
+  if trace is not None:
+    trace.finished = True
+  _local.trace = None
+  _local.stack = []
+  return trace
+
+@contextlib.contextmanager
+def activate(trace, parent_id = None):
+  '''Makes 'trace' the current trace for the duration of the block, with
+  spans started in it children of the span 'parent_id'. Use this to carry a
+  trace over into a worker thread, taking 'trace' and 'parent_id' from
+  current() and currentSpanId() on the thread handing the work over.'''
+  previous = (current(), getattr(_local, 'stack', None))
+  _local.trace = trace
+  _local.stack = [parent_id] if parent_id else []
+  try:
+    yield trace
+  finally:
+    _local.trace, _local.stack = previous
+
+@contextlib.contextmanager
+def span(name, **attrs):
+  '''Records the block as a span named 'name' of the current trace. Does
+  nothing if there is no current trace. Yields the span's record (a dict), so
+  callers can attach extra attributes to it as they go.'''
+  trace = current()
+  if trace is None:
+    yield {}
+    return
+
+  record = { 'trace_id'  : trace.trace_id,
+             'span_id'   : newId(),
+             'parent_id' : currentSpanId(),
+             'name'      : name,
+             'pid'       : os.getpid(),
+             'thread'    : threading.current_thread().name }
+  record.update(trace.attrs)
+  record.update(attrs)
+  stack = _spanStack()
+  stack.append(record['span_id'])
+  record['start'] = time.time()
+  try:
+    yield record
+  except Exception as e:
+    record['error'] = "%s: %s" % (type(e).__name__, e)
+    raise
+  finally:
+    record['end']      = time.time()
+    record['duration'] = record['end'] - record['start']
+    stack.pop()
+    if trace.finished:
+      record['late'] = True
+    else:
+      trace.spans.append(record)
+    _log.info(json.dumps(record, sort_keys = True, default = str))
@@ -0,0 +1,126 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import threading
+import unittest
+import tracing
+
+class _ListHandler(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(json.loads(record.getMessage()))
+
+class TracingTestCase(unittest.TestCase):
+  '''Tests for the tracing library'''
+
+  def setUp(self):
+    self.handler = _ListHandler()
+    self.logger  = logging.getLogger("roboviva.trace")
+    self.logger.addHandler(self.handler)
+    self.logger.setLevel(logging.INFO)
+
+  def tearDown(self):
+    self.logger.removeHandler(self.handler)
+    tracing.finish()
+
+  def test_noTrace(self):
+    # Spans outside of a trace are no-ops:
+    with tracing.span("foo") as span:
+      span['bar'] = 1
+    self.assertEqual([], self.handler.records)
+
+  def test_nestedSpans(self):
+    trace = tracing.start("abc", route_id = 123)
+    with tracing.span("outer"):
+      with tracing.span("inner", attempt = 1) as span:
+        span['bytes'] = 10
+    self.assertTrue(trace is tracing.finish())
+    self.assertEqual(None, tracing.current())
+
+    inner, outer = self.handler.records
+    self.assertEqual("inner", inner['name'])
+    self.assertEqual("outer", outer['name'])
+    self.assertEqual("abc", inner['trace_id'])
+    self.assertEqual(123,   inner['route_id'])
+    self.assertEqual(1,     inner['attempt'])
+    self.assertEqual(10,    inner['bytes'])
+    self.assertEqual(outer['span_id'], inner['parent_id'])
+    self.assertEqual(None, outer['parent_id'])
+    self.assertTrue(outer['start'] <= inner['start'] <= inner['end'] <= outer['end'])
+    self.assertEqual(["inner", "outer"], [n for n, d in trace.stageTimings()])
+
+  def test_errorsAreRecorded(self):
+    tracing.start()
+    def fail():
+      with tracing.span("fail"):
+        raise ValueError("oops")
+    self.assertRaises(ValueError, fail)
+    self.assertEqual("ValueError: oops", self.handler.records[0]['error'])
+
+  def test_activate(self):
+    trace = tracing.Trace()
+    with tracing.activate(trace):
+      self.assertTrue(trace is tracing.current())
+    self.assertEqual(None, tracing.current())
+
+  def test_threadsKeepTheirOwnSpans(self):
+    # Overlapping spans on two threads sharing a trace are both children of
+    # the span that handed the work over, not of each other:
+    trace = tracing.start()
+    started = [threading.Event(), threading.Event()]
+    def work(name, parent_id, mine, other):
+      with tracing.activate(trace, parent_id):
+        with tracing.span(name):
+          started[mine].set()
+          started[other].wait(5)
+          with tracing.span(name + ".child"):
+            pass
+    with tracing.span("request"):
+      parent_id = tracing.currentSpanId()
+      threads = [threading.Thread(target = work, args = ("a", parent_id, 0, 1)),
+                 threading.Thread(target = work, args = ("b", parent_id, 1, 0))]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    spans = dict((record['name'], record) for record in self.handler.records)
+    self.assertEqual(parent_id, spans["request"]['span_id'])
+    self.assertEqual(parent_id, spans["a"]['parent_id'])
+    self.assertEqual(parent_id, spans["b"]['parent_id'])
+    self.assertEqual(spans["a"]['span_id'], spans["a.child"]['parent_id'])
+    self.assertEqual(spans["b"]['span_id'], spans["b.child"]['parent_id'])
+    # ...and the handing-over thread's stack is untouched:
+    self.assertEqual(None, tracing.currentSpanId())
+
+  def test_lateSpans(self):
+    # Spans that end after their trace has finished are logged, but aren't
+    # part of it any more:
+    trace = tracing.start()
+    tracing.finish()
+    with tracing.activate(trace):
+      with tracing.span("late"):
+        pass
+    self.assertEqual([], trace.spans)
+    self.assertTrue(self.handler.records[0]['late'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,289 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Tools for being a good (and robust) client of an upstream service: jittered
+exponential backoff, a token-bucket rate limiter, a circuit breaker, hedged
+requests, and deadlines.
+'''
+
+import Queue
+import collections
+import random
+import threading
+import time
+
+def backoffDelays(base_secs, cap_secs, rng = random):
+  '''
+  Generates an endless sequence of retry delays, using exponential backoff
+  with "full jitter": the n'th delay is uniform in
+  [0, min(cap_secs, base_secs * 2**n)].
+  '''
+  n = 0
+  while True:
+    yield rng.uniform(0, min(cap_secs, base_secs * (2 ** n)))
+    n += 1
+
+class TokenBucket(object):
+  '''A thread-safe token-bucket rate limiter: allows bursts of up to 'burst'
+  requests, refilled at 'rate' tokens per second.'''
+  def __init__(self, rate, burst):
+    if rate <= 0 or burst < 1:
+      raise ValueError("rate must be positive, and burst at least 1")
+    self.rate    = float(rate)
+    self.burst   = float(burst)
+    self._tokens = float(burst)
+    self._last   = time.time()
+    self._lock   = threading.Lock()
+
+  def _refill(self, now):
+    self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+    self._last   = now
+
+  def tryAcquire(self):
+    '''Takes a token if one is available. Returns True if it got one.'''
+    with self._lock:
+      self._refill(time.time())
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return True
+      return False
+
+  def acquire(self, timeout = None):
+    '''Waits until a token is available (or 'timeout' seconds pass) and takes
+    it. Returns True if it got a token, False if it timed out.'''
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      with self._lock:
+        now = time.time()
+        self._refill(now)
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return True
+        wait = (1 - self._tokens) / self.rate
+      if deadline is not None:
+        if now + wait > deadline:
+          return False
+      time.sleep(wait)
+
+class CircuitBreaker(object):
+  '''
+  Stops calling an upstream service that keeps failing.
+
+  'closed'    - Normal operation. After 'failure_threshold' consecutive
+                failures, the breaker opens.
+  'open'      - Calls fail fast for 'reset_secs'. After that, the breaker is
+                half open.
+  'half_open' - A single trial call is let through. If it succeeds the breaker
+                closes; if it fails, it opens again.
+  '''
+  CLOSED    = 'closed'
+  OPEN      = 'open'
+  HALF_OPEN = 'half_open'
+
+  def __init__(self, failure_threshold, reset_secs):
+    self.failure_threshold = failure_threshold
+    self.reset_secs        = reset_secs
+    self.failures          = 0
+    self.times_opened      = 0
+    self._opened_at        = None
+    self._trial_running    = False
+    self._lock             = threading.Lock()
+
+  @property
+  def state(self):
+    if self._opened_at is None:
+      return self.CLOSED
+    if time.time() - self._opened_at < self.reset_secs:
+      return self.OPEN
+    return self.HALF_OPEN
+
+  def allow(self):
+    '''Returns True if a call should be attempted right now.'''
+    with self._lock:
+      state = self.state
+      if state == self.CLOSED:
+        return True
+      if state == self.HALF_OPEN and not self._trial_running:
+        self._trial_running = True
+        return True
+      return False
+
+  def recordSuccess(self):
+    with self._lock:
+      self.failures       = 0
+      self._opened_at     = None
+      self._trial_running = False
+
+  def recordFailure(self):
+    with self._lock:
+      self.failures += 1
+      if self._trial_running or self.failures >= self.failure_threshold:
+        if self._opened_at is None or self._trial_running:
+          self.times_opened += 1
+        self._opened_at     = time.time()
+        self._trial_running = False
+
+  def release(self):
+    '''Ends a call let through by allow() without a verdict either way (e.g.
+    the caller ran out of time, or was rate limited). If it was the half-open
+    trial, the next call becomes the trial instead.'''
+    with self._lock:
+      self._trial_running = False
+
+class LatencyTracker(object):
+  '''Remembers the last 'size' latencies seen, and computes percentiles
+  over them.'''
+  def __init__(self, size = 1000):
+    self._samples = collections.deque(maxlen = size)
+    self._lock    = threading.Lock()
+
+  def record(self, latency_secs):
+    with self._lock:
+      self._samples.append(latency_secs)
+
+  def __len__(self):
+    return len(self._samples)
+
+  def percentile(self, fraction):
+    '''Returns the 'fraction' (0.0 - 1.0) percentile of the recorded
+    latencies, or None if nothing has been recorded yet.'''
+    with self._lock:
+      samples = sorted(self._samples)
+    if not samples:
+      return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+class Hedger(object):
+  '''
+  Hedged requests: if a call hasn't finished within the recent 'percentile'
+  latency, a second, identical call is started, and whichever finishes first
+  with a usable result wins. The losing call is left to finish (and be
+  ignored) in the background.
+
+  To keep hedging from doubling the load on a struggling upstream, at most
+  'max_rate' of all calls are hedged, and until 'min_samples' latencies have
+  been seen, 'initial_delay_secs' is used as the hedging delay.
+  '''
+  def __init__(self,
+               percentile         = 0.95,
+               max_rate           = 0.05,
+               min_delay_secs     = 0.01,
+               initial_delay_secs = 1.0,
+               min_samples        = 20):
+    self.percentile         = percentile
+    self.max_rate           = max_rate
+    self.min_delay_secs     = min_delay_secs
+    self.initial_delay_secs = initial_delay_secs
+    self.min_samples        = min_samples
+    self.latencies          = LatencyTracker()
+    self.calls              = 0
+    self.hedges_issued      = 0
+    self.hedges_won         = 0
+    self._lock              = threading.Lock()
+
+  def delay(self):
+    '''Returns how long to wait for the first call before hedging.'''
+    if len(self.latencies) < self.min_samples:
+      return self.initial_delay_secs
+    return max(self.min_delay_secs, self.latencies.percentile(self.percentile))
+
+  def _allowHedge(self, may_hedge):
+    with self._lock:
+      if self.hedges_issued + 1 > self.max_rate * self.calls:
+        return False
+    if not may_hedge():
+      return False
+    with self._lock:
+      self.hedges_issued += 1
+    return True
+
+  def _start(self, fn, which, results):
+    def run():
+      start = time.time()
+      try:
+        value = fn()
+      except Exception as e:
+        results.put((which, None, e))
+        return
+      self.latencies.record(time.time() - start)
+      results.put((which, value, None))
+    thread = threading.Thread(target = run, name = "hedge-%s" % which)
+    thread.daemon = True
+    thread.start()
+
+  def call(self, fn, is_usable_error = lambda error: False, may_hedge = lambda: True):
+    '''
+    Calls fn(), possibly twice, and returns the first usable result, or
+    raises the first usable exception.
+
+    is_usable_error - Given an exception raised by fn(), returns True if it's
+                      a definitive answer (e.g. a 404) rather than a failure
+                      worth waiting on the other call for.
+    may_hedge       - Called right before hedging; returning False skips the
+                      hedge (e.g. if a rate limiter has no tokens to spare).
+    '''
+    with self._lock:
+      self.calls += 1
+    results = Queue.Queue()
+    self._start(fn, 'primary', results)
+    outstanding = 1
+    try:
+      result = results.get(timeout = self.delay())
+    except Queue.Empty:
+      if self._allowHedge(may_hedge):
+        self._start(fn, 'hedge', results)
+        outstanding += 1
+      result = results.get()
+    outstanding -= 1
+
+    which, value, error = result
+    while error is not None and not is_usable_error(error) and outstanding > 0:
+      # This one failed, but the other might not:
+      which, value, error = results.get()
+      outstanding -= 1
+
+    if which == 'hedge':
+      with self._lock:
+        self.hedges_won += 1
+    if error is not None:
+      raise error
+    return value
+
+class Deadline(object):
+  '''
+  The time by which a piece of work (e.g. a request, and everything it asks
+  of RideWithGPS and pdflatex) has to be done, 'budget_secs' from now. Hand
+  the same Deadline to every part of the work, and each can size its own
+  timeouts - and decide whether starting at all is worthwhile - from what's
+  left, rather than each having a fixed timeout of its own.
+  '''
+  def __init__(self, budget_secs, clock = time.time):
+    self.budget_secs = budget_secs
+    self.expires_at  = clock() + budget_secs
+    self._clock      = clock
+
+  def remaining(self):
+    '''Returns the number of seconds left, or 0 if there are none.'''
+    return max(0.0, self.expires_at - self._clock())
+
+  def expired(self):
+    return self.remaining() <= 0
+
+  def timeout(self, cap_secs):
+    '''Returns the time left, or 'cap_secs' if that's less.'''
+    return min(cap_secs, self.remaining())
@@ -0,0 +1,175 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import time
+import unittest
+import upstream
+
+class BackoffTestCase(unittest.TestCase):
+  def test_backoffDelays(self):
+    delays = upstream.backoffDelays(0.5, 3.0, random.Random(1234))
+    for n in xrange(10):
+      delay = delays.next()
+      self.assertTrue(0 <= delay <= min(3.0, 0.5 * 2 ** n))
+
+class TokenBucketTestCase(unittest.TestCase):
+  def test_burstThenRefill(self):
+    bucket = upstream.TokenBucket(rate = 100, burst = 3)
+    self.assertTrue(bucket.tryAcquire())
+    self.assertTrue(bucket.tryAcquire())
+    self.assertTrue(bucket.tryAcquire())
+    self.assertFalse(bucket.tryAcquire())
+    # A token comes back every 10ms:
+    self.assertTrue(bucket.acquire(timeout = 1.0))
+
+  def test_acquireTimesOut(self):
+    bucket = upstream.TokenBucket(rate = 0.1, burst = 1)
+    self.assertTrue(bucket.acquire(timeout = 0))
+    self.assertFalse(bucket.acquire(timeout = 0.01))
+
+  def test_badArguments(self):
+    self.assertRaises(ValueError, upstream.TokenBucket, 0, 1)
+    self.assertRaises(ValueError, upstream.TokenBucket, 1, 0)
+
+class CircuitBreakerTestCase(unittest.TestCase):
+  def test_opensAfterThreshold(self):
+    breaker = upstream.CircuitBreaker(failure_threshold = 2, reset_secs = 60)
+    self.assertEqual(upstream.CircuitBreaker.CLOSED, breaker.state)
+    breaker.recordFailure()
+    self.assertTrue(breaker.allow())
+    breaker.recordFailure()
+    self.assertEqual(upstream.CircuitBreaker.OPEN, breaker.state)
+    self.assertFalse(breaker.allow())
+    self.assertEqual(1, breaker.times_opened)
+
+  def test_successResets(self):
+    breaker = upstream.CircuitBreaker(failure_threshold = 2, reset_secs = 60)
+    breaker.recordFailure()
+    breaker.recordSuccess()
+    breaker.recordFailure()
+    self.assertEqual(upstream.CircuitBreaker.CLOSED, breaker.state)
+
+  def test_halfOpen(self):
+    breaker = upstream.CircuitBreaker(failure_threshold = 1, reset_secs = 0.01)
+    breaker.recordFailure()
+    self.assertFalse(breaker.allow())
+    time.sleep(0.02)
+    self.assertEqual(upstream.CircuitBreaker.HALF_OPEN, breaker.state)
+    # Only a single trial request is let through:
+    self.assertTrue(breaker.allow())
+    self.assertFalse(breaker.allow())
+    # ...and if it fails, the breaker opens again:
+    breaker.recordFailure()
+    self.assertEqual(upstream.CircuitBreaker.OPEN, breaker.state)
+    self.assertEqual(2, breaker.times_opened)
+    time.sleep(0.02)
+    self.assertTrue(breaker.allow())
+    breaker.recordSuccess()
+    self.assertEqual(upstream.CircuitBreaker.CLOSED, breaker.state)
+
+  def test_release(self):
+    breaker = upstream.CircuitBreaker(failure_threshold = 1, reset_secs = 0.01)
+    breaker.recordFailure()
+    time.sleep(0.02)
+    self.assertTrue(breaker.allow())
+    self.assertFalse(breaker.allow())
+    # A trial given up on hands its place to the next call:
+    breaker.release()
+    self.assertEqual(upstream.CircuitBreaker.HALF_OPEN, breaker.state)
+    self.assertTrue(breaker.allow())
+
+class DeadlineTestCase(unittest.TestCase):
+  def test_remaining(self):
+    now = [100.0]
+    deadline = upstream.Deadline(5, clock = lambda: now[0])
+    self.assertEqual(5, deadline.remaining())
+    self.assertEqual(2, deadline.timeout(2))
+    self.assertFalse(deadline.expired())
+    now[0] = 104.0
+    self.assertEqual(1, deadline.remaining())
+    self.assertEqual(1, deadline.timeout(2))
+    now[0] = 106.0
+    self.assertEqual(0, deadline.remaining())
+    self.assertTrue(deadline.expired())
+
+class LatencyTrackerTestCase(unittest.TestCase):
+  def test_percentile(self):
+    tracker = upstream.LatencyTracker(size = 100)
+    self.assertEqual(None, tracker.percentile(0.5))
+    for i in xrange(200):
+      tracker.record(i)
+    # Only the last 100 are kept:
+    self.assertEqual(100, len(tracker))
+    self.assertEqual(150, tracker.percentile(0.5))
+    self.assertEqual(199, tracker.percentile(1.0))
+
+class HedgerTestCase(unittest.TestCase):
+  def _slowThenFast(self):
+    '''Returns a function that's slow the first time it's called, and fast
+    after that.'''
+    calls = []
+    def fn():
+      calls.append(None)
+      if len(calls) == 1:
+        time.sleep(0.5)
+        return "slow"
+      return "fast"
+    return fn
+
+  def test_hedgeWins(self):
+    hedger = upstream.Hedger(max_rate = 1.0, initial_delay_secs = 0.01)
+    self.assertEqual("fast", hedger.call(self._slowThenFast()))
+    self.assertEqual(1, hedger.calls)
+    self.assertEqual(1, hedger.hedges_issued)
+    self.assertEqual(1, hedger.hedges_won)
+
+  def test_noHedgeWhenFast(self):
+    hedger = upstream.Hedger(max_rate = 1.0, initial_delay_secs = 1.0)
+    self.assertEqual("ok", hedger.call(lambda: "ok"))
+    self.assertEqual(0, hedger.hedges_issued)
+
+  def test_hedgeRateCapped(self):
+    # With max_rate = 0.5, the first call can't be hedged:
+    hedger = upstream.Hedger(max_rate = 0.5, initial_delay_secs = 0.01)
+    self.assertEqual("slow", hedger.call(self._slowThenFast()))
+    self.assertEqual(0, hedger.hedges_issued)
+    # ...nor can one the caller vetoes:
+    hedger.calls = 10
+    self.assertEqual("slow", hedger.call(self._slowThenFast(), may_hedge = lambda: False))
+    self.assertEqual(0, hedger.hedges_issued)
+
+  def test_errors(self):
+    hedger = upstream.Hedger(max_rate = 1.0, initial_delay_secs = 0.01)
+    calls = []
+    def failSlowlyThenSucceed():
+      calls.append(None)
+      if len(calls) == 1:
+        time.sleep(0.05)
+        raise IOError("timeout")
+      time.sleep(0.1)
+      return "ok"
+    # The primary fails, but the hedge is still running, so wait for it:
+    self.assertEqual("ok", hedger.call(failSlowlyThenSucceed))
+    # Usable errors win right away:
+    def notFound():
+      raise KeyError("404")
+    self.assertRaises(KeyError, hedger.call, notFound,
+                      is_usable_error = lambda e: isinstance(e, KeyError))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -17,197 +17,1180 @@
 import flask
 import flask.ext
 
+import roboviva.assets
+import roboviva.cache_index
+import roboviva.chunked
+import roboviva.cue_formats
 import roboviva.ridewithgps
 import roboviva.latex
+import roboviva.latex_check
+import roboviva.lru
+import roboviva.metrics
+import roboviva.pack
+import roboviva.renderers
+import roboviva.route_store
 import roboviva.tex
+import roboviva.tracing
+import roboviva.upstream
 
+import contextlib
+import fcntl
+import hashlib
+import json
 import os
 import logging
+import mimetypes
+import multiprocessing
+import shelve
 import sys
+import tempfile
+import threading
 import time
 
-blueprint = flask.Blueprint("roboviva", __name__, static_folder='static', static_url_path="")
+# Hashed asset names never change contents, so browsers can keep them forever:
+Immutable_Cache_Control = "public, max-age=31536000, immutable"
+
+class _AssetBlueprint(flask.Blueprint):
+  '''A Blueprint whose static files come from the built assets (see
+  roboviva/assets.py and build_assets.py) where there are any, and from its
+  static folder otherwise.'''
+  def send_static_file(self, filename):
+    response = _sendBuiltAsset(filename)
+    if response is None:
+      response = flask.Blueprint.send_static_file(self, filename)
+    return response
+
+blueprint = _AssetBlueprint("roboviva", __name__, static_folder='static', static_url_path="")
+
+# Metrics, served at /roboviva/metrics:
+_stage_seconds = roboviva.metrics.histogram(
+    "roboviva_stage_seconds",
+    "Time spent in each stage of handle_request, in seconds.",
+    ["stage"])
+_request_seconds = roboviva.metrics.histogram(
+    "roboviva_request_seconds",
+    "Total time spent in handle_request, in seconds.")
+_pdflatex_runs = roboviva.metrics.histogram(
+    "roboviva_pdflatex_runs",
+    "Number of pdflatex passes needed per PDF render.",
+    buckets = (1, 2, 3, 4, 5))
+_cache_lookups = roboviva.metrics.counter(
+    "roboviva_cache_lookups_total",
+    "Route cache lookups, by result: 'miss' (route not cached), 'not_modified'"
+    " (cached copy still current), 'stale' (route changed on RideWithGPS), or"
+    " 'outdated' (cached copy made by an older renderer), or 'unchanged' (new"
+    " ETag, but nothing on the cue sheet changed).",
+    ["result"])
+_request_errors = roboviva.metrics.counter(
+    "roboviva_request_errors_total",
+    "Errors returned by handle_request, by the stage that failed.",
+    ["stage"])
+_pdf_bytes_written = roboviva.metrics.counter(
+    "roboviva_pdf_bytes_written_total",
+    "Bytes of PDF data written to the PDF cache.")
+_stale_served = roboviva.metrics.counter(
+    "roboviva_stale_pdfs_served_total",
+    "Cached PDFs served without revalidation, because RideWithGPS was unavailable.")
+_pdf_requests = roboviva.metrics.counter(
+    "roboviva_pdf_requests_total",
+    "Requests for cached PDFs, by result: 'hit', 'preview' or 'missing'.",
+    ["result"])
+_previews_rendered = roboviva.metrics.counter(
+    "roboviva_previews_rendered_total",
+    "First-page previews rendered while the full PDF rendered in the background.")
+_deadlines_exceeded = roboviva.metrics.counter(
+    "roboviva_deadlines_exceeded_total",
+    "Requests that ran out of time (see REQUEST_DEADLINE_SECS), by the stage"
+    " they ran out in: 'fetch', 'render', or 'render_pass' (a PDF was served,"
+    " but a pdflatex pass was skipped to make it in time).",
+    ["stage"])
+_negative_cache_hits = roboviva.metrics.counter(
+    "roboviva_negative_cache_hits_total",
+    "Requests answered from the negative caches, by kind: 'unknown_route' or"
+    " 'failed_render'.",
+    ["kind"])
+_render_chunks = roboviva.metrics.counter(
+    "roboviva_render_chunks_total",
+    "Chunks of long routes, by result: 'rendered', or 'reused' from the chunk cache.",
+    ["result"])
+for _field in ("size", "hits", "misses", "hit_rate"):
+  roboviva.metrics.gauge(
+      "roboviva_latex_row_cache_%s" % _field,
+      "Rendered LaTeX row cache: %s." % _field.replace("_", " "),
+      value_fn = lambda field=_field: roboviva.latex.rowCacheStats()[field])
+
+# Negative caches: route ids RideWithGPS says don't exist, and LaTeX (keyed
+# on its hash) that pdflatex failed on. Both map to the error message, and
+# are per-process; entries expire after the *_TTL_SECS config values, which
+# are applied when the blueprint is registered (see _configureCaches()).
+_unknown_routes = roboviva.lru.ExpiringCache(4096, ttl_secs = None)
+_failed_renders = roboviva.lru.ExpiringCache(1024, ttl_secs = None)
+
+@blueprint.record_once
+def _configureCaches(state):
+  _unknown_routes.ttl_secs = state.app.config['UNKNOWN_ROUTE_TTL_SECS']
+  _failed_renders.ttl_secs = state.app.config['FAILED_RENDER_TTL_SECS']
+
+_manifests = {}
+
+def _assetManifest():
+  '''Returns the manifest of the assets built into ASSET_DIR, or None if
+  they haven't been built.'''
+  asset_dir = flask.current_app.config['ASSET_DIR']
+  if not asset_dir:
+    return None
+  try:
+    mtime = os.path.getmtime(os.path.join(asset_dir, roboviva.assets.Manifest_Name))
+  except OSError:
+    return None
+  cached = _manifests.get(asset_dir)
+  if cached is None or cached[0] != mtime:
+    cached = _manifests[asset_dir] = (mtime, roboviva.assets.loadManifest(asset_dir))
+  return cached[1]
+
+def _sendBuiltAsset(filename):
+  '''Returns a response serving the built 'filename' - precompressed, if the
+  client accepts that - or None if it hasn't been built.'''
+  manifest = _assetManifest()
+  # The precompressed copies are only served in place of their originals, with
+  # a Content-Encoding; as themselves, they'd be gzip labelled as CSS (or so):
+  if (manifest is None or filename == roboviva.assets.Manifest_Name or
+      filename.endswith((".gz", ".br"))):
+    return None
+  path = flask.safe_join(flask.current_app.config['ASSET_DIR'], filename)
+  if not os.path.isfile(path):
+    return None
+
+  mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+  encoding = None
+  for name, suffix in (("br", ".br"), ("gzip", ".gz")):
+    if flask.request.accept_encodings[name] and os.path.isfile(path + suffix):
+      path, encoding = path + suffix, name
+      break
+  response = flask.send_file(path, mimetype = mimetype, conditional = True)
+  if encoding:
+    response.headers['Content-Encoding'] = encoding
+  response.vary.add('Accept-Encoding')
+  if filename in manifest.values():
+    response.headers['Cache-Control'] = Immutable_Cache_Control
+  else:
+    # Pages keep their names, so make sure browsers check for a new version:
+    response.headers['Cache-Control'] = "no-cache"
+  return response
+
+@blueprint.app_context_processor
+def _assetNames():
+  '''Lets templates refer to assets by their hashed names, with
+  url_for('roboviva.static', filename = asset('robo.css')).'''
+  manifest = _assetManifest() or {}
+  return dict(asset = lambda filename: manifest.get(filename, filename))
 
 @blueprint.route('/')
 def index():
-  return flask.current_app.send_static_file('index.html')
+  return blueprint.send_static_file('index.html')
+
+def _routeStore():
+  '''Returns the store of parsed routes.'''
+  return roboviva.route_store.RouteStore(flask.current_app.config['ROUTE_CACHE_DIR'])
+
+def _pdfPath(route_id):
+  '''Returns the path of the cached PDF for 'route_id'.'''
+  return os.path.join(flask.current_app.config['PDF_CACHE_DIR'],
+                      "%s.pdf" % (route_id))
+
+def _previewPath(route_id):
+  '''Returns the path of the first-page preview PDF for 'route_id'.'''
+  return os.path.join(flask.current_app.config['PDF_CACHE_DIR'],
+                      "%s.preview.pdf" % (route_id))
+
+# Tells clients whether /pdfs/<id>.pdf gave them the 'full' PDF, or a 'preview':
+Pdf_Version_Header = "X-Roboviva-Pdf-Version"
+
+# Routes whose full PDF is being rendered in the background, behind a preview:
+_background_renders = set()
+_background_lock    = threading.Lock()
+
+def _writeAtomically(path, data):
+  '''Writes 'data' to 'path' via a temp file in the same directory, so anyone
+  reading 'path' (e.g. get_pdf(), while a background render finishes) sees
+  either the old file or the whole new one, never half of it.'''
+  fd, tmp_path = tempfile.mkstemp(suffix = ".tmp", dir = os.path.dirname(path))
+  try:
+    with os.fdopen(fd, 'wb') as out:
+      out.write(data)
+    # (mkstemp() makes it private; PDFs may be served by something else.)
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
+  except:
+    os.unlink(tmp_path)
+    raise
+
+def _renderPreview(route_id, route, deadline = None):
+  '''Renders the first page's worth of 'route', in a single pdflatex pass, to
+  the preview PDF. Returns True if that worked.'''
+  log = flask.current_app.logger
+  try:
+    with _stage("preview"):
+      latex = roboviva.latex.makePreviewLatex(route,
+                                              flask.current_app.config['PREVIEW_ENTRIES'])
+      pdf_data = roboviva.tex.latex2pdf(latex, single_pass = True, deadline = deadline)
+      _writeAtomically(_previewPath(route_id), pdf_data)
+  except Exception as e:
+    log.error("[request][%10d]: Error rendering preview: %s", route_id, e)
+    return False
+  _previews_rendered.inc()
+  return True
+
+def _renderInBackground(route_id, etag, route, renderer):
+  '''Renders the full PDF for 'route' on a background thread, records it in
+  the cache, and removes the preview. Returns False (and does nothing) if
+  'route_id' is already being rendered in the background.'''
+  with _background_lock:
+    if route_id in _background_renders:
+      return False
+    _background_renders.add(route_id)
+  app   = flask.current_app._get_current_object()
+  trace, parent_id = roboviva.tracing.current(), roboviva.tracing.currentSpanId()
+  def render():
+    try:
+      with app.test_request_context(), roboviva.tracing.activate(trace, parent_id):
+        if _renderRoute(route_id, route, renderer) is None:
+          with _cacheDb() as hash_db:
+            _markRendered(hash_db, route_id, etag, route, renderer)
+        try:
+          os.unlink(_previewPath(route_id))
+        except OSError:
+          pass
+    finally:
+      with _background_lock:
+        _background_renders.discard(route_id)
+  thread = threading.Thread(target = render, name = "render-%s" % route_id)
+  thread.daemon = True
+  thread.start()
+  return True
+
+def _cacheEntry(hash_db, db_key):
+  '''Returns the (etag, timestamp, renderer_version, fingerprint) cache entry
+  for 'db_key', or None if there isn't one. Fields that older entries don't
+  have come back as None.'''
+  if db_key not in hash_db:
+    return None
+  entry = tuple(hash_db[db_key])
+  return entry + (None,) * (4 - len(entry))
+
+def _renderer():
+  '''Returns the renderer to use: the one named by '?renderer=<name>', if this
+  request has one, else the one named by the RENDERER config value. Throws a
+  KeyError if there's no renderer by that name.'''
+  name = flask.request.args.get('renderer') or flask.current_app.config['RENDERER']
+  return roboviva.renderers.get(name)
+
+def _configuredRenderer():
+  '''Returns the renderer named by the RENDERER config value: the one the
+  PDF cache is rendered with, whatever the request asks for.'''
+  return roboviva.renderers.get(flask.current_app.config['RENDERER'])
+
+def _markRendered(hash_db, route_id, etag, route, renderer = None):
+  '''Records that the cached PDF for 'route_id' is 'route', at version 'etag',
+  rendered by 'renderer' (default: _configuredRenderer()).'''
+  renderer = renderer or _configuredRenderer()
+  timestamp = time.time()
+  hash_db[str(route_id)] = (etag,
+                            timestamp,
+                            renderer.version,
+                            roboviva.latex.routeFingerprint(route))
+  _cacheIndex(hash_db).put(route_id, etag, timestamp, renderer.version,
+                           _pdfSize(route_id))
+
+def _pdfSize(route_id):
+  '''Returns the size of the cached PDF for 'route_id', or None if there
+  isn't one.'''
+  try:
+    return os.path.getsize(_pdfPath(route_id))
+  except OSError:
+    return None
+
+def _indexEntries(hash_db):
+  '''Yields the index entry for every route in the cache db.'''
+  for db_key in hash_db:
+    etag, timestamp, version, _ = _cacheEntry(hash_db, db_key)
+    yield db_key, etag, timestamp, version, _pdfSize(db_key)
+
+def _cacheIndex(hash_db = None):
+  '''Returns the index of the cache db (see cache_index.py), building it from
+  'hash_db' (default: the cache db, opened for the purpose) first if there
+  isn't one yet.'''
+  config = flask.current_app.config
+  path = config['CACHE_INDEX_FILE'] or config['SHELVE_FILENAME'] + ".index"
+  index = roboviva.cache_index.CacheIndex(path)
+  if not os.path.exists(path):
+    if hash_db is None:
+      with _cacheDb() as hash_db:
+        index.rebuild(_indexEntries(hash_db))
+    else:
+      index.rebuild(_indexEntries(hash_db))
+  return index
+
+# Only one thread (or greenlet) per process waits on the cache db's file lock
+# at a time, the rest wait here. A blocking flock() would stall every greenlet
+# in the process, not just the one asking, under gevent.
+_cache_db_lock = threading.Lock()
+# The cache db, while this thread has it open, so that nested _cacheDb()
+# blocks share it rather than waiting on themselves:
+_cache_db_local = threading.local()
+
+@contextlib.contextmanager
+def _cacheDb():
+  '''Opens the cache db (and takes its lock) for just the duration of the
+  block, rather than until the end of the request like get_shelve() does, so
+  that slow work - fetching from RideWithGPS, running pdflatex - doesn't hold
+  up every other request waiting on the db. Blocks nested inside one another
+  get the same, already open, db.
+
+  Takes the same lock file as Flask-Shelve, so get_shelve() (and other
+  processes) still see the db one writer at a time.'''
+  hash_db = getattr(_cache_db_local, 'hash_db', None)
+  if hash_db is not None:
+    yield hash_db
+    return
+  config = flask.current_app.config
+  with _cache_db_lock:
+    # Closing lock_file releases the flock:
+    with open(config['SHELVE_LOCKFILE'], 'a') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      hash_db = shelve.open(config['SHELVE_FILENAME'],
+                            flag      = 'c',
+                            protocol  = config['SHELVE_PROTOCOL'],
+                            writeback = config['SHELVE_WRITEBACK'])
+      _cache_db_local.hash_db = hash_db
+      try:
+        yield hash_db
+      finally:
+        del _cache_db_local.hash_db
+        hash_db.close()
+
+@contextlib.contextmanager
+def _stage(name, **attrs):
+  '''Times the block as stage 'name' of the current request, both in the
+  stage metrics and as a span of the current trace.'''
+  with _stage_seconds.time(stage = name):
+    with roboviva.tracing.span(name, **attrs) as span:
+      yield span
+
+def _unknownRoutePage(route_id):
+  return flask.render_template('error.html', error=("'%s' is not a valid RideWithGPS Route :(" % route_id))
+
+def _refusedRoutePage(route_id):
+  '''The page for routes RideWithGPS wouldn't give us, though they may exist
+  (e.g. private ones).'''
+  return flask.render_template('error.html',
+                               error = ("RideWithGPS wouldn't give us route '%s'. Is it private?" % route_id))
+
+def _outOfTimePage(route_id, stage):
+  '''Counts a request that ran out of time in 'stage', and returns what to
+  show instead: whatever PDF we have for 'route_id', stale or not, if there's
+  one, or else an error page.'''
+  _deadlines_exceeded.inc(stage = stage)
+  if os.path.exists(_pdfPath(route_id)):
+    _stale_served.inc()
+    return flask.redirect(flask.url_for('roboviva.get_pdf', route_id = route_id))
+  return flask.render_template('error.html',
+                               error = 'That took too long :( Please try again in a bit.',
+                               meditation = '{Guru Meditation: 0xFC - Out of Time}')
+
+def _renderErrorPage():
+  return flask.render_template(
+      'error.html',
+      error = "Internal Error :(",
+      meditation = "{Guru Meditation: 0xFF - Error Rendering PDF}")
+
+def _renderRoute(route_id, route, renderer = None, deadline = None, stats = None,
+                 pdf_path = None):
+  '''
+  Renders 'route' to PDF with 'renderer' (default: _configuredRenderer()), and
+  writes it to 'pdf_path' (default: the PDF cache). Returns None on success, or
+  the page to show the user if something went wrong.
+
+  If 'deadline' (an upstream.Deadline) is given, pdflatex is stopped when it
+  runs out. If 'stats' is a dict, stats['settled'] is set to False if a
+  pdflatex pass was skipped to make the deadline (so e.g. page counts may be
+  missing), else True.
+  '''
+  log = flask.current_app.logger
+  renderer = renderer or _configuredRenderer()
+  if deadline and deadline.expired():
+    log.warning("[request][%10d]: Out of time before rendering.", route_id)
+    return _outOfTimePage(route_id, "render")
+  if not isinstance(renderer, roboviva.renderers.LatexRenderer):
+    try:
+      with _stage("render", renderer = renderer.name):
+        pdf_data = renderer.render(route)
+    except Exception as e:
+      _request_errors.inc(stage = "render")
+      log.error("[request][%10d]: Error rendering PDF with %s: %s",
+                route_id, renderer.name, e)
+      return _renderErrorPage()
+    return _writePdf(route_id, pdf_data, pdf_path)
+
+  # Step three, make the latex:
+  try:
+    with _stage("latex"):
+      latex = roboviva.latex.makeLatex(route)
+  except Exception as e:
+    _request_errors.inc(stage = "latex")
+    log.error("[request][%10d]: Error generating latex: %s\n cue:\n %s",
+        route_id, e, route)
+    return flask.render_template('error.html',
+                                 error = "Internal Error :(",
+                                 meditation = "{Guru Meditation: 0xBA - Cue Parsing Failed}")
+
+  # Broken LaTeX can hang pdflatex or fail slowly, so check it first:
+  with _stage("latex_check"):
+    problems = roboviva.latex_check.checkDocument(latex)
+  if problems:
+    _request_errors.inc(stage = "latex_check")
+    log.error("[request][%10d]: Generated LaTeX failed checks (%d problems): %s",
+              route_id, len(problems), "; ".join(problems[:10]))
+    return flask.render_template('error.html',
+                                 error = "Internal Error :(",
+                                 meditation = "{Guru Meditation: 0xBB - LaTeX Check Failed}")
+
+  # Step four, render the pdf. If this exact LaTeX failed to render recently,
+  # it will again, so don't bother:
+  latex_hash = hashlib.sha1(latex.encode("utf-8")).hexdigest()
+  if latex_hash in _failed_renders:
+    _negative_cache_hits.inc(kind = "failed_render")
+    log.info("[request][%10d]: LaTeX %s failed to render recently, not retrying.",
+             route_id, latex_hash)
+    return _renderErrorPage()
+
+  # Long routes are rendered in pieces, in parallel:
+  config = flask.current_app.config
+  tex_stats = {}
+  try:
+    if len(route.entries) > config['LONG_ROUTE_ENTRIES']:
+      workers = config['LONG_ROUTE_WORKERS'] or multiprocessing.cpu_count()
+      store = None
+      if config['CHUNK_CACHE_DIR']:
+        store = roboviva.chunked.ChunkStore(config['CHUNK_CACHE_DIR'],
+                                            config['CHUNK_CACHE_MAX'])
+      with _stage("render", chunked = True, workers = workers):
+        pdf_data = roboviva.chunked.renderChunked(route,
+                                                  config['LONG_ROUTE_CHUNK_ENTRIES'],
+                                                  workers,
+                                                  stats = tex_stats,
+                                                  store = store,
+                                                  deadline = deadline)
+      _render_chunks.inc(tex_stats['chunks_rendered'], result = "rendered")
+      _render_chunks.inc(tex_stats['chunks'] - tex_stats['chunks_rendered'],
+                         result = "reused")
+      if store and tex_stats['chunks_rendered']:
+        store.prune()
+    else:
+      with _stage("render"):
+        pdf_data = roboviva.tex.latex2pdf(latex, stats = tex_stats, deadline = deadline)
+  except Exception as e:
+    if deadline and deadline.expired():
+      # Not the LaTeX's fault, so it isn't negatively cached:
+      log.warning("[request][%10d]: Out of time rendering: %s", route_id, e)
+      return _outOfTimePage(route_id, "render")
+    _request_errors.inc(stage = "render")
+    _failed_renders.put(latex_hash, (route_id, str(e)))
+    log.error("[request][%10d]: Error generating PDF (latex %s)\n latex: \n %s\n error:\n%s",
+        route_id, latex_hash, latex, e)
+    return _renderErrorPage()
+  finally:
+    if 'runs' in tex_stats:
+      _pdflatex_runs.observe(tex_stats['runs'])
+
+  settled = tex_stats.get('settled', True)
+  if not settled:
+    _deadlines_exceeded.inc(stage = "render_pass")
+    log.warning("[request][%10d]: Skipped a pdflatex pass to make the deadline.", route_id)
+  if stats is not None:
+    stats['settled'] = settled
+
+  # Step five, write it:
+  return _writePdf(route_id, pdf_data, pdf_path)
+
+def _writePdf(route_id, pdf_data, pdf_path = None):
+  '''Writes 'pdf_data' to 'pdf_path' (default: the PDF cache, as the PDF for
+  'route_id'). Returns None on success, or the error page to show the user.'''
+  log = flask.current_app.logger
+  pdf_filepath = pdf_path or _pdfPath(route_id)
+  try:
+    with _stage("write", path = pdf_filepath):
+      _writeAtomically(pdf_filepath, pdf_data)
+  except Exception as e:
+    _request_errors.inc(stage = "write")
+    log.error("[request][%10d]: Error writing pdf to %s: %s", route_id, pdf_filepath, e)
+    return flask.render_template(
+        'error.html',
+        error = "Internal Error :(",
+        meditation = "{Guru Meditation: 0xCE - Error writing PDF}")
+  _pdf_bytes_written.inc(len(pdf_data))
+  return None
 
 @blueprint.route('/routes/<int:route_id>')
 def handle_request(route_id):
+  # If another process (e.g. a proxy, or a load tester) already assigned this
+  # request a trace id, keep using it, so its spans can be stitched together:
+  trace = roboviva.tracing.start(
+      flask.request.headers.get(roboviva.tracing.Trace_Header),
+      route_id = route_id)
+  flask.g.roboviva_trace = trace
+  try:
+    with _request_seconds.time():
+      with roboviva.tracing.span("request"):
+        response = flask.make_response(_handleRequest(route_id, _requestDeadline()))
+    response.headers[roboviva.tracing.Trace_Header] = trace.trace_id
+    return response
+  finally:
+    roboviva.tracing.finish()
+
+def _requestDeadline():
+  '''Returns the Deadline for the current request, or None if there isn't
+  one (see REQUEST_DEADLINE_SECS).'''
+  budget_secs = flask.current_app.config['REQUEST_DEADLINE_SECS']
+  if not budget_secs:
+    return None
+  return roboviva.upstream.Deadline(budget_secs)
+
+def _handleRequest(route_id, deadline = None):
   log = flask.current_app.logger
-  log.debug("[request][%10d]: start", route_id)
+  log.debug("[request][%10d]: start, trace: %s",
+            route_id, roboviva.tracing.current().trace_id)
 
   # Roboviva uses the HTTP ETag header to determine if it's worth
   # re-downloading the route information from RideWithGPS, so step one is
   # determining if we have an ETag already on hand:
-  hash_db = flask.ext.shelve.get_shelve('c')
+  # A renderer asked for by name has to be one we can actually use here:
+  try:
+    renderer = _renderer()
+  except KeyError:
+    renderer = None
+  if renderer is None or (flask.request.args.get('renderer') and
+                          not renderer.available()):
+    return flask.render_template('error.html',
+                                 error = "Unknown renderer; try one of: %s" %
+                                         ", ".join(roboviva.renderers.names()))
+  if renderer.name != _configuredRenderer().name:
+    return _renderUncached(route_id, renderer, deadline)
+
+  # If the full PDF is already on its way, the preview is all there is to see:
+  if route_id in _background_renders:
+    return flask.redirect(flask.url_for('roboviva.get_pdf', route_id = route_id))
+
   db_key  = str(route_id)
-  cached_etag = None
-  if db_key in hash_db:
-    cached_etag, timestamp = hash_db[db_key]
+  cached_etag = cached_fingerprint = None
+  with _cacheDb() as hash_db:
+    cache_entry = _cacheEntry(hash_db, db_key)
+  if cache_entry:
+    cached_etag, timestamp, cached_version, cached_fingerprint = cache_entry
+
+  # If the cached PDF was made by an older renderer, it needs re-rendering
+  # even if the route hasn't changed. Re-use the stored, parsed route if we
+  # have it; otherwise, fetch the whole thing again:
+  outdated = cache_entry and cached_version != renderer.version
+  outdated_route = None
+  if outdated:
+    outdated_route = _routeStore().get(route_id, cached_etag)
+    log.info("[request][%10d]: Rendered by %s, current renderer is %s",
+             route_id, cached_version, renderer.version)
+
+  # Don't bother RideWithGPS about routes it told us recently don't exist:
+  unknown_route_error = _unknown_routes.get(route_id)
+  if unknown_route_error is not None:
+    _negative_cache_hits.inc(kind = "unknown_route")
+    log.info("[request][%10d]: Known unknown route: %s", route_id, unknown_route_error)
+    return _unknownRoutePage(route_id)
 
   # Query RideWithGPS. This method will return the current ETag, and, if the
   # current ETag is different from the one we have on file, the full cue data
   # for the route:
   try:
-    cur_etag, cur_route = roboviva.ridewithgps.getETagAndCuesheet_viaJSON(route_id, cached_etag)
+    with _stage("fetch"):
+      cur_etag, cur_route = roboviva.ridewithgps.getETagAndCuesheet_viaJSON(
+          route_id,
+          None if (outdated and outdated_route is None) else cached_etag,
+          deadline = deadline)
+  except roboviva.ridewithgps.RideWithGpsDeadlineExceeded as e:
+    log.warning("[request][%10d]: %s", route_id, e)
+    return _outOfTimePage(route_id, "fetch")
+  except roboviva.ridewithgps.RideWithGpsUnavailable as e:
+    _request_errors.inc(stage = "fetch")
+    # RideWithGPS is having trouble; if we have *any* PDF for this route on
+    # hand, a possibly-stale sheet beats an error page:
+    if cached_etag is not None and os.path.exists(_pdfPath(route_id)):
+      _stale_served.inc()
+      log.warning("[request][%10d]: RideWithGPS unavailable, serving cached PDF: %s",
+                  route_id, e)
+      return flask.redirect(flask.url_for('roboviva.get_pdf', route_id = route_id))
+    log.warning("[request][%10d]: RideWithGPS unavailable: %s", route_id, e)
+    return flask.render_template('error.html',
+                                 error = 'RideWithGPS is having trouble right now. Please try again in a bit.',
+                                 meditation = '{Guru Meditation: 0xFB - RideWithGPS Unavailable}')
   except roboviva.ridewithgps.RideWithGpsError as e:
+    _request_errors.inc(stage = "fetch")
     log.warning("[request][%10d]: RideWithGPS error: %s", route_id, e)
-    return flask.render_template('error.html', error=("'%s' is not a valid RideWithGPS Route :(" % route_id))
+    if isinstance(e, roboviva.ridewithgps.RideWithGpsUnknownRoute):
+      _unknown_routes.put(route_id, str(e))
+      return _unknownRoutePage(route_id)
+    return _refusedRoutePage(route_id)
   except Exception as e:
+    _request_errors.inc(stage = "fetch")
     log.error("[request][%10d]: Other error: %s", route_id, e)
     return flask.render_template('error.html',
                                  error = 'Error querying RideWithGPS',
                                  meditation = '{Guru Meditation: 0xFA}')
 
-  log.debug("[request][%10d]: GPS OK, old etag: %s cur etag:", route_id, cached_etag, cur_etag)
+  log.debug("[request][%10d]: GPS OK, old etag: %s cur etag: %s", route_id, cached_etag, cur_etag)
 
-  if cur_etag == cached_etag:
-    log.info("[request][%10d]: No changes, redirecting to cache.")
+  if cur_etag == cached_etag and not outdated:
+    _cache_lookups.inc(result = "not_modified")
+    log.info("[request][%10d]: No changes, redirecting to cache.", route_id)
   else:
     # Need to update the cache, and regenerate the PDF:
-    if cached_etag is None:
+    if cur_etag == cached_etag:
+      _cache_lookups.inc(result = "outdated")
+      log.info("[request][%10d]: re-render: %s", route_id, cur_etag)
+      if cur_route is None:
+        cur_route = outdated_route
+    elif cached_etag is None:
+      _cache_lookups.inc(result = "miss")
       log.info("[request][%10d]: new_ent: %s", route_id, cur_etag)
     else:
       log.info("[request][%10d]: replace: %s -> %s",
                route_id, cached_etag, cur_etag)
 
-    # Step three, make the latex:
+    # Keep the parsed route, so it can be re-rendered later without asking
+    # RideWithGPS again:
     try:
-      latex = roboviva.latex.makeLatex(cur_route)
+      with _stage("route_store"):
+        _routeStore().put(route_id, cur_etag, cur_route)
     except Exception as e:
-      log.error("[request][%10d]: Error generating latex: %s\n cue:\n %s",
-          route_id, e, cur_route)
-      return flask.render_template('error.html',
-                                   error = "Internal Error :(",
-                                   meditation = "{Guru Meditation: 0xBA - Cue Parsing Failed}")
+      log.error("[request][%10d]: Error storing parsed route: %s", route_id, e)
 
-    # Step four, render the pdf:
-    try:
-      pdf_data = roboviva.tex.latex2pdf(latex)
-    except Exception as e:
-      log.error("[request][%10d]: Error generating PDF\n latex: \n %s\n error:\n%s",
-          route_id, latex, e)
-      return flask.render_template(
-          'error.html',
-          error = "Internal Error :(",
-          meditation = "{Guru Meditation: 0xFF - Error Rendering PDF}")
-
-    # Step five, write it:
-    cache_dir = flask.current_app.config['PDF_CACHE_DIR']
-    pdf_filename = "%s.pdf" % (route_id)
-    pdf_filepath = os.path.join(cache_dir, pdf_filename)
-    try:
-      with open(pdf_filepath, 'wb') as pdffile:
-        pdffile.write(roboviva.tex.latex2pdf(latex))
-    except Exception as e:
-      log.error("[request][%10d]: Error writing pdf to %s: %s", route_id, pdf_filepath, e)
-      return flask.render_template(
-          'error.html',
-          error = "Internal Error :(",
-          meditation = "{Guru Meditation: 0xCE - Error writing PDF}")
+    # RideWithGPS bumps the ETag for plenty of things that never make it onto
+    # the cue sheet (track point edits, photos, privacy settings...). If
+    # nothing we print changed, the PDF we have is still good:
+    fingerprint = roboviva.latex.routeFingerprint(cur_route)
+    if (fingerprint == cached_fingerprint and not outdated and
+        os.path.exists(_pdfPath(route_id))):
+      _cache_lookups.inc(result = "unchanged")
+      log.info("[request][%10d]: Cue sheet unchanged, keeping cached PDF.", route_id)
+    else:
+      if cached_etag not in (None, cur_etag):
+        _cache_lookups.inc(result = "stale")
+
+      # If there's nothing to show the user yet, and this route is longer
+      # than a page, show them the first page right away, and render the
+      # rest in the background:
+      preview_entries = flask.current_app.config['PREVIEW_ENTRIES']
+      if (preview_entries and
+          isinstance(renderer, roboviva.renderers.LatexRenderer) and
+          len(cur_route.entries) > preview_entries and
+          not os.path.exists(_pdfPath(route_id)) and
+          _renderPreview(route_id, cur_route, deadline)):
+        _renderInBackground(route_id, cur_etag, cur_route, renderer)
+        return flask.redirect(flask.url_for('roboviva.get_pdf', route_id = route_id))
+
+      # Steps three through five: make the latex, render it, and write it out:
+      render_stats = {}
+      error_page = _renderRoute(route_id, cur_route, renderer, deadline, render_stats)
+      if error_page:
+        return error_page
+      if not render_stats.get('settled', True):
+        # It was cut short to make the deadline. Better than nothing, but not
+        # worth keeping, so it isn't recorded, and the next request redoes it:
+        return flask.redirect(flask.url_for('roboviva.get_pdf', route_id = route_id))
 
     # Update the hash db:
-    hash_db[db_key] = (cur_etag, time.time())
+    with _stage("cache_write"), _cacheDb() as hash_db:
+      _markRendered(hash_db, route_id, cur_etag, cur_route, renderer)
 
   # ...and point them to the final PDF, which can be served statically from
   # pdfs/<route_id>.pdf:
   return flask.redirect(flask.url_for('roboviva.get_pdf',
                                       route_id   = route_id))
 
+def _renderUncached(route_id, renderer, deadline = None):
+  '''Renders 'route_id' with 'renderer', a renderer other than the configured
+  one (see '?renderer=<name>'), and returns the PDF itself. Nothing is
+  cached: the cached PDF and its cache entry belong to the configured
+  renderer, and anyone asking for another one mustn't replace everybody
+  else's sheet with theirs.'''
+  log = flask.current_app.logger
+  if _unknown_routes.get(route_id) is not None:
+    _negative_cache_hits.inc(kind = "unknown_route")
+    return _unknownRoutePage(route_id)
+  try:
+    etag, route = _currentRoute(route_id, deadline)
+  except roboviva.ridewithgps.RideWithGpsDeadlineExceeded as e:
+    log.warning("[request][%10d]: %s", route_id, e)
+    return _outOfTimePage(route_id, "fetch")
+  except roboviva.ridewithgps.RideWithGpsUnavailable as e:
+    _request_errors.inc(stage = "fetch")
+    etag, route = _routeStore().latest(route_id) or (None, None)
+    if route is None:
+      log.warning("[request][%10d]: RideWithGPS unavailable: %s", route_id, e)
+      return flask.render_template('error.html',
+                                   error = 'RideWithGPS is having trouble right now. Please try again in a bit.',
+                                   meditation = '{Guru Meditation: 0xFB - RideWithGPS Unavailable}')
+    _stale_served.inc()
+    log.warning("[request][%10d]: RideWithGPS unavailable, using stored route: %s",
+                route_id, e)
+  except roboviva.ridewithgps.RideWithGpsError as e:
+    _request_errors.inc(stage = "fetch")
+    log.warning("[request][%10d]: RideWithGPS error: %s", route_id, e)
+    if isinstance(e, roboviva.ridewithgps.RideWithGpsUnknownRoute):
+      _unknown_routes.put(route_id, str(e))
+      return _unknownRoutePage(route_id)
+    return _refusedRoutePage(route_id)
+  except Exception as e:
+    _request_errors.inc(stage = "fetch")
+    log.error("[request][%10d]: Other error: %s", route_id, e)
+    return flask.render_template('error.html',
+                                 error = 'Error querying RideWithGPS',
+                                 meditation = '{Guru Meditation: 0xFA}')
+
+  log.info("[request][%10d]: Rendering %s with %s, uncached", route_id, etag, renderer.name)
+  fd, pdf_path = tempfile.mkstemp(suffix = ".pdf",
+                                  dir = flask.current_app.config['PDF_CACHE_DIR'])
+  os.close(fd)
+  try:
+    error_page = _renderRoute(route_id, route, renderer, deadline, pdf_path = pdf_path)
+    if error_page:
+      return error_page
+    with open(pdf_path, 'rb') as pdf_file:
+      pdf_data = pdf_file.read()
+  finally:
+    os.unlink(pdf_path)
+  return flask.Response(pdf_data, mimetype = "application/pdf")
+
+@blueprint.route('/routes/<int:route_id>/rerender')
+def rerender_route(route_id):
+  '''Re-renders the PDF for 'route_id' from the stored, parsed route, without
+  asking RideWithGPS. Falls back to a normal request if nothing is stored.'''
+  log = flask.current_app.logger
+  stored = _routeStore().latest(route_id)
+  if stored is None:
+    log.info("[rerender][%10d]: Not in route store, fetching.", route_id)
+    return flask.redirect(flask.url_for('roboviva.handle_request', route_id = route_id))
+
+  etag, route = stored
+  log.info("[rerender][%10d]: Re-rendering from route store (etag: %s)", route_id, etag)
+  error_page = _renderRoute(route_id, route)
+  if error_page:
+    return error_page
+  with _cacheDb() as hash_db:
+    _markRendered(hash_db, route_id, etag, route)
+  return flask.redirect(flask.url_for('roboviva.get_pdf', route_id = route_id))
+
+def _currentRoute(route_id, deadline = None):
+  '''Returns the (etag, route) for the current version of 'route_id', from
+  the route store if RideWithGPS says our copy is current, else freshly
+  fetched (and stored). Throws RideWithGpsErrors, like ridewithgps does.'''
+  stored_etag, stored_route = _routeStore().latest(route_id) or (None, None)
+  with _stage("fetch"):
+    etag, route = roboviva.ridewithgps.getETagAndCuesheet_viaJSON(route_id, stored_etag,
+                                                                  deadline = deadline)
+  if route is None:
+    return etag, stored_route
+  _routeStore().put(route_id, etag, route)
+  return etag, route
+
+@blueprint.route('/pack')
+def render_pack():
+  '''Renders every route in '?routes=1,2,3' in one go (e.g. all the distances
+  of an event), caches each route's PDF as usual, and returns all of them as
+  one combined PDF.'''
+  log = flask.current_app.logger
+  try:
+    route_ids = [int(route_id)
+                 for route_id in flask.request.args.get('routes', '').split(',')
+                 if route_id.strip()]
+  except ValueError:
+    route_ids = []
+  max_routes = flask.current_app.config['PACK_MAX_ROUTES']
+  if not route_ids or len(route_ids) > max_routes:
+    return flask.render_template('error.html',
+                                 error = "Packs need between 1 and %d route numbers, like ?routes=1,2,3" % max_routes)
+
+  # Don't bother RideWithGPS about routes it told us recently don't exist:
+  for route_id in route_ids:
+    if _unknown_routes.get(route_id) is not None:
+      _negative_cache_hits.inc(kind = "unknown_route")
+      return _unknownRoutePage(route_id)
+
+  routes = []
+  for route_id in route_ids:
+    try:
+      routes.append(_currentRoute(route_id))
+    except roboviva.ridewithgps.RideWithGpsError as e:
+      _request_errors.inc(stage = "fetch")
+      if isinstance(e, roboviva.ridewithgps.RideWithGpsUnknownRoute):
+        _unknown_routes.put(route_id, str(e))
+      log.warning("[pack][%10d]: RideWithGPS error: %s", route_id, e)
+      return flask.render_template('error.html',
+                                   error = ("Couldn't get route '%s' from RideWithGPS :(" % route_id))
+    except Exception as e:
+      _request_errors.inc(stage = "fetch")
+      log.error("[pack][%10d]: Other error: %s", route_id, e)
+      return flask.render_template('error.html',
+                                   error = 'Error querying RideWithGPS',
+                                   meditation = '{Guru Meditation: 0xFA}')
+
+  tex_stats = {}
+  try:
+    with _stage("render", routes = len(routes)):
+      pack_pdf, route_pdfs = roboviva.pack.renderPack(
+          [route for etag, route in routes],
+          workers = flask.current_app.config['LONG_ROUTE_WORKERS'] or multiprocessing.cpu_count(),
+          stats = tex_stats)
+  except Exception as e:
+    _request_errors.inc(stage = "render")
+    log.error("[pack]: Error rendering routes %s: %s", route_ids, e)
+    return _renderErrorPage()
+  finally:
+    if 'runs' in tex_stats:
+      _pdflatex_runs.observe(tex_stats['runs'])
+
+  with _cacheDb() as hash_db:
+    for route_id, (etag, route), pdf_data in zip(route_ids, routes, route_pdfs):
+      if _writePdf(route_id, pdf_data) is None:
+        _markRendered(hash_db, route_id, etag, route, roboviva.renderers.get("latex"))
+  return flask.Response(pack_pdf, mimetype = "application/pdf")
+
+_Cue_Formats = {
+  "json" : "application/json",
+  "html" : "text/html; charset=utf-8",
+  "txt"  : "text/plain; charset=utf-8",
+}
+
+def _cueSheetHtml(route):
+  '''Renders 'route' as an HTML page; see cue_formats.'''
+  html_format = roboviva.cue_formats.htmlFormat
+  entries = []
+  for entry in route.entries:
+    description, note = html_format(entry.description), html_format(entry.note)
+    # As in the PDF: a note without a description stands in for it:
+    if description.strip() == "":
+      description, note = note, ""
+    entries.append((entry, flask.Markup(description), flask.Markup(note)))
+  return flask.render_template('cuesheet.html',
+                               route   = route,
+                               stats   = roboviva.cue_formats.routeStats(route),
+                               entries = entries)
+
+@blueprint.route('/routes/<int:route_id>.<any(json, html, txt):fmt>')
+def route_data(route_id, fmt):
+  '''Serves the cue sheet for 'route_id' as JSON, HTML or text, made
+  straight from the parsed route - no PDF involved. Revalidated against
+  RideWithGPS just like the PDF, and served with an ETag, so clients can
+  revalidate against us.'''
+  log = flask.current_app.logger
+  unknown_route_error = _unknown_routes.get(route_id)
+  if unknown_route_error is not None:
+    _negative_cache_hits.inc(kind = "unknown_route")
+    flask.abort(404)
+  try:
+    etag, route = _currentRoute(route_id)
+  except roboviva.ridewithgps.RideWithGpsUnavailable as e:
+    _request_errors.inc(stage = "fetch")
+    # As with PDFs, a possibly-stale copy beats an error:
+    etag, route = _routeStore().latest(route_id) or (None, None)
+    if route is None:
+      log.warning("[%s][%10d]: RideWithGPS unavailable: %s", fmt, route_id, e)
+      flask.abort(503)
+    _stale_served.inc()
+    log.warning("[%s][%10d]: RideWithGPS unavailable, serving stored route: %s",
+                fmt, route_id, e)
+  except roboviva.ridewithgps.RideWithGpsError as e:
+    _request_errors.inc(stage = "fetch")
+    log.warning("[%s][%10d]: RideWithGPS error: %s", fmt, route_id, e)
+    if isinstance(e, roboviva.ridewithgps.RideWithGpsUnknownRoute):
+      _unknown_routes.put(route_id, str(e))
+      flask.abort(404)
+    flask.abort(502)
+  except Exception as e:
+    _request_errors.inc(stage = "fetch")
+    log.error("[%s][%10d]: Other error: %s", fmt, route_id, e)
+    flask.abort(503)
+
+  if fmt == "json":
+    data = roboviva.cue_formats.toJson(route)
+  elif fmt == "txt":
+    data = roboviva.cue_formats.toText(route)
+  else:
+    data = _cueSheetHtml(route)
+  response = flask.Response(data, mimetype = _Cue_Formats[fmt])
+  response.set_etag(hashlib.sha1("%s:%s:%d" % (
+      etag, fmt, roboviva.cue_formats.Format_Version)).hexdigest())
+  # The route can change on RideWithGPS at any time, so always check back:
+  response.headers['Cache-Control'] = "no-cache"
+  return response.make_conditional(flask.request)
+
 @blueprint.route('/pdfs/<int:route_id>.pdf')
 def get_pdf(route_id):
   cache_dir = flask.current_app.config['PDF_CACHE_DIR']
   pdf_filename = "%s.pdf" % (route_id)
   pdf_filepath = os.path.join(cache_dir, pdf_filename)
-  if not os.path.exists(pdf_filepath):
-    return flask.render_template('regen.html', route_id = route_id)
-  return flask.send_from_directory(
-      cache_dir,
-      pdf_filename,
-      mimetype = "application/pdf",
-      as_attachment = False)
+  if os.path.exists(pdf_filepath):
+    _pdf_requests.inc(result = "hit")
+    response = flask.send_from_directory(
+        cache_dir,
+        pdf_filename,
+        mimetype = "application/pdf",
+        as_attachment = False)
+    response.headers[Pdf_Version_Header] = "full"
+    return response
+  if os.path.exists(_previewPath(route_id)):
+    _pdf_requests.inc(result = "preview")
+    response = flask.send_file(_previewPath(route_id), mimetype = "application/pdf")
+    response.headers[Pdf_Version_Header] = "preview"
+    # The full PDF will be along shortly, at the same URL:
+    response.headers["Cache-Control"] = "no-store"
+    return response
+  _pdf_requests.inc(result = "missing")
+  return flask.render_template('regen.html', route_id = route_id)
+
+@blueprint.route('/routes/<int:route_id>/status')
+def route_status(route_id):
+  '''Says which PDF /pdfs/<route_id>.pdf will serve ('full', 'preview' or
+  'none'), and whether the full PDF is being rendered right now.'''
+  pdf = "none"
+  if os.path.exists(_pdfPath(route_id)):
+    pdf = "full"
+  elif os.path.exists(_previewPath(route_id)):
+    pdf = "preview"
+  return flask.jsonify(route_id  = route_id,
+                       pdf       = pdf,
+                       rendering = route_id in _background_renders)
+
+@blueprint.route('/metrics')
+def get_metrics():
+  return flask.Response(roboviva.metrics.render(),
+                        mimetype = "text/plain; version=0.0.4")
+
+# Admin pages list the cache this many entries at a time (at most
+# Cache_Max_Page_Size, with ?per_page=):
+Cache_Page_Size     = 100
+Cache_Max_Page_Size = 1000
+# Purges delete this many entries per trip to the cache db:
+Purge_Batch_Size    = 100
+
+def _ageString(age):
+  '''Returns 'age' (in seconds) in the most sensible units.'''
+  if age < 60:
+    return "%d sec" % age
+  elif age < 3600:
+    return "%d min" % (age / 60.)
+  elif age < 86400:
+    return "%d hr" % (age / 3600.)
+  return "%.1f days" % (age / 86400.)
+
+def _cacheQuery():
+  '''Returns the (cache_index.Query, page, per_page) asked for by the
+  request's arguments:
+
+    min_age, max_age   - in seconds
+    min_size, max_size - of the PDF, in bytes
+    min_id, max_id     - route ids
+    sort               - 'age' (the default), 'id' or 'size'
+    order              - 'asc' (the default) or 'desc'
+    page, per_page     - which page of matching entries to list, from 1
+
+  Throws a ValueError if they don't make sense.'''
+  args = flask.request.args
+  def number(name, convert = int):
+    value = args.get(name, "").strip()
+    return convert(value) if value else None
+  query = roboviva.cache_index.Query(time.time(),
+                                     min_age    = number('min_age', float),
+                                     max_age    = number('max_age', float),
+                                     min_size   = number('min_size'),
+                                     max_size   = number('max_size'),
+                                     min_id     = number('min_id'),
+                                     max_id     = number('max_id'),
+                                     sort       = args.get('sort', 'age'),
+                                     descending = args.get('order') == 'desc')
+  page     = number('page') or 1
+  per_page = number('per_page') or Cache_Page_Size
+  if page < 1 or not 1 <= per_page <= Cache_Max_Page_Size:
+    raise ValueError("page must be >= 1, and per_page between 1 and %d" %
+                     Cache_Max_Page_Size)
+  return query, page, per_page
+
+def _badCacheQuery(error):
+  return flask.Response("Bad query: %s\n" % error, status = 400, mimetype = "text/plain")
 
 @blueprint.route('/cache')
 def dump_cache():
-  hash_db = flask.ext.shelve.get_shelve('c')
-  ents = []
-  for route_id in hash_db:
-    md5_sum, ts = hash_db[route_id]
-    ents.append( (ts, route_id, md5_sum) )
+  '''Lists a page of cache entries; see _cacheQuery() for the arguments.'''
+  try:
+    query, page, per_page = _cacheQuery()
+  except ValueError as e:
+    return _badCacheQuery(e)
+  index      = _cacheIndex()
+  n_entries  = index.count()
+  n_matching = index.count(query)
+  rows       = index.select(query, per_page, (page - 1) * per_page)
+  version    = _configuredRenderer().version
+  args       = flask.request.args.to_dict()
+
+  def pageLink(page, text):
+    return "<a href=%s>%s</a>\n" % (flask.url_for('roboviva.dump_cache', **dict(args, page = page)), text)
 
-  ret  = "Cache has %d entries\n" % len(hash_db)
+  def generate():
+    yield "Cache has %d entries (current renderer: %s)\n" % (n_entries, version)
+    yield "%d match; showing %d - %d\n" % (n_matching,
+                                          min(n_matching, (page - 1) * per_page + 1),
+                                          (page - 1) * per_page + len(rows))
+    yield "<table border=1>\n"
+    yield "  <tr><th>route id</th><th>md5</th><th>renderer</th><th>size</th><th>age</th><th>Remove?</th></tr>\n"
+    now = time.time()
+    for route_id, etag, timestamp, renderer_version, pdf_size in rows:
+      yield ("  <tr>\n"
+             "    <td>%s</td>\n"
+             "    <td>%s</td>\n"
+             "    <td>%s</td>\n"
+             "    <td>%s</td>\n"
+             "    <td>%s</td>\n"
+             "    <td><a href=%s>Remove</a></td>\n"
+             "  </tr>\n") % (route_id,
+                             etag,
+                             renderer_version,
+                             "-" if pdf_size is None else "%d kB" % (pdf_size / 1024),
+                             _ageString(now - timestamp),
+                             flask.url_for('roboviva.remove_route', route_id = route_id))
+    yield "</table>\n"
+    if page > 1:
+      yield pageLink(page - 1, "Previous")
+    if page * per_page < n_matching:
+      yield pageLink(page + 1, "Next")
+
+  return flask.Response(flask.stream_with_context(generate()))
+
+@blueprint.route('/cache.json')
+def dump_cache_json():
+  '''dump_cache(), as JSON.'''
+  try:
+    query, page, per_page = _cacheQuery()
+  except ValueError as e:
+    return _badCacheQuery(e)
+  index = _cacheIndex()
+  header = { "entries"          : index.count(),
+             "matching"         : index.count(query),
+             "page"             : page,
+             "per_page"         : per_page,
+             "renderer_version" : _configuredRenderer().version }
+  rows = index.select(query, per_page, (page - 1) * per_page)
+
+  def generate():
+    # All but the closing "}" of the header, then the page of entries:
+    yield json.dumps(header, sort_keys = True)[:-1] + ', "routes": ['
+    for n, (route_id, etag, timestamp, renderer_version, pdf_size) in enumerate(rows):
+      yield (", " if n else "") + json.dumps({ "route_id"         : route_id,
+                                               "etag"             : etag,
+                                               "timestamp"        : timestamp,
+                                               "renderer_version" : renderer_version,
+                                               "pdf_size"         : pdf_size },
+                                             sort_keys = True)
+    yield "]}"
+
+  return flask.Response(generate(), mimetype = "application/json")
+
+@blueprint.route('/cache/reindex')
+def reindex_cache():
+  '''Rebuilds the cache index from the cache db.'''
+  with _cacheDb() as hash_db:
+    n_entries = _cacheIndex(hash_db).rebuild(_indexEntries(hash_db))
+  flask.current_app.logger.warning("[reindex] %d entries", n_entries)
+  return "%d entries indexed" % n_entries
+
+@blueprint.route('/cache/negative')
+def dump_negative_cache():
+  now = time.time()
+  ret  = "Unknown routes: %d entries\n" % len(_unknown_routes.items())
   ret += "<table border=1>\n"
-  ret += "  <tr><th>route id</th><th>md5</th><th>age</th><th>Remove?</th></tr>\n"
-  for timestamp, route_id, md5_sum in sorted(ents):
-    ret += "  <tr>\n"
-    ret += "    <td>%s</td>\n" % route_id
-    ret += "    <td>%s</td>\n" % md5_sum
-    age = time.time() - timestamp
-    age_str = ""
-    if age < 60:
-      age_str = "%d sec" % age
-    elif age > 60 and age < 3600:
-      age_str = "%d min" % (age / 60.)
-    elif age > 3600 and age < 86400:
-      age_str = "%d hr" % (age / 3600.)
-    else:
-      age_str = "%.1f days" % (age / 86400.)
-    ret += "    <td>%s</td>\n" % age_str
-    ret += "    <td><a href=%s>Remove</a></td>\n" % (flask.url_for('roboviva.remove_route',
-                                                                    route_id = route_id))
-    ret += "  </tr>\n"
+  ret += "  <tr><th>route id</th><th>error</th><th>expires in</th></tr>\n"
+  for route_id, error, expires_at in _unknown_routes.items():
+    ret += "  <tr><td>%s</td><td>%s</td><td>%d sec</td></tr>\n" % (
+        route_id, flask.escape(error), expires_at - now)
+  ret += "</table>\n"
+  ret += "Failed renders: %d entries\n" % len(_failed_renders.items())
+  ret += "<table border=1>\n"
+  ret += "  <tr><th>latex sha1</th><th>route id</th><th>error</th><th>expires in</th></tr>\n"
+  for latex_hash, (route_id, error), expires_at in _failed_renders.items():
+    ret += "  <tr><td>%s</td><td>%s</td><td>%s</td><td>%d sec</td></tr>\n" % (
+        latex_hash, route_id, flask.escape(error), expires_at - now)
   ret += "</table>\n"
+  ret += "<a href=%s>Clear both</a>\n" % flask.url_for('roboviva.clear_negative_cache')
   return ret
 
+@blueprint.route('/cache/negative/clear')
+def clear_negative_cache():
+  n_entries = len(_unknown_routes) + len(_failed_renders)
+  _unknown_routes.clear()
+  _failed_renders.clear()
+  flask.current_app.logger.warning("[negative] cleared %d entries", n_entries)
+  return "%d entries cleared" % n_entries
+
 @blueprint.route('/cache/remove/<int:route_id>')
 def remove_route(route_id):
-  hash_db = flask.ext.shelve.get_shelve('c')
-  ret = ""
   db_key = str(route_id)
-  if db_key in hash_db:
-    del hash_db[db_key]
-    ret = "%s removed from cache" % route_id
-  else:
-    ret = "%s not found in cache" % route_id
-  return ret
+  with _cacheDb() as hash_db:
+    found = db_key in hash_db
+    if found:
+      del hash_db[db_key]
+    _cacheIndex(hash_db).remove([route_id])
+  if found:
+    return "%s removed from cache" % route_id
+  return "%s not found in cache" % route_id
 
 @blueprint.route('/cache/purge/<int:delete_older_than>')
 def purge_cache(delete_older_than):
+  '''Deletes the cached PDFs of routes rendered more than 'delete_older_than'
+  seconds ago, listing them as it goes.'''
   log = flask.current_app.logger
-  cache_dir = flask.current_app.config['PDF_CACHE_DIR']
-  hash_db = flask.ext.shelve.get_shelve('c')
+  index = _cacheIndex()
+  query = roboviva.cache_index.Query(time.time(), min_age = delete_older_than)
   log.warning("[purge] starting: age: %s", delete_older_than)
-  bytes_deleted   = 0
-  bytes_remaining = 0
-  ret = ""
-  ret += "Cache has %d entries\n" % len(hash_db)
 
-  ret += "<table border=1>\n"
-  ret += "  <tr><th>route id</th><th>md5</th><th>age (s)</th><th>status</th></tr>\n"
-  for route_id in hash_db:
-    h, ts = hash_db[route_id]
-    pdf_filename = "%s.pdf" % (route_id)
-    pdf_filepath = os.path.join(cache_dir, pdf_filename)
-    status = ""
-    if (time.time() - ts > delete_older_than):
-      log.warning("[purge]: Nuking %s (%d sec old): %s",
-          route_id, time.time() - ts, pdf_filepath)
-      try:
-        file_size = os.stat(pdf_filepath).st_size
-        os.unlink(pdf_filepath)
-        bytes_deleted += file_size
-        status = "DELETED"
-      except Exception as e:
-        log.error("[purge]: Error unlinking %s: %s", pdf_filepath, e)
-        status = "ERROR"
-      del hash_db[route_id]
-    else:
-      file_size = os.stat(pdf_filepath).st_size
-      bytes_remaining += file_size
-    ret += "  <tr><td>%s</td><td>%s</td><td>%d</td><td>%s</td></tr>\n" % \
-        (route_id, h, time.time() - ts, status)
-  ret += "</table>\n"
-  ret += "%d kB deleted, %d kB remaining" % (bytes_deleted / 1024, bytes_remaining / 1024)
-  return ret
+  def generate():
+    bytes_deleted = 0
+    yield "Cache has %d entries\n" % index.count()
+    yield "<table border=1>\n"
+    yield "  <tr><th>route id</th><th>md5</th><th>age (s)</th><th>status</th></tr>\n"
+    # Each batch is deleted from the index along with the db, so the next
+    # batch is always the first page of what's left:
+    while True:
+      rows = index.select(query, Purge_Batch_Size)
+      if not rows:
+        break
+      statuses = []
+      with _cacheDb() as hash_db:
+        for route_id, etag, timestamp, _, _ in rows:
+          pdf_filepath = _pdfPath(route_id)
+          log.warning("[purge]: Nuking %s (%d sec old): %s",
+              route_id, time.time() - timestamp, pdf_filepath)
+          try:
+            file_size = os.stat(pdf_filepath).st_size
+            os.unlink(pdf_filepath)
+            bytes_deleted += file_size
+            statuses.append("DELETED")
+          except Exception as e:
+            log.error("[purge]: Error unlinking %s: %s", pdf_filepath, e)
+            statuses.append("ERROR")
+          if str(route_id) in hash_db:
+            del hash_db[str(route_id)]
+        index.remove([row[0] for row in rows])
+      now = time.time()
+      for (route_id, etag, timestamp, _, _), status in zip(rows, statuses):
+        yield "  <tr><td>%s</td><td>%s</td><td>%d</td><td>%s</td></tr>\n" % \
+            (route_id, etag, now - timestamp, status)
+    yield "</table>\n"
+    yield "%d kB deleted, %d kB remaining" % (bytes_deleted / 1024, index.totalSize() / 1024)
 
+  return flask.Response(flask.stream_with_context(generate()))
@@ -1,8 +1,16 @@
 import roboviva
+import roboviva.assets
+import roboviva.standin
 import unittest
 import flask.ext
 import tempfile
+import glob
+import json
+import contextlib
+import shutil
 import os
+import time
+import threading
 
 
 class RobovivaTestCase(unittest.TestCase):
@@ -12,13 +20,424 @@ class RobovivaTestCase(unittest.TestCase):
     self.app = roboviva.app.test_client()
 
   def tearDown(self):
-    os.unlink(roboviva.app.config['SHELVE_FILENAME'] + '.db')
+    # Depending on the dbm backend, the shelf may be spread across several
+    # files (or not exist at all, if the test never touched it):
+    for filename in glob.glob(roboviva.app.config['SHELVE_FILENAME'] + '.*'):
+      os.unlink(filename)
+    roboviva.views._unknown_routes.clear()
+    roboviva.views._failed_renders.clear()
 
   def test_Empty(self):
     # Verify cache is empty at launch:
     ret = self.app.get("/roboviva/cache")
     self.assertTrue('Cache has 0 entries' in ret.data)
 
+  def test_LegacyCacheEntry(self):
+    # Entries written before renderer versions were tracked are still listed,
+    # as made by an unknown (so, outdated) renderer:
+    with roboviva.app.test_request_context():
+      flask.ext.shelve.get_shelve('c')['12345'] = ('"legacy"', time.time())
+    ret = self.app.get("/roboviva/cache")
+    self.assertTrue('Cache has 1 entries' in ret.data)
+    self.assertTrue('<td>"legacy"</td>' in ret.data)
+    self.assertTrue('<td>None</td>' in ret.data)
+
+  @contextlib.contextmanager
+  def standIn(self, **kwargs):
+    '''Points the app at a local RideWithGPS stand-in, and at empty PDF and
+    route caches, for the duration of the block. Yields the stand-in server
+    and the cache directory.'''
+    server = roboviva.standin.StandInServer(**kwargs).start()
+    original_base_url = roboviva.ridewithgps.Base_Url
+    original_dirs = (roboviva.app.config['PDF_CACHE_DIR'],
+                     roboviva.app.config['ROUTE_CACHE_DIR'])
+    cache_dir = tempfile.mkdtemp()
+    roboviva.ridewithgps.Base_Url = server.url
+    roboviva.app.config['PDF_CACHE_DIR'] = cache_dir
+    roboviva.app.config['ROUTE_CACHE_DIR'] = os.path.join(cache_dir, 'routes')
+    try:
+      yield server, cache_dir
+    finally:
+      roboviva.ridewithgps.Base_Url = original_base_url
+      (roboviva.app.config['PDF_CACHE_DIR'],
+       roboviva.app.config['ROUTE_CACHE_DIR']) = original_dirs
+      server.stop()
+      shutil.rmtree(cache_dir)
+
+  def test_CacheAdminViews(self):
+    now = time.time()
+    with roboviva.app.test_request_context():
+      hash_db = flask.ext.shelve.get_shelve('c')
+      for route_id in range(1, 6):
+        hash_db[str(route_id)] = ('"etag%d"' % route_id, now - route_id * 1000, "v1", None)
+
+    ret = self.app.get("/roboviva/cache?per_page=2&sort=id")
+    self.assertTrue('Cache has 5 entries' in ret.data)
+    self.assertTrue('<td>"etag1"</td>' in ret.data)
+    self.assertTrue('<td>"etag2"</td>' in ret.data)
+    self.assertFalse('<td>"etag3"</td>' in ret.data)
+    self.assertTrue('page=2' in ret.data)
+
+    ret = self.app.get("/roboviva/cache.json?min_age=2500&sort=id&order=desc")
+    data = json.loads(ret.data)
+    self.assertEqual(5, data["entries"])
+    self.assertEqual(3, data["matching"])
+    self.assertEqual([5, 4, 3], [route["route_id"] for route in data["routes"]])
+
+    self.assertEqual(400, self.app.get("/roboviva/cache?sort=etag").status_code)
+    self.assertEqual(400, self.app.get("/roboviva/cache?min_id=x").status_code)
+
+    ret = self.app.get("/roboviva/cache/purge/3500")
+    self.assertTrue('<td>4</td>' in ret.data and '<td>5</td>' in ret.data)
+    self.app.get("/roboviva/cache/remove/1")
+    with roboviva.app.test_request_context():
+      self.assertEqual(['2', '3'], sorted(flask.ext.shelve.get_shelve('c').keys()))
+    data = json.loads(self.app.get("/roboviva/cache.json").data)
+    self.assertEqual([3, 2], [route["route_id"] for route in data["routes"]])
+
+  def test_UnchangedCueSheetNotRerendered(self):
+    # A new ETag whose route prints the same as what we've cached just
+    # updates the cache entry, and keeps the cached PDF:
+    Route_Id = 6260667
+    with self.standIn() as (server, cache_dir):
+      cur_etag, route = roboviva.ridewithgps.getETagAndCuesheet_viaJSON(Route_Id)
+      with open(os.path.join(cache_dir, '%d.pdf' % Route_Id), 'wb') as pdf:
+        pdf.write("cached pdf")
+      with roboviva.app.test_request_context():
+        flask.ext.shelve.get_shelve('c')[str(Route_Id)] = (
+            '"old"', 0, roboviva.latex.Renderer_Version,
+            roboviva.latex.routeFingerprint(route))
+
+      ret = self.app.get("/roboviva/routes/%d" % Route_Id)
+      self.assertEqual(302, ret.status_code)
+      with open(os.path.join(cache_dir, '%d.pdf' % Route_Id), 'rb') as pdf:
+        self.assertEqual("cached pdf", pdf.read())
+      with roboviva.app.test_request_context():
+        entry = flask.ext.shelve.get_shelve('c')[str(Route_Id)]
+      self.assertEqual(cur_etag, entry[0])
+
+  def test_UnknownRouteNegativeCached(self):
+    # Unknown routes are only looked up once, until the entry is cleared:
+    with self.standIn(synthesize = False) as (server, cache_dir):
+      for _ in range(2):
+        ret = self.app.get("/roboviva/routes/12345")
+        self.assertTrue("not a valid RideWithGPS Route" in ret.data)
+      self.assertEqual(1, server.counts['404'])
+
+      ret = self.app.get("/roboviva/cache/negative")
+      self.assertTrue("<td>12345</td>" in ret.data)
+      self.app.get("/roboviva/cache/negative/clear")
+      self.assertFalse("<td>12345</td>" in self.app.get("/roboviva/cache/negative").data)
+
+      self.app.get("/roboviva/routes/12345")
+      self.assertEqual(2, server.counts['404'])
+
+  def test_RefusedRouteNotNegativeCached(self):
+    # A route RideWithGPS won't give us (e.g. a private one) may not stay
+    # that way, so it's asked about every time:
+    with self.standIn() as (server, cache_dir):
+      server.injectFault = lambda: 'forbidden'
+      for _ in range(2):
+        ret = self.app.get("/roboviva/routes/6260667")
+        self.assertTrue("Is it private?" in ret.data)
+      self.assertEqual(502, self.app.get("/roboviva/routes/6260667.json").status_code)
+      self.assertEqual(3, server.counts['403'])
+    self.assertEqual(roboviva.app.config['UNKNOWN_ROUTE_TTL_SECS'],
+                     roboviva.views._unknown_routes.ttl_secs)
+    self.assertEqual(roboviva.app.config['FAILED_RENDER_TTL_SECS'],
+                     roboviva.views._failed_renders.ttl_secs)
+
+  def test_CacheDbNotHeldDuringFetch(self):
+    # A slow fetch from RideWithGPS mustn't keep other requests out of the db:
+    with self.standIn(synthesize = False, latency_secs = 0.5) as (server, cache_dir):
+      client = roboviva.app.test_client()
+      request = threading.Thread(target = client.get, args = ("/roboviva/routes/12345",))
+      request.start()
+      time.sleep(0.2)
+      start = time.time()
+      with roboviva.app.test_request_context():
+        flask.ext.shelve.get_shelve('c')
+      waited = time.time() - start
+      request.join()
+      self.assertTrue(waited < 0.2, waited)
+      self.assertEqual(1, server.counts['404'])
+
+  def test_CacheDbNests(self):
+    # Opening the cache db inside a block that already has it open (as
+    # _cacheIndex() does, when there's no index yet) reuses it, rather than
+    # waiting on itself. Other threads wait until it's closed:
+    events = []
+    def nest():
+      with roboviva.app.test_request_context():
+        with roboviva.views._cacheDb() as outer:
+          outer['1'] = ('"1"', time.time())
+          with roboviva.views._cacheDb() as inner:
+            self.assertTrue(inner is outer)
+            roboviva.views._cacheIndex()
+          events.append("nested")
+          other.start()
+          time.sleep(0.2)
+          events.append("closed")
+    def wait():
+      with roboviva.app.test_request_context(), roboviva.views._cacheDb() as hash_db:
+        events.append("other: %s" % hash_db.keys())
+    other = threading.Thread(target = wait)
+    thread = threading.Thread(target = nest)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    self.assertFalse(thread.is_alive(), "nested _cacheDb() deadlocked")
+    other.join(5)
+    self.assertEqual(["nested", "closed", "other: ['1']"], events)
+
+  def test_BuiltAssets(self):
+    asset_dir = tempfile.mkdtemp()
+    original_asset_dir = roboviva.app.config['ASSET_DIR']
+    roboviva.app.config['ASSET_DIR'] = os.path.join(asset_dir, 'build')
+    try:
+      # Not built yet, so the originals are served:
+      ret = self.app.get("/roboviva/")
+      self.assertTrue('href="robo.css"' in ret.data)
+
+      manifest = roboviva.assets.buildAssets(
+          os.path.join(roboviva.app.root_path, 'static'), roboviva.app.config['ASSET_DIR'])
+      ret = self.app.get("/roboviva/")
+      self.assertTrue('href="%s"' % manifest['robo.css'] in ret.data)
+      self.assertEqual("no-cache", ret.headers['Cache-Control'])
+
+      ret = self.app.get("/roboviva/" + manifest['robo.css'],
+                         headers = [('Accept-Encoding', 'gzip, deflate')])
+      self.assertEqual("gzip", ret.headers['Content-Encoding'])
+      self.assertEqual("text/css", ret.mimetype)
+      self.assertEqual(roboviva.views.Immutable_Cache_Control, ret.headers['Cache-Control'])
+      self.assertTrue("Accept-Encoding" in ret.headers['Vary'])
+
+      ret = self.app.get("/roboviva/" + manifest['robo.css'])
+      self.assertFalse('Content-Encoding' in ret.headers)
+      self.assertTrue('.viva_button_enabled' in ret.data)
+
+      # The precompressed copies aren't served as themselves:
+      self.assertEqual(404, self.app.get("/roboviva/" + manifest['robo.css'] + ".gz").status_code)
+
+      # Old, unhashed URLs still work, as do the templates:
+      self.assertEqual(200, self.app.get("/roboviva/robo.css").status_code)
+      with roboviva.app.test_request_context():
+        page = flask.render_template('error.html', error = "Oops")
+      self.assertTrue(manifest['robo.css'] in page)
+    finally:
+      roboviva.app.config['ASSET_DIR'] = original_asset_dir
+      shutil.rmtree(asset_dir)
+
+  def test_CueSheetFormats(self):
+    with self.standIn() as (server, cache_dir):
+      ret = self.app.get("/roboviva/routes/123.json")
+      self.assertEqual(200, ret.status_code)
+      self.assertEqual("application/json", ret.mimetype)
+      data = json.loads(ret.data)
+      self.assertEqual(123, data["route_id"])
+      self.assertTrue(len(data["entries"]) >= 60)
+      self.assertEqual(1, server.counts['200'])
+
+      # The others come from the stored route, revalidated with RideWithGPS:
+      ret = self.app.get("/roboviva/routes/123.txt")
+      self.assertEqual("text/plain", ret.mimetype)
+      self.assertTrue("Route #123" in ret.data)
+      ret = self.app.get("/roboviva/routes/123.html")
+      self.assertEqual("text/html", ret.mimetype)
+      self.assertTrue("<table>" in ret.data)
+      self.assertEqual(1, server.counts['200'])
+      self.assertEqual(2, server.counts['304'])
+      self.assertEqual([], glob.glob(os.path.join(cache_dir, "*.pdf")))
+
+      # ...and we revalidate our clients in turn:
+      etag = ret.headers['ETag']
+      ret = self.app.get("/roboviva/routes/123.html", headers = [('If-None-Match', etag)])
+      self.assertEqual(304, ret.status_code)
+      server.bump(123)
+      ret = self.app.get("/roboviva/routes/123.html", headers = [('If-None-Match', etag)])
+      self.assertEqual(200, ret.status_code)
+      self.assertNotEqual(etag, ret.headers['ETag'])
+
+    with self.standIn(synthesize = False) as (server, cache_dir):
+      self.assertEqual(404, self.app.get("/roboviva/routes/12345.json").status_code)
+
+  def test_RequestDeadline(self):
+    roboviva.app.config['REQUEST_DEADLINE_SECS'] = 0.2
+    try:
+      with self.standIn(latency_secs = 1.0) as (server, cache_dir):
+        start = time.time()
+        ret = self.app.get("/roboviva/routes/6260667")
+        self.assertTrue(time.time() - start < 0.8)
+        self.assertTrue("That took too long" in ret.data)
+
+        # With a PDF on hand, that's served instead, stale or not:
+        with open(os.path.join(cache_dir, "6260667.pdf"), "wb") as pdf:
+          pdf.write("stale pdf")
+        ret = self.app.get("/roboviva/routes/6260667")
+        self.assertEqual(302, ret.status_code)
+        self.assertTrue(ret.location.endswith("/roboviva/pdfs/6260667.pdf"))
+      self.assertTrue('roboviva_deadlines_exceeded_total{stage="fetch"} 2' in
+                      self.app.get("/roboviva/metrics").data)
+    finally:
+      roboviva.app.config['REQUEST_DEADLINE_SECS'] = 30
+
+  def test_LatexCheckFailed(self):
+    # LaTeX that fails latex_check never makes it to pdflatex:
+    make_latex = roboviva.latex.makeLatex
+    roboviva.latex.makeLatex = lambda route: make_latex(route) + "\\bogus{"
+    try:
+      with self.standIn() as (server, cache_dir):
+        ret = self.app.get("/roboviva/routes/6260667")
+        self.assertTrue("0xBB - LaTeX Check Failed" in ret.data)
+        self.assertFalse(os.path.exists(os.path.join(cache_dir, "6260667.pdf")))
+      self.assertTrue('roboviva_request_errors_total{stage="latex_check"} 1' in
+                      self.app.get("/roboviva/metrics").data)
+    finally:
+      roboviva.latex.makeLatex = make_latex
+
+  def test_PreviewThenFull(self):
+    with self.standIn() as (server, cache_dir):
+      ret = self.app.get("/roboviva/routes/123/status")
+      self.assertEqual({"route_id" : 123, "pdf" : "none", "rendering" : False},
+                       json.loads(ret.data))
+
+      with open(os.path.join(cache_dir, "123.preview.pdf"), "wb") as pdf:
+        pdf.write("preview pdf")
+      ret = self.app.get("/roboviva/pdfs/123.pdf")
+      self.assertEqual("preview pdf", ret.data)
+      self.assertEqual("preview", ret.headers["X-Roboviva-Pdf-Version"])
+      self.assertEqual("preview", json.loads(self.app.get("/roboviva/routes/123/status").data)["pdf"])
+
+      with open(os.path.join(cache_dir, "123.pdf"), "wb") as pdf:
+        pdf.write("full pdf")
+      ret = self.app.get("/roboviva/pdfs/123.pdf")
+      self.assertEqual("full pdf", ret.data)
+      self.assertEqual("full", ret.headers["X-Roboviva-Pdf-Version"])
+
+  def test_UnknownRenderer(self):
+    ret = self.app.get("/roboviva/routes/6260667?renderer=crayon")
+    self.assertTrue("Unknown renderer; try one of: latex, reportlab" in ret.data)
+
+  def test_OtherRendererNotCached(self):
+    # Asking for a renderer other than the configured one gets its PDF, but
+    # leaves the cached PDF and cache entry alone:
+    class Crayon(object):
+      name    = "crayon"
+      version = "crayon-1"
+      def available(self):
+        return True
+      def render(self, route, stats = None):
+        return "crayon pdf for %s" % route.id
+    roboviva.renderers.register(Crayon())
+    try:
+      with self.standIn() as (server, cache_dir):
+        with open(os.path.join(cache_dir, "6260667.pdf"), "wb") as pdf:
+          pdf.write("cached pdf")
+        with roboviva.app.test_request_context():
+          flask.ext.shelve.get_shelve('c')['6260667'] = ('"old"', 0, "v1", None)
+
+        ret = self.app.get("/roboviva/routes/6260667?renderer=crayon")
+        self.assertEqual("application/pdf", ret.mimetype)
+        self.assertEqual("crayon pdf for 6260667", ret.data)
+        self.assertEqual(["6260667.pdf", "routes"], sorted(os.listdir(cache_dir)))
+        with open(os.path.join(cache_dir, "6260667.pdf"), "rb") as pdf:
+          self.assertEqual("cached pdf", pdf.read())
+        with roboviva.app.test_request_context():
+          self.assertEqual(('"old"', 0, "v1", None),
+                           flask.ext.shelve.get_shelve('c')['6260667'])
+    finally:
+      del roboviva.renderers._renderers["crayon"]
+
+  def test_TransportErrors(self):
+    # Errors that aren't RideWithGpsErrors (here, a dropped connection) get an
+    # error page or status, not a 500:
+    original_breaker = roboviva.ridewithgps.breaker
+    roboviva.ridewithgps.breaker = roboviva.upstream.CircuitBreaker(10, 60)
+    try:
+      with self.standIn() as (server, cache_dir):
+        server.injectFault = lambda: 'garbled'
+        self.assertEqual(503, self.app.get("/roboviva/routes/6260667.json").status_code)
+        ret = self.app.get("/roboviva/pack?routes=6260667")
+        self.assertEqual(200, ret.status_code)
+        self.assertTrue("0xFA" in ret.data)
+        self.assertEqual(2, server.counts['garbled'])
+    finally:
+      roboviva.ridewithgps.breaker = original_breaker
+
+  def test_PackUnknownRouteNegativeCached(self):
+    with self.standIn(synthesize = False) as (server, cache_dir):
+      for _ in range(2):
+        ret = self.app.get("/roboviva/pack?routes=12345")
+        self.assertTrue("12345" in ret.data)
+      self.assertEqual(1, server.counts['404'])
+
+  def test_PdfWritesAreAtomic(self):
+    # A reader of the old PDF keeps reading the old PDF, and no temp files
+    # are left behind:
+    cache_dir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(cache_dir, "123.pdf")
+      roboviva.views._writeAtomically(path, "old pdf")
+      with open(path, "rb") as reader:
+        roboviva.views._writeAtomically(path, "new pdf")
+        self.assertEqual("old pdf", reader.read())
+      with open(path, "rb") as reader:
+        self.assertEqual("new pdf", reader.read())
+      self.assertEqual(["123.pdf"], os.listdir(cache_dir))
+      self.assertEqual(0644, os.stat(path).st_mode & 0777)
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_PackNeedsRoutes(self):
+    for query in ("", "?routes=", "?routes=1,x", "?routes=" + ",".join(["1"] * 21)):
+      ret = self.app.get("/roboviva/pack" + query)
+      self.assertTrue("Packs need between 1 and 20 route numbers" in ret.data)
+
+  def test_Metrics(self):
+    ret = self.app.get("/roboviva/metrics")
+    self.assertEqual(200, ret.status_code)
+    self.assertTrue('# TYPE roboviva_stage_seconds histogram' in ret.data)
+    self.assertTrue('roboviva_latex_row_cache_hit_rate' in ret.data)
+
+  def test_ProfileOnDemand(self):
+    profile_dir = tempfile.mkdtemp()
+    roboviva.app.config['PROFILE_DIR'] = profile_dir
+    roboviva.app.config['PROFILE_ADMIN_TOKEN'] = 'secret'
+    try:
+      # Wrong token: no profile.
+      self.app.get("/roboviva/metrics?profile=wrong")
+      self.assertEqual([], os.listdir(profile_dir))
+      self.app.get("/roboviva/metrics?profile=secret")
+      written = sorted(os.listdir(profile_dir))
+      self.assertEqual(2, len(written))
+      self.assertTrue(written[0].endswith(".folded"))
+      self.assertTrue(written[1].endswith(".json"))
+    finally:
+      roboviva.app.config['PROFILE_ADMIN_TOKEN'] = None
+      shutil.rmtree(profile_dir)
+
+  def test_ProfileOfFailedRequest(self):
+    # A view that raises still has its sampler stopped, and its profile kept:
+    profile_dir = tempfile.mkdtemp()
+    roboviva.app.config['PROFILE_DIR'] = profile_dir
+    roboviva.app.config['PROFILE_ADMIN_TOKEN'] = 'secret'
+    render = roboviva.metrics.render
+    def broken():
+      raise ValueError("broken metrics")
+    roboviva.metrics.render = broken
+    try:
+      self.assertRaises(ValueError, self.app.get, "/roboviva/metrics?profile=secret")
+      self.assertEqual([], [thread for thread in threading.enumerate()
+                            if thread.name.startswith("profiler-")])
+      info = [name for name in os.listdir(profile_dir) if name.endswith(".json")]
+      self.assertEqual(1, len(info))
+      with open(os.path.join(profile_dir, info[0])) as info_file:
+        self.assertEqual("broken metrics", json.load(info_file)['error'])
+    finally:
+      roboviva.metrics.render = render
+      roboviva.app.config['PROFILE_ADMIN_TOKEN'] = None
+      shutil.rmtree(profile_dir)
+
   def test_CacheAdd(self):
     # Generate a route, verify it ends up in the cache:
     Route_Id = "6260667"
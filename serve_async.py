@@ -0,0 +1,57 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Serves Roboviva from a single process that keeps many requests in flight at
+once.
+
+Flask (and Python 2) have no asyncio, so instead this runs the unchanged app
+under gevent: after monkey-patching, the sockets urllib2 uses to talk to
+RideWithGPS, the pdflatex subprocess waits, and the render worker threads all
+yield to other requests while they wait, and each request costs a greenlet
+rather than an OS thread. The URLs are exactly the ones run.py serves.
+
+Needs gevent (pip install gevent), which the rest of Roboviva doesn't.
+
+Example:
+  python serve_async.py --port 8000 --max-connections 500
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+
+import gevent.pool
+import gevent.pywsgi
+
+from roboviva import app
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Serve Roboviva under gevent.")
+  parser.add_argument("--host", default = "127.0.0.1",
+                      help = "Address to listen on.")
+  parser.add_argument("--port", type = int, default = 5000,
+                      help = "Port to listen on.")
+  parser.add_argument("--max-connections", type = int, default = 1000,
+                      help = "Most requests to have in flight at once.")
+  args = parser.parse_args()
+
+  server = gevent.pywsgi.WSGIServer((args.host, args.port), app,
+                                    spawn = gevent.pool.Pool(args.max_connections))
+  print "Serving on http://%s:%d/roboviva/" % (args.host, args.port)
+  server.serve_forever()
@@ -0,0 +1,116 @@
+# Roboviva - Better cue sheets for everyone
+# Copyright (C) 2015 Mike Kocurek
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Revalidates cached routes against RideWithGPS in bulk, and re-renders the
+ones that changed, so e.g. event-day traffic finds fresh sheets already in
+the cache.
+
+Routes are checked least-recently-rendered first, with conditional requests
+(an unchanged route costs RideWithGPS a 304, not a full export), from a few
+worker threads and at a bounded rate. Run it from cron, or by hand before a
+big ride.
+
+Usage: sweep_cache.py [--limit N] [--older-than SECS] [--workers N] [--rate N] [--dry-run]
+'''
+
+import argparse
+import sys
+import time
+
+import roboviva
+from roboviva import latex
+from roboviva import ridewithgps
+from roboviva import sweeper
+from roboviva import views
+
+def cachedRoutes(older_than_secs):
+  '''Returns the cache entries last rendered more than 'older_than_secs'
+  ago, as (timestamp, route_id, etag, renderer_version, fingerprint) tuples,
+  oldest first.'''
+  now = time.time()
+  entries = []
+  with roboviva.app.test_request_context(), views._cacheDb() as hash_db:
+    for route_id in hash_db:
+      etag, timestamp, version, fingerprint = views._cacheEntry(hash_db, route_id)
+      if now - timestamp > older_than_secs:
+        entries.append((timestamp, route_id, etag, version, fingerprint))
+  return sorted(entries)
+
+def refreshRoute(route_id, etag, route, cached_version, cached_fingerprint):
+  '''Stores a changed route, and re-renders it if its cue sheet changed.
+  Returns "RENDERED", "UNCHANGED" (new ETag, same sheet) or "FAILED".'''
+  with roboviva.app.test_request_context():
+    views._routeStore().put(route_id, etag, route)
+    result = "UNCHANGED"
+    if (latex.routeFingerprint(route) != cached_fingerprint or
+        cached_version != views._configuredRenderer().version):
+      if views._renderRoute(int(route_id), route):
+        return "FAILED"
+      result = "RENDERED"
+    with views._cacheDb() as hash_db:
+      views._markRendered(hash_db, route_id, etag, route)
+    return result
+
+def main(argv):
+  parser = argparse.ArgumentParser(description = "Revalidate cached routes.")
+  parser.add_argument("--limit", type = int, default = 0,
+                      help = "Check at most this many routes (0: all)")
+  parser.add_argument("--older-than", type = float, default = 0,
+                      help = "Only check routes last rendered more than this many seconds ago")
+  parser.add_argument("--workers", type = int, default = 4,
+                      help = "Requests in flight at once")
+  parser.add_argument("--rate", type = float, default = 2.0,
+                      help = "Requests per second to RideWithGPS (0: no limit)")
+  parser.add_argument("--dry-run", action = "store_true",
+                      help = "Only report which routes changed")
+  args = parser.parse_args(argv[1:])
+
+  entries = cachedRoutes(args.older_than)
+  if args.limit:
+    entries = entries[:args.limit]
+  cached = dict((route_id, (version, fingerprint))
+                for _, route_id, _, version, fingerprint in entries)
+  print "Checking %d cached routes..." % len(entries)
+
+  counts = {}
+  start = time.time()
+  results = sweeper.revalidate([(entry[1], entry[2]) for entry in entries],
+                               ridewithgps.getETagAndCuesheet_viaJSON,
+                               workers = args.workers,
+                               rate = args.rate)
+  for route_id, etag, route, error in results:
+    if error is not None:
+      result = "ERROR"
+      print "%10s: %s" % (route_id, error)
+    elif route is None:
+      result = "NOT_MODIFIED"
+    elif args.dry_run:
+      result = "CHANGED"
+    else:
+      result = refreshRoute(route_id, etag, route, *cached[route_id])
+    counts[result] = counts.get(result, 0) + 1
+    if result != "NOT_MODIFIED":
+      print "%10s: %s" % (route_id, result)
+
+  print "Checked %d routes in %.1f s: %s" % (
+      len(entries), time.time() - start,
+      ", ".join("%d %s" % (n, result.lower()) for result, n in sorted(counts.items())))
+  return 1 if "ERROR" in counts or "FAILED" in counts else 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
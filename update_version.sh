@@ -128,6 +128,15 @@ if [[ $response == 'y' || $response == "Y" ]]; then
     exit 1
   fi
 
+  # The served copies of the static files are built from them, hashed names
+  # and all; rebuild them so the new index.html goes out:
+  echo "Building static assets..."
+  if ! python build_assets.py >/dev/null; then
+    echo "Error building static assets; the version commit + tag are done, so"
+    echo "just re-run build_assets.py."
+    exit 1
+  fi
+
   echo "Done"
 
 else